@@ -0,0 +1,320 @@
+"""
+Benchmarks for dcmtag2table.
+
+Generates a deterministic synthetic DICOM corpus from the pydicom test
+datasets and times each pipeline stage at several worker counts, reporting
+files/s, MB/s and the largest peak RSS of a single process as JSON so runs
+can be compared across commits.
+
+    python benchmarks/benchmark.py run --studies 20 --workers 1 4 8 --output bench.json
+    python benchmarks/benchmark.py compare before.json after.json
+
+Each measurement runs in a fresh Python process, so the peak RSS of one
+stage never leaks into another. The metric is the peak of the largest
+process (the driver or any one worker), not the sum over the pool: the
+whole stage may use up to about workers times as much.
+"""
+import argparse
+import contextlib
+import copy
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pydicom
+from pydicom.data import get_testdata_file
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+STAGES = ["scan", "replace_ids", "allow_list", "dump_unique"]
+
+# Tags read by the scan stage
+SCAN_TAGS = [
+    "PatientID", "PatientName", "PatientSex", "PatientAge", "AccessionNumber", "StudyID",
+    "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID", "Modality", "StudyDate", "SeriesDescription",
+]
+
+# Tags kept by the allow_list stage
+ALLOW_TAGS = [
+    "SOPClassUID", "Modality", "Rows", "Columns", "BitsAllocated", "BitsStored", "HighBit",
+    "PixelRepresentation", "SamplesPerPixel", "PhotometricInterpretation", "NumberOfFrames", "PixelData",
+]
+
+
+# --------------------------------------------------------------------------
+# Synthetic corpus
+# --------------------------------------------------------------------------
+
+def _uid(*parts):
+    # Deterministic UID: same corpus parameters, same UIDs
+    return generate_uid(entropy_srcs=[str(p) for p in parts])
+
+
+def _nested_sequence(depth, rng):
+    item = Dataset()
+    item.CodeValue = str(rng.randint(0, 99999))
+    item.CodeMeaning = f"level {depth}"
+    if depth > 1:
+        item.ContentSequence = Sequence([_nested_sequence(depth - 1, rng) for _ in range(2)])
+    return item
+
+
+def _add_private_block(ds, rng):
+    block = ds.private_block(0x0019, "DCMTAG2TABLE BENCH", create=True)
+    block.add_new(0x10, "LO", f"private {rng.randint(0, 10 ** 6)}")
+    block.add_new(0x11, "DS", f"{rng.random():.6f}")
+    block.add_new(0x12, "OB", bytes(rng.getrandbits(8) for _ in range(256)))
+
+
+def _make_instance(kind, template, study, series, instance, rng):
+    # Dataset.copy() is shallow: elements set below would leak into the template
+    ds = copy.deepcopy(template)
+    ds.PatientID = f"PAT{study % 97:05d}"
+    ds.PatientName = f"Synthetic^{study % 97}"
+    ds.PatientSex = "MF"[study % 2]
+    ds.PatientAge = f"{20 + study % 70:03d}Y"
+    ds.AccessionNumber = f"ACC{study:07d}"
+    ds.StudyID = str(study)
+    ds.StudyInstanceUID = _uid("study", study)
+    ds.SeriesInstanceUID = _uid("series", study, series)
+    ds.SOPInstanceUID = _uid("sop", study, series, instance)
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.SeriesDescription = f"{kind} series {series}"
+    ds.InstanceNumber = instance + 1
+    if kind == "multiframe":
+        frames = 8
+        ds.NumberOfFrames = frames
+        ds.PixelData = template.PixelData * frames
+    elif kind == "sequences":
+        ds.ContentSequence = Sequence([_nested_sequence(4, rng) for _ in range(3)])
+    elif kind == "private":
+        _add_private_block(ds, rng)
+    return ds
+
+
+def generate_corpus(out_dir, studies=10, series_per_study=3, instances_per_series=20, noise_files=10, seed=0):
+    """
+    Write a synthetic corpus to <out_dir>/<study>/<series>/<instance>.dcm.
+    Series cycle through CT slices, multi-frame images, deep sequences and
+    private tags; <noise_files> non-DICOM files are added at the top level.
+    Returns the number of files and bytes written.
+    """
+    rng = random.Random(seed)
+    template = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    kinds = ["ct", "multiframe", "sequences", "private"]
+    n_files = 0
+    n_bytes = 0
+    for study in range(studies):
+        for series in range(series_per_study):
+            kind = kinds[(study + series) % len(kinds)]
+            series_dir = os.path.join(out_dir, f"{study:05d}", f"{series:03d}")
+            os.makedirs(series_dir, exist_ok=True)
+            for instance in range(instances_per_series):
+                path = os.path.join(series_dir, f"{instance:05d}.dcm")
+                _make_instance(kind, template, study, series, instance, rng).save_as(path, enforce_file_format=True)
+                n_files += 1
+                n_bytes += os.path.getsize(path)
+    noise_dir = os.path.join(out_dir, "noise")
+    os.makedirs(noise_dir, exist_ok=True)
+    for i in range(noise_files):
+        path = os.path.join(noise_dir, f"noise_{i:04d}.bin")
+        with open(path, "wb") as f:
+            f.write(bytes(rng.getrandbits(8) for _ in range(rng.randint(16, 4096))))
+        n_files += 1
+        n_bytes += os.path.getsize(path)
+    return n_files, n_bytes
+
+
+# --------------------------------------------------------------------------
+# Measurement (child process)
+# --------------------------------------------------------------------------
+
+def _max_process_rss_mb():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS. For RUSAGE_CHILDREN
+    # it is the largest single child, so this is the largest process peak
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return max(own, children) / 1e6
+
+
+def _run_stage(stage, corpus, workers, work_dir):
+    import dcmtag2table as d
+
+    if stage == "scan":
+        d.dcmtag2table_parallel(corpus, SCAN_TAGS, max_workers=workers)
+    elif stage == "replace_ids":
+        df = d.dcmtag2table_parallel(corpus, SCAN_TAGS, max_workers=workers)
+        start = time.perf_counter()
+        d.replace_ids_parallel_joblib(df, prefix="1.2.840.12345.", n_jobs=workers)
+        return time.perf_counter() - start
+    elif stage == "allow_list":
+        d.allow_list_parallel(corpus, os.path.join(work_dir, "out"), ALLOW_TAGS, max_workers=workers,
+                              scan_workers=workers)
+    elif stage == "dump_unique":
+        d.dump_unique_values_parallel(corpus, os.path.join(work_dir, "unique.txt"), max_workers=workers)
+    else:
+        raise ValueError(f"unknown stage {stage}")
+    return None
+
+
+def measure(stage, corpus, workers):
+    """Run one stage once in this process and return its metrics."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Keep stdout for the JSON result
+        with contextlib.redirect_stdout(sys.stderr):
+            start = time.perf_counter()
+            elapsed = _run_stage(stage, corpus, workers, work_dir)
+            if elapsed is None:
+                elapsed = time.perf_counter() - start
+    return {"seconds": elapsed, "max_process_rss_mb": _max_process_rss_mb()}
+
+
+# --------------------------------------------------------------------------
+# Driver
+# --------------------------------------------------------------------------
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    corpus = args.corpus or tempfile.mkdtemp(prefix="dcmtag2table-bench-")
+    try:
+        generated = not os.listdir(corpus)
+        if generated:
+            print(f"Generating corpus in {corpus}...", file=sys.stderr)
+            n_files, n_bytes = generate_corpus(corpus, args.studies, args.series, args.instances, args.noise,
+                                               args.seed)
+        else:
+            n_files, n_bytes = _corpus_size(corpus)
+        results = []
+        for stage in args.stages:
+            for workers in args.workers:
+                runs = []
+                for _ in range(args.repeats):
+                    child = subprocess.run(
+                        [sys.executable, os.path.abspath(__file__), "_measure", stage, corpus, str(workers)],
+                        stdout=subprocess.PIPE, stderr=None if args.verbose else subprocess.DEVNULL, text=True,
+                        check=True,
+                    )
+                    runs.append(json.loads(child.stdout.strip().splitlines()[-1]))
+                best = min(r["seconds"] for r in runs)
+                result = {
+                    "stage": stage,
+                    "workers": workers,
+                    "seconds": best,
+                    "files_per_s": n_files / best,
+                    "mb_per_s": n_bytes / 1e6 / best,
+                    "max_process_rss_mb": max(r["max_process_rss_mb"] for r in runs),
+                    "runs": [r["seconds"] for r in runs],
+                }
+                results.append(result)
+                print(f"{stage:12s} workers={workers:<3d} {result['files_per_s']:10.1f} files/s "
+                      f"{result['mb_per_s']:8.1f} MB/s {result['max_process_rss_mb']:8.1f} MB largest process peak",
+                      file=sys.stderr)
+    finally:
+        if not args.corpus and not args.keep_corpus:
+            shutil.rmtree(corpus, ignore_errors=True)
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pydicom": pydicom.__version__,
+        "cpus": os.cpu_count(),
+        "corpus": {"files": n_files, "bytes": n_bytes},
+        "results": results,
+    }
+    if generated:
+        report["corpus"].update(studies=args.studies, series=args.series, instances=args.instances,
+                                noise=args.noise, seed=args.seed)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+def _corpus_size(corpus):
+    n_files = 0
+    n_bytes = 0
+    for dirpath, _, filenames in os.walk(corpus):
+        for name in filenames:
+            n_files += 1
+            n_bytes += os.path.getsize(os.path.join(dirpath, name))
+    return n_files, n_bytes
+
+
+def _rss(result):
+    # Reports written before the rename hold the same value as peak_rss_mb
+    return result.get("max_process_rss_mb", result.get("peak_rss_mb"))
+
+
+def compare(args):
+    """Print the files/s ratio (after / before) of every stage and worker count."""
+    with open(args.before) as f:
+        before = {(r["stage"], r["workers"]): r for r in json.load(f)["results"]}
+    with open(args.after) as f:
+        after = json.load(f)["results"]
+    print(f"{'stage':12s} {'workers':>7s} {'before':>10s} {'after':>10s} {'speedup':>8s} {'rss':>8s}")
+    for r in after:
+        old = before.get((r["stage"], r["workers"]))
+        if old is None:
+            continue
+        print(f"{r['stage']:12s} {r['workers']:7d} {old['files_per_s']:10.1f} {r['files_per_s']:10.1f} "
+              f"{r['files_per_s'] / old['files_per_s']:7.2f}x {_rss(r) / _rss(old):7.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="generate a corpus and time every stage")
+    run_parser.add_argument("--corpus", help="existing corpus (or empty directory to generate it in)")
+    run_parser.add_argument("--keep-corpus", action="store_true", help="do not delete the generated corpus")
+    run_parser.add_argument("--studies", type=int, default=10)
+    run_parser.add_argument("--series", type=int, default=3, help="series per study")
+    run_parser.add_argument("--instances", type=int, default=20, help="instances per series")
+    run_parser.add_argument("--noise", type=int, default=10, help="non-DICOM files")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    run_parser.add_argument("--workers", nargs="+", type=int, default=[1, 4])
+    run_parser.add_argument("--repeats", type=int, default=3, help="runs per measurement (best is kept)")
+    run_parser.add_argument("--output", help="JSON file for the results (default: stdout)")
+    run_parser.add_argument("--verbose", action="store_true", help="show the output of the stages")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.set_defaults(func=compare)
+
+    measure_parser = subparsers.add_parser("_measure")
+    measure_parser.add_argument("stage", choices=STAGES)
+    measure_parser.add_argument("corpus")
+    measure_parser.add_argument("workers", type=int)
+    measure_parser.set_defaults(func=lambda a: print(json.dumps(measure(a.stage, a.corpus, a.workers))))
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,21 @@ import pandas as pd
 import os
 import shutil
 import time
+import functools
+import argparse
+import json
+import re
+import io
+import struct
+import sqlite3
+import hmac
+import hashlib
+import tarfile
+import heapq
+import tempfile
+import numpy as np
+from collections import defaultdict, deque
+from contextlib import contextmanager
 from typing import Set
 from datetime import datetime
 from joblib import Parallel, delayed
@@ -168,14 +183,181 @@ required_mg_dicom_tags = [
 ]
 
 
-def dcmtag2table(folder, list_of_tags):
+class Instrumentation:
+    """
+    Stage timers, counters and per-worker throughput of the pipeline.
+    The module-level instance (see set_instrumentation) is updated by the
+    scan, read, ID replacement, rewrite and dump functions, always in the
+    parent process: worker processes report their file counts and busy
+    time with their results.
+
+    Counters: files_listed, files_skipped and bytes_listed (directory scan),
+    files_parsed and files_failed (tag reads), files_written, files_failed
+    and bytes_written (rewrites), and bytes_read, the bytes of the input
+    files read by the scans and rewrites (headers up to where parsing
+    stopped, prefetched blocks and copied pixel data).
+
+    Parameters:
+        callback (callable, optional): called as callback(event, name, value)
+            for every update: ("stage", stage name, seconds),
+            ("counter", counter name, increment) and
+            ("worker", pid, (files, seconds)).
+        verbose (bool): print a line for every file that fails, as it fails.
+    """
+
+    def __init__(self, callback=None, verbose=False):
+        self.callback = callback
+        self.verbose = verbose
+        self.reset()
+
+    def reset(self):
+        self.counters = defaultdict(int)
+        self.stage_seconds = defaultdict(float)
+        self.workers = defaultdict(lambda: [0, 0.0])
+        self._active = set()
+
+    @contextmanager
+    def stage(self, name):
+        # A stage nested in itself (e.g. replace_ids calling replace_uids) is timed once
+        if name in self._active:
+            yield
+            return
+        self._active.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._active.discard(name)
+            elapsed = time.perf_counter() - start
+            self.stage_seconds[name] += elapsed
+            if self.callback is not None:
+                self.callback("stage", name, elapsed)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+        if self.callback is not None:
+            self.callback("counter", name, n)
+
+    def worker(self, pid, files, seconds):
+        self.workers[pid][0] += files
+        self.workers[pid][1] += seconds
+        if self.callback is not None:
+            self.callback("worker", pid, (files, seconds))
+
+    def log(self, message):
+        # Per-file messages are printed only when asked for
+        if self.verbose:
+            print(message)
+
+    def snapshot(self):
+        """Return the counters, stage times and worker throughput as a dict."""
+        return {
+            "counters": dict(self.counters),
+            "stage_seconds": dict(self.stage_seconds),
+            "workers": {
+                pid: {"files": files, "seconds": seconds, "files_per_s": files / seconds if seconds else 0.0}
+                for pid, (files, seconds) in self.workers.items()
+            },
+        }
+
+    def to_prometheus(self, prefix="dcmtag2table"):
+        """Format the current values in the Prometheus text exposition format."""
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+        lines.append(f"# TYPE {prefix}_stage_seconds_total counter")
+        for name, value in sorted(self.stage_seconds.items()):
+            lines.append(f'{prefix}_stage_seconds_total{{stage="{name}"}} {value:.6f}')
+        lines.append(f"# TYPE {prefix}_worker_files_total counter")
+        for pid, (files, _) in sorted(self.workers.items()):
+            lines.append(f'{prefix}_worker_files_total{{pid="{pid}"}} {files}')
+        lines.append(f"# TYPE {prefix}_worker_seconds_total counter")
+        for pid, (_, seconds) in sorted(self.workers.items()):
+            lines.append(f'{prefix}_worker_seconds_total{{pid="{pid}"}} {seconds:.6f}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="dcmtag2table"):
+        """
+        Write the values to <path> for the node_exporter textfile collector.
+        The file is replaced atomically, so the collector never reads it half written.
+        """
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus(prefix))
+        os.replace(tmp_path, path)
+
+
+instrumentation = Instrumentation()
+
+
+def set_instrumentation(new):
+    """
+    Replace the module-level Instrumentation updated by the pipeline
+    functions. Returns the previous one.
+    """
+    global instrumentation
+    previous = instrumentation
+    instrumentation = new
+    return previous
+
+
+def _staged(name):
+    """Decorator timing every call of a function as stage <name>."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with instrumentation.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Bytes of input files read by this process (see _timed_call)
+_bytes_read = 0
+
+
+def _count_bytes_read(n):
+    global _bytes_read
+    _bytes_read += n
+
+
+@contextmanager
+def _counting_bytes_read():
+    # Report the bytes read by this process within the block, for reads run in the parent
+    start = _bytes_read
+    try:
+        yield
+    finally:
+        instrumentation.count("bytes_read", _bytes_read - start)
+
+
+def _timed_call(func, *args):
+    """
+    Run func(*args) in a worker and return (result, pid, busy seconds, bytes
+    read), so the parent can record per-worker throughput and read volume.
+    """
+    start = time.perf_counter()
+    start_bytes = _bytes_read
+    result = func(*args)
+    return result, os.getpid(), time.perf_counter() - start, _bytes_read - start_bytes
+
+
+def dcmtag2table(folder, list_of_tags, cache_path=None, tag_bounded=False, typed=False):
     """
     # Create a Pandas DataFrame with the <list_of_tags> DICOM tags
     # from the DICOM files in <folder>
 
     # Parameters:
     #    folder (str): folder to be recursively walked looking for DICOM files.
-    #    list_of_tags (list of strings): list of DICOM tags with no whitespaces.
+    #    list_of_tags (list of strings): list of DICOM tags with no whitespaces, or tag
+    #        paths such as Seq[0].Keyword, Seq/*/Keyword or (gggg,xxee,CREATOR)
+    #        (see _compile_tag_path).
+    #    cache_path (str, optional): scan manifest to reuse between runs. Only
+    #        new or modified files are read again (see _incremental_read).
+    #    tag_bounded (bool): parse only the requested tags and stop reading
+    #        each file after the highest one (see _dcmread_header).
+    #    typed (bool): give each tag column a dtype driven by its VR, with
+    #        nulls instead of "Not found" (see _apply_tag_dtypes).
 
     # Returns:
     #    df (DataFrame): table of DICOM tags from the files in folder.
@@ -183,31 +365,42 @@ def dcmtag2table(folder, list_of_tags):
     list_of_tags = list_of_tags.copy()
     items = []
     table = []
-    filelist = []
     print("Listing all files...")
     start = time.time()
-    for root, dirs, files in os.walk(folder, topdown=False):
-        for name in files:
-            filelist.append(os.path.join(root, name))
+    file_stats, skipped = scan_dicom_files(folder, return_stats=True)
+    filelist = [f[0] for f in file_stats]
     print("Time: " + str(time.time() - start))
     print("Reading files...")
-    time.sleep(2)
-    for _f in tqdm(filelist):
-        try:
-            ds = pydicom.dcmread(_f, stop_before_pixels=True, force=True)
-            items = []
-            items.append(_f)
-
-            for _tag in list_of_tags:
-                if _tag in ds:
-                    items.append(ds.data_element(_tag).value)
-                else:
-                    items.append("Not found")
+    if cache_path is not None:
+        _report_skipped(skipped)
+
+        def read_rows(paths, tags):
+            # Compiled once per call: the tags differ between the two reads of _incremental_read
+            plan = _compile_plan(tags)
+            bound = _tag_bound(tags) if tag_bounded else None
+            return [_read_dicom_tags(_f, plan, bound) for _f in tqdm(paths)]
+
+        with _counting_bytes_read():
+            df = _incremental_read(file_stats, list_of_tags, cache_path, read_rows)
+        if typed:
+            df = _apply_tag_dtypes(df, list_of_tags)
+        print("Finished.")
+        return df
+    plan = _compile_plan(list_of_tags)
+    tag_bound = _tag_bound(list_of_tags) if tag_bounded else None
+    with instrumentation.stage("read"), _counting_bytes_read():
+        for _f in tqdm(filelist):
+            try:
+                ds = _dcmread_header(_f, tag_bound)
+                items = [_f] + _apply_plan(ds, plan)
+                table.append((items))
+            except:
+                skipped["unreadable by pydicom"].append(_f)
+                instrumentation.log(f"Unreadable by pydicom: {_f}")
+    instrumentation.count("files_parsed", len(table))
+    instrumentation.count("files_failed", len(filelist) - len(table))
+    _report_skipped(skipped)
 
-            table.append((items))
-        except:
-            print("Skipping non-DICOM: " + _f)
-      
     list_of_tags.insert(0, "Filename")
     test = list(map(list, zip(*table)))
     dictone = {}
@@ -216,7 +409,8 @@ def dcmtag2table(folder, list_of_tags):
         dictone[_tag] = test[i]
 
     df = pd.DataFrame(dictone)
-    time.sleep(2)
+    if typed:
+        df = _apply_tag_dtypes(df, list_of_tags[1:])
     print("Finished.")
     return df
 import os
@@ -224,80 +418,1650 @@ import time
 import pydicom
 import pandas as pd
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+
+# Process pool shared by every stage run inside worker_pool(), or None
+_shared_pool = None
+
+
+@contextmanager
+def worker_pool(max_workers):
+    """
+    Run every stage called inside the block (scan, rewrite, dump, profile)
+    on one long-lived pool of <max_workers> processes, instead of each stage
+    starting its own workers and importing pydicom in them again. The
+    max_workers arguments of the stages are ignored inside the block.
+    Nested blocks reuse the outer pool.
+    """
+    global _shared_pool
+    if _shared_pool is not None:
+        yield _shared_pool
+        return
+    _shared_pool = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        yield _shared_pool
+    finally:
+        pool, _shared_pool = _shared_pool, None
+        pool.shutdown()
+
+
+@contextmanager
+def _process_pool(max_workers):
+    # The shared pool when one is active, otherwise a pool for this stage only
+    if _shared_pool is not None:
+        yield _shared_pool
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            yield executor
+
+
+def _map_unordered(func, arg_tuples, max_workers):
+    """
+    Yield func(*args) for every tuple of <arg_tuples>, in completion order:
+    on the shared pool with a bounded number of tasks in flight, or on a
+    joblib pool of <max_workers> outside worker_pool().
+    """
+    if _shared_pool is None:
+        yield from Parallel(n_jobs=max_workers, return_as="generator_unordered")(
+            delayed(func)(*args) for args in arg_tuples)
+        return
+    pending = set()
+    limit = 2 * _shared_pool._max_workers
+    for args in arg_tuples:
+        pending.add(_shared_pool.submit(func, *args))
+        if len(pending) >= limit:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in as_completed(pending):
+        yield future.result()
+
+
+# Pixel data elements are never extracted into tables
+_PIXEL_DATA_TAGS = {0x7FE00008, 0x7FE00009, 0x7FE00010}
+
+# One step of a tag path: a keyword, (gggg,eeee) or a private (gggg,xxee,CREATOR),
+# optionally followed by [n] or [*]; a bare * step means [*] on the previous one
+_TAG_PATH_STEP = re.compile(
+    r"(?:\((?P<group>[0-9A-Fa-f]{4}),(?P<element>[0-9A-Fa-fXx]{4})(?:,(?P<creator>[^)]+))?\)"
+    r"|(?P<keyword>[A-Za-z][A-Za-z0-9]*)|(?P<star>\*))"
+    r"(?:\[(?P<index>\d+|\*)\])?"
+)
+
+
+def _compile_tag_path(path):
+    """
+    Compile a tag path to a tuple of (tag, creator, index) steps.
+
+    Steps are separated by "." or "/" and are a keyword, a hex tag
+    (gggg,eeee) or a private tag (gggg,xxee,CREATOR), where the block
+    xx is looked up from the private creator in each file (a block given
+    in hex, as in (0019,101E,CREATOR), is ignored the same way). Every step but
+    the last is a sequence: [n] selects item n (the first one by default)
+    and [*] or a following "*" step selects every item, as in the paths
+    written by dump_unique_values_per_tag (e.g. Seq/*/Keyword).
+    Returns () for an unknown keyword, which is then always "Not found".
+    Raises ValueError for a malformed path.
+    """
+    steps = []
+    unknown = False
+    pos = 0
+    while True:
+        m = _TAG_PATH_STEP.match(path, pos)
+        if m is None:
+            raise ValueError(f"Invalid tag path {path!r} at position {pos}")
+        if m.group("star"):
+            if not steps or steps[-1][2] is not None or m.group("index"):
+                raise ValueError(f"Invalid tag path {path!r}: misplaced *")
+            steps[-1][2] = "*"
+        else:
+            index = m.group("index")
+            if index is not None and index != "*":
+                index = int(index)
+            creator = m.group("creator")
+            if m.group("keyword"):
+                tag = pydicom.datadict.tag_for_keyword(m.group("keyword"))
+                if tag is None:
+                    unknown = True
+                    tag = 0
+            elif creator is not None:
+                group = int(m.group("group"), 16)
+                if group % 2 == 0:
+                    raise ValueError(f"Invalid tag path {path!r}: private creator on even group")
+                element = m.group("element")
+                if "x" in element[2:].lower() or ("x" in element[:2].lower() and element[:2].lower() != "xx"):
+                    raise ValueError(
+                        f"Invalid tag path {path!r}: a private tag is (gggg,xxee,CREATOR) or (gggg,bbee,CREATOR), "
+                        f"with the element offset ee in hex (the block bb is looked up from CREATOR)")
+                tag = (group << 16) | int(element[2:], 16)
+                creator = creator.strip()
+            elif "x" in m.group("element").lower():
+                raise ValueError(f"Invalid tag path {path!r}: xx needs a private creator")
+            else:
+                tag = int(m.group("group") + m.group("element"), 16)
+            steps.append([pydicom.tag.Tag(tag), creator, index])
+        pos = m.end()
+        if pos == len(path):
+            break
+        if path[pos] not in "./":
+            raise ValueError(f"Invalid tag path {path!r} at position {pos}")
+        pos += 1
+    if steps[-1][2] is not None:
+        raise ValueError(f"Invalid tag path {path!r}: the last step cannot select items")
+    if unknown:
+        return ()
+    for step in steps[:-1]:
+        if step[2] is None:
+            step[2] = 0
+    return tuple(tuple(step) for step in steps)
+
+
+def _compile_plan(list_of_tags):
+    """
+    Compile <list_of_tags> (keywords or tag paths, see _compile_tag_path)
+    once per run into an extraction plan: a list of (name, steps, wildcard)
+    holding integer tags only, so workers never look keywords up again.
+    """
+    plan = []
+    for name in list_of_tags:
+        steps = _compile_tag_path(name)
+        plan.append((name, steps, any(index == "*" for _, _, index in steps)))
+    return plan
+
+
+def _path_values(ds, steps, values):
+    # Append to <values> the values found at <steps> below <ds>
+    tag, creator, index = steps[0]
+    if creator is not None:
+        try:
+            tag = ds.private_block(tag >> 16, creator).get_tag(tag & 0xFF)
+        except KeyError:
+            return
+    try:
+        element = ds[tag]
+    except KeyError:
+        return
+    if len(steps) == 1:
+        values.append(element.value)
+        return
+    if element.VR != "SQ":
+        return
+    items = element.value
+    if index == "*":
+        for item in items:
+            _path_values(item, steps[1:], values)
+    elif index < len(items):
+        _path_values(items[index], steps[1:], values)
+
+
+def _apply_plan(ds, plan):
+    """
+    Extract the values of a compiled <plan> from <ds>: one value per entry,
+    a list of values for paths with [*], or "Not found".
+    """
+    row = []
+    for _, steps, wildcard in plan:
+        if len(steps) == 1 and steps[0][1] is None:
+            # Plain top-level tag
+            try:
+                row.append(ds[steps[0][0]].value)
+            except KeyError:
+                row.append("Not found")
+            continue
+        values = []
+        if steps:
+            _path_values(ds, steps, values)
+        if wildcard:
+            row.append(values if values else "Not found")
+        else:
+            row.append(values[0] if values else "Not found")
+    return row
+
+
+def _tag_bound(list_of_tags):
+    """
+    Resolve <list_of_tags> (keywords or tag paths) to tag numbers once per
+    run. Returns (specific_tags, max_tag) for _dcmread_header, or None when
+    no path starts with a known tag. Unknown keywords are ignored: they are
+    always "Not found" anyway. A private step keeps every private creator of
+    its group and the element at its offset in every block.
+    """
+    tags = set()
+    for _, steps, _ in _compile_plan(list_of_tags):
+        if not steps:
+            continue
+        tag, creator, _ = steps[0]
+        if creator is None:
+            tags.add(tag)
+            continue
+        group = tag & 0xFFFF0000
+        for block in range(0x10, 0x100):
+            tags.add(group | block)
+            tags.add(group | (block << 8) | (tag & 0xFF))
+    tags = sorted(t for t in tags if t not in _PIXEL_DATA_TAGS)
+    if not tags:
+        return None
+    return tags, tags[-1]
+
+
+def _dcmread_header(filepath, tag_bound=None):
+    """
+    Read the header of a DICOM file without pixel data.
+
+    With a <tag_bound> from _tag_bound, only the requested elements are
+    parsed (the values of the others are skipped over), and reading stops at
+    the first top-level element past the highest requested tag.
+    """
+    if tag_bound is None:
+        def read(fp):
+            return pydicom.dcmread(fp, stop_before_pixels=True, force=True)
+    else:
+        specific_tags, max_tag = tag_bound
+
+        def stop_when(tag, vr, length):
+            return tag > max_tag or tag in _PIXEL_DATA_TAGS
+
+        def read(fp):
+            return pydicom.filereader.read_partial(fp, stop_when, force=True, specific_tags=specific_tags)
+
+    if not isinstance(filepath, (str, os.PathLike)):
+        # Already an open file object
+        return read(filepath)
+    with open(filepath, "rb") as fp:
+        ds = read(fp)
+        _count_bytes_read(fp.tell())
+    return ds
+
+
+_FLOAT_VRS = {"DS", "FD", "FL"}
+_INT_VRS = {"IS", "US", "UL", "SS", "SL", "SV", "UV", "AT"}
+_CATEGORY_VRS = {"UI", "CS", "AE", "AS", "DA", "TM", "DT"}
+_TEXT_VRS = {"SH", "LO", "ST", "LT", "UT", "UC", "UR", "PN"}
+
+
+def _tag_kinds(list_of_tags):
+    """
+    Map each keyword or tag path to (kind, multi) from the DICOM dictionary
+    entry of its last tag, where kind
+    is "float", "int", "category", "string" or "object" and multi is True
+    for tags whose VM allows more than one value. Paths with [*] return a
+    list of values, one per item: they are lists of strings.
+    """
+    kinds = {}
+    for _tag, steps, wildcard in _compile_plan(list_of_tags):
+        if wildcard:
+            kinds[_tag] = ("string", True)
+            continue
+        if not steps or steps[-1][1] is not None or steps[-1][0] not in pydicom.datadict.DicomDictionary:
+            # Unknown and private tags
+            kinds[_tag] = ("object", False)
+            continue
+        tag = steps[-1][0]
+        vr = pydicom.datadict.dictionary_VR(tag).split(" or ")[0]
+        multi = pydicom.datadict.dictionary_VM(tag) != "1"
+        if vr in _FLOAT_VRS:
+            kinds[_tag] = ("float", multi)
+        elif vr in _INT_VRS:
+            kinds[_tag] = ("int", multi)
+        elif vr in _CATEGORY_VRS:
+            kinds[_tag] = ("category", multi)
+        elif vr in _TEXT_VRS:
+            kinds[_tag] = ("string", multi)
+        else:
+            kinds[_tag] = ("object", False)
+    return kinds
+
+
+def _convert_scalar(value, kind):
+    if value is None or value == "":
+        return None
+    try:
+        if kind == "float":
+            return float(value)
+        if kind == "int":
+            return int(value)
+    except (TypeError, ValueError):
+        return None
+    if kind in ("category", "string"):
+        return str(value)
+    return value
+
+
+def _convert_value(value, kind, multi):
+    """
+    Convert a raw pydicom value (DSfloat, IS, PersonName, MultiValue...) to
+    plain Python: a scalar, or a list for multi-valued tags. Missing tags
+    ("Not found") become None. Calling it on a converted value is a no-op.
+    """
+    if isinstance(value, str) and value == "Not found":
+        return None
+    if kind == "object":
+        return value
+    if multi:
+        if value is None or value == "":
+            return None
+        if isinstance(value, (list, pydicom.multival.MultiValue)):
+            return [_convert_scalar(v, kind) for v in value]
+        return [_convert_scalar(value, kind)]
+    if isinstance(value, (list, pydicom.multival.MultiValue)):
+        # VM 1 tag holding several values: not representable in the column
+        return None
+    return _convert_scalar(value, kind)
+
+
+_PANDAS_DTYPES = {"float": "Float64", "int": "Int64", "category": "category", "string": "string"}
+
+
+def _apply_tag_dtypes(df, list_of_tags, converted=False):
+    """
+    Give every tag column of <df> a dtype driven by the tag's VR: numeric
+    VRs become nullable Float64/Int64, UIDs and codes become categoricals,
+    text becomes strings and multi-valued tags become list columns.
+    Missing values are real nulls instead of "Not found".
+    Pass <converted> when the workers already ran _convert_value.
+    """
+    kinds = _tag_kinds(list_of_tags)
+    df = df.copy()
+    for _tag in list_of_tags:
+        kind, multi = kinds[_tag]
+        if converted:
+            values = list(df[_tag])
+        else:
+            values = [_convert_value(v, kind, multi) for v in df[_tag]]
+        if multi or kind == "object":
+            df[_tag] = pd.Series(values, index=df.index, dtype=object)
+        else:
+            df[_tag] = pd.Series(values, index=df.index, dtype=object).astype(_PANDAS_DTYPES[kind])
+    return df
+
+
+def _prefetch_header(filepath, prefetch_bytes):
+    """
+    Read the first <prefetch_bytes> of a file (run on an I/O thread).
+    Returns (data, complete) where complete is True when data holds the
+    whole file, or None if the file cannot be read.
+    """
+    try:
+        with open(filepath, "rb") as fp:
+            data = fp.read(prefetch_bytes)
+    except OSError:
+        return None
+    return data, len(data) < prefetch_bytes
 
 
-def _read_dicom_tags(filepath, list_of_tags):
+def _dcmread_prefetched(filepath, header, tag_bound=None):
+    """
+    Parse a header prefetched by _prefetch_header. If the prefetch stopped
+    before the parser reached pixel data or the last requested tag, the
+    file is read again from disk.
+    """
+    if header is None:
+        return _dcmread_header(filepath, tag_bound)
+    data, complete = header
+    _count_bytes_read(len(data))
+    fp = io.BytesIO(data)
+    try:
+        ds = _dcmread_header(fp, tag_bound)
+    except Exception:
+        if complete:
+            raise
+        return _dcmread_header(filepath, tag_bound)
+    # The parser rewinds to the element it stopped at, so it only reaches
+    # the end of the buffer when the header was cut short
+    if not complete and fp.tell() >= len(data):
+        return _dcmread_header(filepath, tag_bound)
+    return ds
+
+
+def _read_dicom_tags(filepath, plan, tag_bound=None, kinds=None, header=None):
     """
     Helper function to read a single DICOM file
-    and extract the requested tags.
+    and extract the tags of a plan compiled by _compile_plan.
+    With <kinds> from _tag_kinds, values are converted to plain Python
+    (see _convert_value) before they are returned. With <header> (bytes
+    prefetched by _prefetch_header) the file is parsed from memory.
     Returns a list [filepath, tag1, tag2, ...] or None on failure.
     """
     try:
-        ds = pydicom.dcmread(filepath, stop_before_pixels=True, force=True)
-        row = [filepath]
-        for tag in list_of_tags:
-            value = ds.data_element(tag).value if tag in ds else "Not found"
-            row.append(value)
-        return row
+        ds = _dcmread_prefetched(filepath, header, tag_bound)
+        row = _apply_plan(ds, plan)
+        if kinds is not None:
+            row = [_convert_value(value, *kinds[name]) for value, (name, _, _) in zip(row, plan)]
+        return [filepath] + row
     except Exception:
         # If it's not a valid DICOM or can't be read, return None
         return None
 
 
-def dcmtag2table_parallel(folder, list_of_tags, max_workers=4):
+def _iter_prefetched(filepaths, io_threads, prefetch_bytes):
+    """
+    Yield (filepath, header) pairs in order while up to 4 * <io_threads>
+    headers are being fetched ahead on a thread pool. The calling thread
+    parses the headers already fetched while the I/O threads wait on storage.
+    """
+    if io_threads <= 1:
+        for filepath in filepaths:
+            yield filepath, None
+        return
+    with ThreadPoolExecutor(max_workers=io_threads) as pool:
+        in_flight = deque()
+        for filepath in filepaths:
+            in_flight.append((filepath, pool.submit(_prefetch_header, filepath, prefetch_bytes)))
+            if len(in_flight) >= 4 * io_threads:
+                head_path, future = in_flight.popleft()
+                yield head_path, future.result()
+        while in_flight:
+            head_path, future = in_flight.popleft()
+            yield head_path, future.result()
+
+
+def _read_dicom_batch(filepaths, plan, tag_bound=None, kinds=None, io_threads=1, prefetch_bytes=65536):
+    """
+    Read the tags of a compiled <plan> from a batch of DICOM files in a
+    worker and return the result in columnar form, so only one object per
+    column is pickled back.
+    With <io_threads> > 1 the first <prefetch_bytes> of upcoming files are
+    fetched by I/O threads while this process parses (see _iter_prefetched).
+    Returns ({"Filename": [...], tag1: [...], ...}, [unreadable filepaths]).
+    """
+    columns = {"Filename": []}
+    for tag, _, _ in plan:
+        columns[tag] = []
+    failed = []
+    for filepath, header in _iter_prefetched(filepaths, io_threads, prefetch_bytes):
+        row = _read_dicom_tags(filepath, plan, tag_bound, kinds, header)
+        if row is None:
+            failed.append(filepath)
+            continue
+        columns["Filename"].append(filepath)
+        for (tag, _, _), value in zip(plan, row[1:]):
+            columns[tag].append(value)
+    return columns, failed
+
+
+def _make_batches(filelist, max_workers, min_batch=16, max_batch=2048):
+    """
+    Split <filelist> into batches of files from the same (or adjacent)
+    directories. Batch sizes follow guided scheduling: each batch holds a
+    fraction of the files still unassigned, so batches shrink towards the
+    end of the run and a huge series directory is spread over all workers
+    instead of leaving cores idle while one worker finishes it.
+    """
+    filelist = sorted(filelist, key=lambda f: os.path.split(f))
+    batches = []
+    start = 0
+    while start < len(filelist):
+        remaining = len(filelist) - start
+        size = min(max_batch, max(min_batch, remaining // (4 * max_workers)))
+        batches.append(filelist[start:start + size])
+        start += size
+    return batches
+
+
+def _read_columns_parallel(filelist, list_of_tags, max_workers=4, tag_bounded=False, typed=False, io_threads=1,
+                           prefetch_bytes=65536):
+    """
+    Read <list_of_tags> from every file in <filelist> with a process pool,
+    one directory-grouped batch per task. With <typed>, workers convert the
+    values to plain Python before pickling them back. Each worker process
+    runs <io_threads> threads prefetching headers (see _read_dicom_batch).
+    Returns ({"Filename": [...], tag1: [...], ...}, [unreadable filepaths]).
+    """
+    plan = _compile_plan(list_of_tags)
+    tag_bound = _tag_bound(list_of_tags) if tag_bounded else None
+    kinds = _tag_kinds(list_of_tags) if typed else None
+    columns = {"Filename": []}
+    for tag in list_of_tags:
+        columns[tag] = []
+    failed = []
+    with instrumentation.stage("read"), _process_pool(max_workers) as executor:
+        # Submit jobs
+        futures = {
+            executor.submit(_timed_call, _read_dicom_batch, batch, plan, tag_bound, kinds, io_threads,
+                            prefetch_bytes): len(batch)
+            for batch in _make_batches(filelist, max_workers)
+        }
+
+        # Collect results with a progress bar
+        with tqdm(total=len(filelist)) as progress:
+            for future in as_completed(futures):
+                (batch_columns, batch_failed), pid, seconds, n_read = future.result()
+                for _col, values in batch_columns.items():
+                    columns[_col].extend(values)
+                failed.extend(batch_failed)
+                progress.update(futures[future])
+                instrumentation.worker(pid, futures[future], seconds)
+                instrumentation.count("files_parsed", futures[future] - len(batch_failed))
+                instrumentation.count("files_failed", len(batch_failed))
+                instrumentation.count("bytes_read", n_read)
+                for filepath in batch_failed:
+                    instrumentation.log(f"Unreadable by pydicom: {filepath}")
+    return columns, failed
+
+
+def _read_rows_parallel(filelist, list_of_tags, max_workers=4, tag_bounded=False, io_threads=1,
+                        prefetch_bytes=65536):
+    """
+    Read <list_of_tags> from every file in <filelist> with a process pool.
+    Returns a list aligned with filelist holding [filepath, tag1, tag2, ...]
+    rows, or None for the files that could not be read.
+    """
+    columns, _ = _read_columns_parallel(filelist, list_of_tags, max_workers, tag_bounded, io_threads=io_threads,
+                                        prefetch_bytes=prefetch_bytes)
+    rows = {}
+    for i, filepath in enumerate(columns["Filename"]):
+        rows[filepath] = [filepath] + [columns[tag][i] for tag in list_of_tags]
+    return [rows.get(filepath) for filepath in filelist]
+
+
+# Bookkeeping columns of the scan manifest. Every other column is a DICOM tag.
+_CACHE_KEY_COLUMNS = ["Filename", "_size", "_mtime_ns", "_inode", "_is_dicom"]
+
+
+def _load_scan_cache(cache_path):
+    if os.path.exists(cache_path):
+        return pd.read_pickle(cache_path)
+    return pd.DataFrame(columns=_CACHE_KEY_COLUMNS)
+
+
+def _atomic_to_pickle(df, path):
+    # Write to a temporary file first so a crash never leaves a truncated file
+    tmp_path = path + ".tmp"
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _incremental_read(file_stats, list_of_tags, cache_path, read_rows):
+    """
+    Read <list_of_tags> from the files of <file_stats>, reusing the values
+    stored in the scan manifest at <cache_path>.
+
+    The manifest is keyed by path, size, mtime and inode, taken from the
+    directory scan (files are not stat'ed again). New or modified
+    files are read for every tag kept in the manifest, unchanged files are
+    only read for the tags that were never extracted before, and files that
+    are unchanged and already complete are not opened at all. Files that are
+    no longer in <file_stats> are dropped from the manifest before saving it.
+
+    Parameters:
+        file_stats (list of tuple): (path, size, mtime_ns, inode) of the files
+            found in the folder being scanned (scan_dicom_files with
+            return_stats=True).
+        list_of_tags (list of str): DICOM tags requested for this run.
+        cache_path (str): path of the manifest (a pickled DataFrame).
+        read_rows (callable): read_rows(paths, tags) returns a list aligned
+            with paths of [filepath, tag1, ...] rows, or None for unreadable files.
+
+    Returns:
+        df (pd.DataFrame): Filename + list_of_tags for the DICOM files in file_stats.
+    """
+    manifest = _load_scan_cache(cache_path)
+    cached_tags = [c for c in manifest.columns if c not in _CACHE_KEY_COLUMNS]
+    new_tags = [t for t in list_of_tags if t not in cached_tags]
+    all_tags = cached_tags + new_tags
+
+    current = pd.DataFrame(file_stats, columns=["Filename", "_size", "_mtime_ns", "_inode"])
+
+    merged = current.merge(manifest, on="Filename", how="left", suffixes=("", "_cached"))
+    unchanged = (
+        (merged["_size"] == merged["_size_cached"])
+        & (merged["_mtime_ns"] == merged["_mtime_ns_cached"])
+        & (merged["_inode"] == merged["_inode_cached"])
+    )
+    merged = merged.drop(columns=["_size_cached", "_mtime_ns_cached", "_inode_cached"])
+
+    # New or modified files: read every tag the manifest keeps
+    stale = merged[~unchanged]
+    print(f"{len(stale)} new or modified files, {int(unchanged.sum())} unchanged.")
+    stale_rows = read_rows(list(stale["Filename"]), all_tags)
+    stale_table = stale[["Filename", "_size", "_mtime_ns", "_inode"]].reset_index(drop=True)
+    stale_table["_is_dicom"] = [row is not None for row in stale_rows]
+    for i, _tag in enumerate(all_tags):
+        stale_table[_tag] = [row[i + 1] if row is not None else "Not found" for row in stale_rows]
+
+    # Unchanged files: only read tags added since the last run
+    kept = merged[unchanged].reset_index(drop=True)
+    if new_tags and len(kept):
+        missing = kept[kept["_is_dicom"].astype(bool)]
+        print(f"Reading {len(new_tags)} new tags from {len(missing)} cached files.")
+        missing_rows = read_rows(list(missing["Filename"]), new_tags)
+        values = {_f: row[1:] for _f, row in zip(missing["Filename"], missing_rows) if row is not None}
+        for i, _tag in enumerate(new_tags):
+            kept[_tag] = [values[_f][i] if _f in values else "Not found" for _f in kept["Filename"]]
+        failed = set(missing["Filename"]) - set(values)
+        kept.loc[kept["Filename"].isin(failed), "_is_dicom"] = False
+
+    manifest = pd.concat([kept, stale_table], ignore_index=True)[_CACHE_KEY_COLUMNS + all_tags]
+    manifest = manifest.set_index("Filename").loc[current["Filename"]].reset_index()
+    _atomic_to_pickle(manifest, cache_path)
+
+    df = manifest[manifest["_is_dicom"].astype(bool)]
+    return df[["Filename"] + list_of_tags].reset_index(drop=True)
+
+
+def _is_dicomdir(path):
+    return os.path.basename(path).upper() == "DICOMDIR"
+
+
+# Instance attributes stored under other tags in the DICOMDIR instance records
+_DICOMDIR_REFERENCED_TAGS = {
+    0x00080018: 0x00041511,  # SOPInstanceUID: ReferencedSOPInstanceUIDInFile
+    0x00080016: 0x00041510,  # SOPClassUID: ReferencedSOPClassUIDInFile
+    0x00020010: 0x00041512,  # TransferSyntaxUID: ReferencedTransferSyntaxUIDInFile
+}
+
+
+def _dicomdir_records(ds):
+    """
+    Yield (file ID, records) for every directory record of the DICOMDIR
+    <ds> that references a file, where records lists that record and its
+    parents (series, study, patient), nearest first. Without a root offset
+    the records are taken one by one, without their parents.
+    """
+    records = {item.seq_item_tell: item for item in ds.DirectoryRecordSequence}
+    first = ds.get("OffsetOfTheFirstDirectoryRecordOfTheRootDirectoryEntity", 0)
+    if not first:
+        for record in records.values():
+            if "ReferencedFileID" in record:
+                yield record.ReferencedFileID, [record]
+        return
+
+    def walk(offset, parents):
+        seen = set()
+        while offset in records and offset not in seen:
+            seen.add(offset)
+            record = records[offset]
+            chain = [record] + parents
+            if "ReferencedFileID" in record:
+                yield record.ReferencedFileID, chain
+            yield from walk(record.get("OffsetOfReferencedLowerLevelDirectoryEntity", 0), chain)
+            offset = record.get("OffsetOfTheNextDirectoryRecord", 0)
+
+    yield from walk(first, [])
+
+
+def _dicomdir_instances(dicomdir_path, plan):
+    """
+    Yield (path, values) for every file referenced by the DICOMDIR at
+    <dicomdir_path>, with the values of <plan> taken from its directory
+    records (the instance record first, then its series, study and patient
+    records). SOPInstanceUID and SOPClassUID come from the Referenced ... in
+    File attributes of the instance record. Tags that no record holds, and
+    paths starting at a private tag, are "Not found". The referenced files
+    are not checked here (see _read_columns_with_dicomdirs).
+    """
+    ds = pydicom.dcmread(dicomdir_path, force=True)
+    root = os.path.dirname(dicomdir_path)
+    top_tags = {steps[0][0] for _, steps, _ in plan if steps and steps[0][1] is None}
+    for file_id, chain in _dicomdir_records(ds):
+        if isinstance(file_id, str):
+            file_id = [file_id]
+        values = Dataset()
+        for tag in top_tags:
+            for record in chain:
+                record_tag = _DICOMDIR_REFERENCED_TAGS.get(tag, tag) if record is chain[0] else tag
+                if record_tag in record:
+                    element = record[record_tag]
+                    values.add_new(tag, element.VR, element.value)
+                    break
+        yield os.path.join(root, *file_id), _apply_plan(values, plan)
+
+
+def _read_columns_with_dicomdirs(filelist, dicomdirs, listing, list_of_tags, read_columns, kinds=None):
+    """
+    Read <list_of_tags> from <filelist> using the DICOMDIR files among
+    <dicomdirs>: instances they reference are not opened when their
+    directory records hold every requested tag, and are opened for the
+    missing tags only otherwise. The references are checked in bulk against
+    <listing>, every file found in the folder: referenced files that are not
+    in it are reported and left out, files of <filelist> that no DICOMDIR
+    references are read as usual, and the DICOMDIR files used are left out
+    of the table. With <kinds>, values taken from the records are converted
+    as the workers convert theirs.
+
+    Parameters:
+        read_columns (callable): read_columns(paths, tags) returns
+            ({"Filename": [...], tag1: [...], ...}, [unreadable filepaths]),
+            like _read_columns_parallel.
+
+    Returns:
+        ({"Filename": [...], tag1: [...], ...}, [unreadable filepaths]).
+    """
+    plan = _compile_plan(list_of_tags)
+    to_read = set(filelist)
+    listed = {os.path.abspath(_f): _f for _f in listing}
+    listed_lower = {path.lower(): _f for path, _f in listed.items()}
+    rows = {}
+    pending = defaultdict(list)
+    missing_files = []
+    used = set()
+    for dicomdir in dicomdirs:
+        try:
+            instances = list(_dicomdir_instances(dicomdir, plan))
+        except Exception as e:
+            instrumentation.log(f"Unusable DICOMDIR {dicomdir} - {e}")
+            continue
+        used.add(dicomdir)
+        for path, values in instances:
+            path = os.path.abspath(path)
+            # File IDs are upper case, the copy on disk may not be
+            _f = listed.get(path) or listed_lower.get(path.lower())
+            if _f is None:
+                missing_files.append(path)
+                continue
+            if _f in rows or _f not in to_read:
+                continue
+            rows[_f] = values
+            missing = tuple(i for i, value in enumerate(values) if isinstance(value, str) and value == "Not found")
+            if missing:
+                pending[missing].append(_f)
+
+    rest = [_f for _f in filelist if _f not in rows and _f not in used]
+    columns, failed = read_columns(rest, list_of_tags)
+    n_opened = 0
+    for missing, paths in pending.items():
+        missing_columns, missing_failed = read_columns(paths, [list_of_tags[i] for i in missing])
+        n_opened += len(paths)
+        for j, _f in enumerate(missing_columns["Filename"]):
+            for i in missing:
+                rows[_f][i] = missing_columns[list_of_tags[i]][j]
+        for _f in missing_failed:
+            del rows[_f]
+        failed.extend(missing_failed)
+
+    for _f, values in rows.items():
+        columns["Filename"].append(_f)
+        for (tag, _, _), value in zip(plan, values):
+            if kinds is not None:
+                value = _convert_value(value, *kinds[tag])
+            columns[tag].append(value)
+    instrumentation.count("files_indexed", len(rows))
+    print(f"{len(used)} DICOMDIRs indexed {len(rows)} files ({n_opened} opened for missing tags), "
+          f"{len(rest)} files read without DICOMDIR.")
+    _report_skipped({"listed in a DICOMDIR but missing": missing_files})
+    return columns, failed
+
+
+def dcmtag2table_parallel(folder, list_of_tags, max_workers=4, cache_path=None, tag_bounded=False, typed=False,
+                          io_threads=1, prefetch_bytes=65536, shard=None, use_dicomdir=False):
     """
     Create a Pandas DataFrame with the <list_of_tags> DICOM tags
     from the DICOM files in <folder>, in parallel.
 
     Parameters:
         folder (str): folder to be recursively walked looking for DICOM files.
-        list_of_tags (list of str): list of DICOM tags with no whitespaces.
-        max_workers (int): number of parallel processes to use.
+        list_of_tags (list of str): DICOM keywords or tag paths (see
+            _compile_tag_path).
+        max_workers (int): number of parallel processes to use. Directories
+            are listed with scan_dicom_files.
+        cache_path (str, optional): scan manifest to reuse between runs. Only
+            new or modified files are read again, and only newly requested
+            tags are read from unchanged files.
+        tag_bounded (bool): parse only the requested tags and stop reading
+            each file after the highest one.
+        typed (bool): give each tag column a dtype driven by its VR, with
+            nulls instead of "Not found".
+        io_threads (int): I/O threads per worker process prefetching file
+            headers while the process parses. Raise it on high-latency
+            network storage (NFS/SMB); 1 disables prefetching.
+        prefetch_bytes (int): bytes prefetched per file. Headers longer than
+            this are read again from disk.
+        shard (tuple or str, optional): (i, N) or "i/N": read only the files
+            of shard i (0 <= i < N), chosen by a stable hash of their path
+            relative to <folder> (see shard_of). The partial tables of the N
+            shards are combined with merge_partial_tables.
+        use_dicomdir (bool): take the tags of the instances referenced by
+            the DICOMDIR files found in <folder> from their directory
+            records, opening an instance only for the tags its records lack
+            (see _read_columns_with_dicomdirs). The records are trusted: a
+            DICOMDIR that no longer matches its files gives stale values.
 
     Returns:
         df (pd.DataFrame): table of DICOM tags from the files in folder.
     """
     list_of_tags = list_of_tags.copy()
-    filelist = []
 
     print("Listing all files...")
     start = time.time()
-    for root, dirs, files in os.walk(folder):
-        for name in files:
-            filelist.append(os.path.join(root, name))
+    file_stats, skipped = scan_dicom_files(folder, return_stats=True)
+    filelist = [f[0] for f in file_stats]
+    _report_skipped(skipped)
+    if use_dicomdir and cache_path is not None:
+        raise ValueError("use_dicomdir does not support cache_path")
+    # Every shard indexes its own files with every DICOMDIR
+    listing = filelist
+    dicomdirs = [f for f in filelist if _is_dicomdir(f)] if use_dicomdir else []
+    if shard is not None:
+        shard_index, n_shards = _parse_shard(shard)
+        file_stats = [f for f in file_stats if shard_of(f[0], folder, n_shards) == shard_index]
+        filelist = [f[0] for f in file_stats]
+        print(f"Shard {shard_index}/{n_shards}: {len(filelist)} files.")
     print("Time for listing: {:.2f} seconds".format(time.time() - start))
 
     # Prepare for parallel processing
     print("Reading DICOM tags in parallel...")
     start_read = time.time()
 
-    rows = []
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        # Submit jobs
-        futures = {executor.submit(_read_dicom_tags, f, list_of_tags): f for f in filelist}
-
-        # Collect results with a progress bar
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            fpath = futures[future]
-            result = future.result()
-            if result is None:
-                # If reading failed, print a message (optional)
-                print(f"Skipping non-DICOM or unreadable: {fpath}")
-            else:
-                rows.append(result)
+    if cache_path is not None:
+        df = _incremental_read(file_stats, list_of_tags, cache_path,
+                               lambda paths, tags: _read_rows_parallel(paths, tags, max_workers, tag_bounded, io_threads,
+                                                                       prefetch_bytes))
+        print("Time for reading: {:.2f} seconds".format(time.time() - start_read))
+        if typed:
+            df = _apply_tag_dtypes(df, list_of_tags)
+        df = df.sort_values(by=['Filename'], ascending=True, ignore_index=True)
+        print("Finished.")
+        return df
+
+    def read_columns(paths, tags):
+        return _read_columns_parallel(paths, tags, max_workers, tag_bounded, typed, io_threads, prefetch_bytes)
+
+    if dicomdirs:
+        columns, failed = _read_columns_with_dicomdirs(filelist, dicomdirs, listing, list_of_tags, read_columns,
+                                                       _tag_kinds(list_of_tags) if typed else None)
+    else:
+        columns, failed = read_columns(filelist, list_of_tags)
+    _report_skipped({"unreadable by pydicom": failed})
 
     print("Time for reading: {:.2f} seconds".format(time.time() - start_read))
 
-    # Build the DataFrame
-    # Prepend "Filename" to the list_of_tags so it aligns with the row format
-    column_names = ["Filename"] + list_of_tags
-    df = pd.DataFrame(rows, columns=column_names)
-    df = df.sort_values(by=['Filename'], ascending=True)
+    # Build the DataFrame from the columns returned by the workers
+    df = pd.DataFrame(columns)
+    if typed:
+        df = _apply_tag_dtypes(df, list_of_tags, converted=True)
+    df = df.sort_values(by=['Filename'], ascending=True, ignore_index=True)
     print("Finished.")
     return df
 
-def replace_uids(df_in: pd.DataFrame, prefix = '1.2.840.1234.') -> pd.DataFrame:
+
+def _parse_shard(shard):
+    # "i/N" or (i, N) -> (i, N)
+    if isinstance(shard, str):
+        shard = shard.split("/")
+    shard_index, n_shards = (int(v) for v in shard)
+    if not 0 <= shard_index < n_shards:
+        raise ValueError(f"shard must be i/N with 0 <= i < N, got {shard_index}/{n_shards}")
+    return shard_index, n_shards
+
+
+def shard_of(path, folder, n_shards):
+    """
+    Return the shard (0 to n_shards - 1) of a file, from a hash of its path
+    relative to <folder>. The hash (blake2b) does not depend on the process
+    or on where each node mounts the folder, so every node agrees.
+    """
+    relative = os.path.relpath(path, folder).replace(os.sep, "/")
+    digest = hashlib.blake2b(relative.encode("utf-8", "surrogateescape"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % n_shards
+
+
+def _read_table(path):
+    # Input format from the file extension (see _write_table)
+    if path.endswith(".parquet") or os.path.isdir(path):
+        return pd.read_parquet(path)
+    if path.endswith((".pkl", ".pickle")):
+        return pd.read_pickle(path)
+    return pd.read_csv(path)
+
+
+def merge_partial_tables(paths, output=None):
+    """
+    Combine the partial tables written by the nodes of a sharded scan
+    (dcmtag2table_parallel(..., shard=...)) into the table a single-node
+    scan returns: rows sorted by Filename, with a fresh index.
+
+    Parameters:
+        paths (list of str or DataFrame): partial tables, as DataFrames or
+            files (.parquet, .pkl or .csv; pickle and Parquet keep the
+            value types of the scan, CSV turns them into text).
+        output (str, optional): also write the merged table here
+            (.parquet, .pkl or .csv).
+
+    Returns:
+        df (pd.DataFrame): the merged table.
+    """
+    frames = [p if isinstance(p, pd.DataFrame) else _read_table(p) for p in paths]
+    df = pd.concat(frames, ignore_index=True)
+    if df['Filename'].duplicated().any():
+        raise ValueError("partial tables overlap: the same file appears in more than one shard")
+    # Categories differ between shards, so concat falls back to plain strings
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype("category")
+    df = df.sort_values(by=['Filename'], ascending=True, ignore_index=True)
+    if output is not None:
+        _write_table(df, output)
+    return df
+
+
+def _evenly_spaced(n, k):
+    # k indices spread over range(n), always including the first one
+    if k >= n:
+        return list(range(n))
+    if k <= 1:
+        return [0] if k == 1 else []
+    return sorted({(i * (n - 1)) // (k - 1) for i in range(k)})
+
+
+def _series_directory(directory, files, series_plan, tag_bound, uid_plan, uid_bound, samples, verify):
+    """
+    Read the series of one directory: <samples> representative files with
+    every tag of <series_plan> (whose last entry is SeriesInstanceUID), and
+    <verify> other files with the SeriesInstanceUID only. If any of them
+    cannot be read or they disagree on the SeriesInstanceUID, every file
+    of the directory is read instead.
+    Returns (rows, n_parsed, n_failed) with one
+    (directory, filename, uid, values, n_files, sampled) row per series.
+    """
+    if len(files) > samples + verify:
+        rep_index = _evenly_spaced(len(files), samples)
+        chosen = set(rep_index)
+        rest = [i for i in range(len(files)) if i not in chosen]
+        verify_files = [files[rest[i]] for i in _evenly_spaced(len(rest), verify)]
+        reps = [_read_dicom_tags(files[i], series_plan, tag_bound) for i in rep_index]
+        checks = [_read_dicom_tags(_f, uid_plan, uid_bound) for _f in verify_files]
+        uids = {row[-1] for row in reps + checks if row is not None}
+        if None not in reps and None not in checks and len(uids) == 1 and "Not found" not in uids:
+            row = reps[0]
+            return [(directory, row[0], row[-1], row[1:-1], len(files), True)], len(reps) + len(checks), 0
+
+    series = {}
+    n_failed = 0
+    for _f in files:
+        row = _read_dicom_tags(_f, series_plan, tag_bound)
+        if row is None:
+            n_failed += 1
+            continue
+        if row[-1] in series:
+            series[row[-1]][4] += 1
+        else:
+            series[row[-1]] = [directory, row[0], row[-1], row[1:-1], 1, False]
+    return [tuple(row) for row in series.values()], len(files), n_failed
+
+
+def _series_batch(directories, series_plan, tag_bound, uid_plan, uid_bound, samples, verify):
+    # _series_directory over a list of (directory, files); returns the summed results
+    rows, n_parsed, n_failed = [], 0, 0
+    for directory, files in directories:
+        dir_rows, dir_parsed, dir_failed = _series_directory(
+            directory, files, series_plan, tag_bound, uid_plan, uid_bound, samples, verify)
+        rows.extend(dir_rows)
+        n_parsed += dir_parsed
+        n_failed += dir_failed
+    return rows, n_parsed, n_failed
+
+
+def dcmtag2table_series(folder, list_of_tags, max_workers=4, samples=1, verify=4, tag_bounded=False, typed=False):
+    """
+    Create a series-level table of the <list_of_tags> DICOM tags from the
+    DICOM files in <folder>, for tags that are constant within a series
+    (Modality, SliceThickness, ConvolutionKernel, Manufacturer...).
+
+    Each directory is assumed to hold one series: the tags are read from
+    <samples> representative files, and <verify> other files spread over
+    the directory are checked (SeriesInstanceUID only) to confirm they
+    belong to the same series. Directories where the check fails, and
+    directories with at most samples + verify files, are read in full and
+    give one row per series found. A series spread over several
+    directories is reported once, with the files of all of them counted.
+
+    Parameters:
+        folder (str): folder to be recursively walked looking for DICOM files.
+        list_of_tags (list of str): DICOM keywords or tag paths (see
+            _compile_tag_path).
+        max_workers (int): number of parallel processes to use.
+        samples (int): representative files read per directory.
+        verify (int): other files per directory checked for the same series.
+        tag_bounded (bool): parse only the requested tags and stop reading
+            each file after the highest one.
+        typed (bool): give each tag column a dtype driven by its VR, with
+            nulls instead of "Not found".
+
+    Returns:
+        df (pd.DataFrame): one row per series with SeriesInstanceUID, the
+            Directory and Filename the tags were read from, the number of
+            Files, whether the row was Sampled (False when the directory
+            was read in full) and the tag columns, sorted by Directory.
+    """
+    if samples < 1:
+        raise ValueError("samples must be at least 1")
+    list_of_tags = list_of_tags.copy()
+    series_tags = list_of_tags + ["SeriesInstanceUID"]
+    series_plan = _compile_plan(series_tags)
+    tag_bound = _tag_bound(series_tags) if tag_bounded else None
+    uid_plan = _compile_plan(["SeriesInstanceUID"])
+    uid_bound = _tag_bound(["SeriesInstanceUID"])
+
+    print("Listing all files...")
+    filelist, skipped = scan_dicom_files(folder)
+    _report_skipped(skipped)
+    by_directory = defaultdict(list)
+    for _f in filelist:
+        by_directory[os.path.dirname(_f)].append(_f)
+    directories = sorted(by_directory.items())
+
+    size = max(1, min(64, len(directories) // (4 * max_workers)))
+    rows = []
+    n_parsed = 0
+    with instrumentation.stage("read"), _process_pool(max_workers) as executor, \
+            tqdm(total=len(filelist), desc="Reading series") as progress:
+        futures = [
+            executor.submit(_timed_call, _series_batch, directories[i:i + size], series_plan, tag_bound, uid_plan,
+                            uid_bound, samples, verify)
+            for i in range(0, len(directories), size)
+        ]
+        for future in as_completed(futures):
+            (batch_rows, batch_parsed, batch_failed), pid, seconds, n_read = future.result()
+            for directory, filename, uid, values, n_files, sampled in batch_rows:
+                row = {"Directory": directory, "Filename": filename, "SeriesInstanceUID": uid,
+                       "Files": n_files, "Sampled": sampled}
+                row.update(zip(list_of_tags, values))
+                rows.append(row)
+            n_parsed += batch_parsed
+            progress.update(sum(row[4] for row in batch_rows) + batch_failed)
+            instrumentation.worker(pid, batch_parsed, seconds)
+            instrumentation.count("files_parsed", batch_parsed - batch_failed)
+            instrumentation.count("files_failed", batch_failed)
+            instrumentation.count("bytes_read", n_read)
+
+    columns = ["Directory", "Filename", "SeriesInstanceUID", "Files", "Sampled"]
+    columns += [tag for tag in list_of_tags if tag not in columns]
+    df = pd.DataFrame(rows, columns=columns).sort_values(by=["Directory", "Filename"], ignore_index=True)
+
+    # Files without a SeriesInstanceUID are only grouped within their directory
+    uid = df["SeriesInstanceUID"].astype(str)
+    key = uid.where(uid != "Not found", "Not found\0" + df["Directory"])
+    agg = {column: "first" for column in columns}
+    agg["Files"] = "sum"
+    agg["Sampled"] = "all"
+    df = df.groupby(key.values, sort=False).agg(agg).reset_index(drop=True)
+
+    print(f"Parsed {n_parsed} headers for {len(filelist)} files in {len(df)} series.")
+    if typed:
+        df = _apply_tag_dtypes(df, list_of_tags)
+    return df
+
+def _iter_files(folder):
+    """
+    Lazily yield the path of every file under <folder>.
+    """
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            yield os.path.join(root, name)
+
+
+# Groups that can plausibly start a DICOM data set written without preamble
+_FIRST_GROUPS = {0x0000, 0x0002, 0x0008, 0x0010, 0x0018, 0x0020}
+
+_VALID_VRS = {
+    b"AE", b"AS", b"AT", b"CS", b"DA", b"DS", b"DT", b"FD", b"FL", b"IS", b"LO", b"LT", b"OB", b"OD",
+    b"OF", b"OL", b"OV", b"OW", b"PN", b"SH", b"SL", b"SQ", b"SS", b"ST", b"SV", b"TM", b"UC", b"UI",
+    b"UL", b"UN", b"UR", b"US", b"UT", b"UV",
+}
+
+
+def _dicom_skip_reason(filepath, size=None):
+    """
+    Cheap check of the first bytes of a file before handing it to pydicom.
+    Accepts files with the 128-byte preamble and the "DICM" magic, and files
+    without preamble whose first element has a plausible group number and
+    either an explicit VR or a plausible implicit VR length.
+    Returns None for plausible DICOM files, or the reason to skip the file.
+    """
+    try:
+        if size is None:
+            size = os.path.getsize(filepath)
+        if size == 0:
+            return "empty file"
+        with open(filepath, "rb") as fp:
+            head = fp.read(132)
+    except OSError:
+        return "unreadable file"
+
+    if len(head) == 132 and head[128:132] == b"DICM":
+        return None
+    if len(head) < 8:
+        return "too small for DICOM"
+    group, element = struct.unpack("<HH", head[:4])
+    if group not in _FIRST_GROUPS:
+        # Explicit VR Big Endian without preamble
+        if struct.unpack(">H", head[:2])[0] in _FIRST_GROUPS and head[4:6] in _VALID_VRS:
+            return None
+        return "no DICM magic or plausible first tag"
+    if head[4:6] in _VALID_VRS:
+        return None
+    length = struct.unpack("<I", head[4:8])[0]
+    if length == 0xFFFFFFFF or length <= size - 8:
+        return None
+    return "no DICM magic or plausible first tag"
+
+
+def _scan_directory(directory, check_header):
+    """
+    List one directory with os.scandir.
+    Returns (files, subdirectories, skipped) where files holds
+    (path, size, mtime_ns, inode) tuples and skipped (path, reason) pairs.
+    """
+    files = []
+    subdirs = []
+    skipped = []
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return files, subdirs, [(directory, "unreadable directory")]
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+                continue
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+        except OSError:
+            skipped.append((entry.path, "unreadable file"))
+            continue
+        reason = _dicom_skip_reason(entry.path, st.st_size) if check_header else None
+        if reason is None:
+            files.append((entry.path, st.st_size, st.st_mtime_ns, st.st_ino))
+        else:
+            skipped.append((entry.path, reason))
+    return files, subdirs, skipped
+
+
+def scan_dicom_files(folder, max_threads=8, check_header=True, return_stats=False):
+    """
+    List the files under <folder>, walking subtrees concurrently with a
+    thread pool (useful on NFS/SMB mounts, where each directory listing and
+    header peek is a network round trip).
+
+    Parameters:
+        folder (str): folder to be recursively walked looking for DICOM files.
+        max_threads (int): number of directories listed concurrently.
+        check_header (bool): skip files that fail the cheap DICOM header check
+            (see _dicom_skip_reason) instead of returning them.
+        return_stats (bool): return (path, size, mtime_ns, inode) tuples taken
+            from the same scandir call instead of bare paths.
+
+    Returns:
+        files (list): sorted paths (or stat tuples) of the files found.
+        skipped (dict): reason -> list of paths of the skipped files.
+    """
+    files = []
+    skipped = defaultdict(list)
+    with instrumentation.stage("list"), ThreadPoolExecutor(max_workers=max_threads) as executor:
+        pending = {executor.submit(_scan_directory, folder, check_header)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_files, subdirs, dir_skipped = future.result()
+                files.extend(dir_files)
+                for path, reason in dir_skipped:
+                    skipped[reason].append(path)
+                for subdir in subdirs:
+                    pending.add(executor.submit(_scan_directory, subdir, check_header))
+    instrumentation.count("files_listed", len(files))
+    instrumentation.count("files_skipped", sum(len(paths) for paths in skipped.values()))
+    instrumentation.count("bytes_listed", sum(f[1] for f in files))
+    files.sort()
+    if not return_stats:
+        files = [f[0] for f in files]
+    return files, skipped
+
+
+def _report_skipped(skipped):
+    """
+    Print one summary line per skip reason instead of one line per file.
+    """
+    for reason, paths in sorted(skipped.items()):
+        if paths:
+            print(f"Skipped {len(paths)} files ({reason}), e.g. {paths[0]}")
+
+
+def _rows_to_frame(rows, list_of_tags):
+    """
+    Build a DataFrame from [filepath, tag1, ...] rows, one column at a time,
+    so no transposed copy of the whole chunk is ever held in memory.
+    """
+    columns = {"Filename": [row[0] for row in rows]}
+    for i, _tag in enumerate(list_of_tags):
+        columns[_tag] = [row[i + 1] for row in rows]
+    return pd.DataFrame(columns)
+
+
+def _arrow_type(kind, multi):
+    import pyarrow as pa
+
+    if kind == "float":
+        item = pa.float64()
+    elif kind == "int":
+        item = pa.int64()
+    elif kind == "category" and not multi:
+        return pa.dictionary(pa.int32(), pa.string())
+    else:
+        item = pa.string()
+    return pa.list_(item) if multi else item
+
+
+def _arrow_string(value):
+    if value is None or (isinstance(value, str) and value == "Not found"):
+        return None
+    return str(value)
+
+
+def _frame_to_arrow(df, typed=False):
+    """
+    Convert a chunk to a pyarrow Table with a fixed schema, so every chunk
+    of a run can be appended to the same Parquet dataset. Without <typed>
+    every column is a string; with it, the schema follows _tag_kinds
+    (numbers, dictionary-encoded codes and UIDs, lists). Missing tags
+    become nulls.
+    """
+    import pyarrow as pa
+
+    kinds = _tag_kinds(list(df.columns[1:])) if typed else {}
+    arrays = []
+    for _col in df.columns:
+        kind, multi = kinds.get(_col, ("object", False))
+        if kind == "object":
+            # Untyped, unknown and private tags: the text of the value
+            arrays.append(pa.array([_arrow_string(v) for v in df[_col]], type=pa.string()))
+            continue
+        values = [_convert_value(v, kind, multi) for v in df[_col]]
+        arrow_type = _arrow_type(kind, multi)
+        if pa.types.is_dictionary(arrow_type):
+            arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type=arrow_type))
+    return pa.Table.from_arrays(arrays, names=list(df.columns))
+
+
+def iter_dcmtag2table(folder, list_of_tags, chunk_rows=10000, max_workers=1, as_arrow=False, tag_bounded=False,
+                      typed=False):
+    """
+    Generator version of dcmtag2table. Yields the table in chunks of at most
+    <chunk_rows> DICOM files, so peak memory is bounded by the chunk size
+    and not by the number of files in <folder>.
+
+    Parameters:
+        folder (str): folder to be recursively walked looking for DICOM files.
+        list_of_tags (list of str): list of DICOM tags with no whitespaces.
+        chunk_rows (int): number of files read per chunk.
+        max_workers (int): number of parallel processes used to read each chunk.
+            With 1 the files are read in the calling process.
+        as_arrow (bool): yield pyarrow Tables instead of DataFrames.
+        tag_bounded (bool): parse only the requested tags and stop reading
+            each file after the highest one.
+        typed (bool): VR-driven column dtypes (see _apply_tag_dtypes) and,
+            with as_arrow, a typed Arrow schema.
+
+    Yields:
+        df (pd.DataFrame or pyarrow.Table): one chunk of the table.
+    """
+    list_of_tags = list_of_tags.copy()
+    plan = _compile_plan(list_of_tags)
+    tag_bound = _tag_bound(list_of_tags) if tag_bounded else None
+    kinds = _tag_kinds(list_of_tags) if typed else None
+
+    def read_chunk(paths):
+        if max_workers > 1:
+            n = len(paths)
+            return executor.map(_read_dicom_tags, paths, [plan] * n, [tag_bound] * n, [kinds] * n,
+                                chunksize=max(1, n // (4 * max_workers)))
+        return (_read_dicom_tags(_f, plan, tag_bound, kinds) for _f in paths)
+
+    def make_chunk(paths):
+        rows = [row for row in read_chunk(paths) if row is not None]
+        df = _rows_to_frame(rows, list_of_tags)
+        if as_arrow:
+            return _frame_to_arrow(df, typed)
+        return _apply_tag_dtypes(df, list_of_tags, converted=True) if typed else df
+
+    if max_workers <= 1:
+        executor = None
+    elif _shared_pool is not None:
+        executor = _shared_pool
+    else:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        paths = []
+        for _f in _iter_files(folder):
+            if _dicom_skip_reason(_f) is not None:
+                continue
+            paths.append(_f)
+            if len(paths) == chunk_rows:
+                yield make_chunk(paths)
+                paths = []
+        if paths:
+            yield make_chunk(paths)
+    finally:
+        if executor is not None and executor is not _shared_pool:
+            executor.shutdown()
+
+
+def dcmtag2table_to_parquet(folder, list_of_tags, output_dir, chunk_rows=10000, max_workers=1, partition_cols=None,
+                            tag_bounded=False, typed=False):
+    """
+    Stream the table of <list_of_tags> from the DICOM files in <folder>
+    straight to a Parquet dataset in <output_dir>, one file per chunk.
+    Requires pyarrow.
+
+    Parameters:
+        folder (str): folder to be recursively walked looking for DICOM files.
+        list_of_tags (list of str): list of DICOM tags with no whitespaces.
+        output_dir (str): directory of the Parquet dataset.
+        chunk_rows (int): number of files read (and rows written) per chunk.
+        max_workers (int): number of parallel processes used to read each chunk.
+        partition_cols (list of str, optional): columns used for Hive-style
+            partitioning, e.g. ["Modality"].
+        tag_bounded (bool): parse only the requested tags and stop reading
+            each file after the highest one.
+        typed (bool): write a VR-typed schema instead of all-string columns.
+
+    Returns:
+        n_rows (int): number of rows written.
+    """
+    import pyarrow.parquet as pq
+
+    os.makedirs(output_dir, exist_ok=True)
+    n_rows = 0
+    chunks = iter_dcmtag2table(folder, list_of_tags, chunk_rows=chunk_rows, max_workers=max_workers, as_arrow=True,
+                               tag_bounded=tag_bounded, typed=typed)
+    for i, table in enumerate(tqdm(chunks, desc="Writing chunks")):
+        if partition_cols:
+            pq.write_to_dataset(table, output_dir, partition_cols=partition_cols,
+                                basename_template=f"part-{i:05d}-{{i}}.parquet")
+        else:
+            pq.write_table(table, os.path.join(output_dir, f"part-{i:05d}.parquet"))
+        n_rows += table.num_rows
+    print(f"Wrote {n_rows} rows to {output_dir}")
+    return n_rows
+
+class _CountingFile(io.FileIO):
+    """
+    Unbuffered file that counts the bytes actually requested by the reader.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def benchmark_header_read(file_paths, list_of_tags, repeats=3):
+    """
+    Compare the full header read (stop_before_pixels) with the tag-bounded
+    read on <file_paths>.
+
+    Parameters:
+        file_paths (list of str): DICOM files to read.
+        list_of_tags (list of str): list of DICOM tags with no whitespaces.
+        repeats (int): timing passes per mode; the fastest one is reported.
+
+    Returns:
+        df (pd.DataFrame): one row per mode with the mean bytes read and the
+            mean time per file in milliseconds.
+    """
+    file_paths = list(file_paths)
+    plan = _compile_plan(list_of_tags)
+    modes = {"full": None, "tag_bounded": _tag_bound(list_of_tags)}
+    results = []
+    for mode, tag_bound in modes.items():
+        bytes_read = 0
+        n_files = 0
+        for _f in file_paths:
+            with _CountingFile(_f, "rb") as fp:
+                try:
+                    _dcmread_header(fp, tag_bound)
+                except Exception:
+                    continue
+                bytes_read += fp.bytes_read
+                n_files += 1
+
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for _f in file_paths:
+                _read_dicom_tags(_f, plan, tag_bound)
+            best = min(best, time.perf_counter() - start)
+
+        results.append({
+            "Mode": mode,
+            "Files": n_files,
+            "Mean bytes read": bytes_read / max(n_files, 1),
+            "Mean ms per file": 1000 * best / max(len(file_paths), 1),
+        })
+    return pd.DataFrame(results)
+
+
+class PseudonymStore:
+    """
+    Disk-backed (SQLite) mapping of original values to pseudonyms, shared by
+    every batch pseudonymized with it. Each mapping belongs to a kind
+    (e.g. "PatientID", "Study", "SOPInstanceUID"); (kind, original) is the
+    primary key, so lookups stay indexed with millions of stored entries.
+    Numeric pseudonyms continue from a per-kind counter, which replaces
+    carrying start_pct/start_study between runs by hand.
+
+    Parameters:
+        path (str): SQLite database file, created if needed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS mapping ("
+            "kind TEXT NOT NULL, original TEXT NOT NULL, pseudonym TEXT NOT NULL, "
+            "PRIMARY KEY (kind, original)) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS counters (kind TEXT PRIMARY KEY, next INTEGER NOT NULL)")
+        self.conn.commit()
+        self._locked = False
+
+    @contextmanager
+    def transaction(self):
+        """
+        Hold the database write lock (BEGIN IMMEDIATE) for the whole block,
+        so processes sharing the store never assign the same number twice or
+        race between lookup and insert. Nested blocks join the outer one.
+        """
+        if self._locked:
+            yield
+            return
+        if self.conn.in_transaction:
+            self.conn.commit()
+        self.conn.execute("BEGIN IMMEDIATE")
+        self._locked = True
+        try:
+            yield
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            self._locked = False
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def lookup(self, kind, values):
+        """
+        Return {original: pseudonym} for the <values> already stored under <kind>.
+        """
+        values = {str(v) for v in values}
+        cur = self.conn.cursor()
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_values (original TEXT PRIMARY KEY)")
+        cur.execute("DELETE FROM lookup_values")
+        cur.executemany("INSERT INTO lookup_values VALUES (?)", ((v,) for v in values))
+        cur.execute(
+            "SELECT m.original, m.pseudonym FROM lookup_values l "
+            "JOIN mapping m ON m.kind = ? AND m.original = l.original",
+            (kind,),
+        )
+        return dict(cur.fetchall())
+
+    def next_number(self, kind, start=1):
+        """
+        Return the next free number of <kind>, or <start> if none was assigned yet.
+        """
+        row = self.conn.execute("SELECT next FROM counters WHERE kind = ?", (kind,)).fetchone()
+        return max(row[0], start) if row else start
+
+    def _assign(self, kind, values, make_pseudonym):
+        with self.transaction():
+            mapping = self.lookup(kind, values)
+            new = [v for v in dict.fromkeys(str(v) for v in values) if v not in mapping]
+            if new:
+                pairs = [(kind, v, make_pseudonym(v)) for v in new]
+                self.conn.executemany("INSERT INTO mapping VALUES (?, ?, ?)", pairs)
+                mapping.update((v, p) for _, v, p in pairs)
+        return mapping
+
+    def assign_numbers(self, kind, values, start=1):
+        """
+        Return {original: number} for <values>, reusing stored numbers and
+        giving consecutive new numbers to the values never seen before.
+        """
+        with self.transaction():
+            counter = [self.next_number(kind, start)]
+
+            def make_number(_):
+                counter[0] += 1
+                return str(counter[0] - 1)
+
+            mapping = self._assign(kind, values, make_number)
+            self.conn.execute(
+                "INSERT INTO counters VALUES (?, ?) ON CONFLICT(kind) DO UPDATE SET next = excluded.next",
+                (kind, counter[0]),
+            )
+        return {k: int(v) for k, v in mapping.items()}
+
+    def assign_uids(self, kind, values, prefix):
+        """
+        Return {original: UID} for <values>, reusing stored UIDs and
+        generating new ones under <prefix> for the values never seen before.
+        """
+        return self._assign(kind, values, lambda _: pydicom.uid.generate_uid(prefix=prefix))
+
+
+@contextmanager
+def _open_store(store):
+    """
+    Accept a PseudonymStore or the path of one. A store opened here from a
+    path is closed on exit; a PseudonymStore passed in is left open.
+    """
+    if isinstance(store, PseudonymStore):
+        yield store
+    else:
+        with PseudonymStore(store) as opened:
+            yield opened
+
+
+def _hmac_int(value, key):
+    if isinstance(key, str):
+        key = key.encode()
+    return int.from_bytes(hmac.new(key, str(value).encode(), hashlib.sha256).digest(), "big")
+
+
+# Digest digits an HMAC UID keeps at least (about 100 bits)
+_HMAC_UID_MIN_DIGITS = 30
+
+_UID_PREFIX = re.compile(r"(?:(?:0|[1-9][0-9]*)\.)+")
+
+
+def _check_uid_prefix(prefix):
+    """
+    Raise ValueError unless <prefix> is a UID root ending in "." (digits and
+    dots, no leading zeros) that leaves _HMAC_UID_MIN_DIGITS digest digits
+    within the 64 characters of a UID.
+    """
+    if not isinstance(prefix, str) or not _UID_PREFIX.fullmatch(prefix):
+        raise ValueError(f"UID prefix {prefix!r} must be digits and dots ending in '.', e.g. '1.2.840.1234.'")
+    if len(prefix) > 64 - _HMAC_UID_MIN_DIGITS:
+        raise ValueError(f"UID prefix {prefix!r} is {len(prefix)} characters long; at most "
+                         f"{64 - _HMAC_UID_MIN_DIGITS} leave the {_HMAC_UID_MIN_DIGITS} digest digits "
+                         f"that keep HMAC UIDs from colliding")
+
+
+def _hmac_uid(value, key, prefix):
+    return (prefix + str(_hmac_int(value, key)))[:64]
+
+
+def hmac_uid(value, key, prefix='1.2.840.1234.'):
+    """
+    Deterministic UID for <value>: <prefix> followed by the decimal digits of
+    HMAC-SHA256(<key>, value), truncated to the 64 characters allowed for a
+    UID. Every worker or machine using the same key and prefix derives the
+    same UID for the same value without any coordination, and the mapping
+    cannot be reversed without the key. <prefix> must leave room for
+    _HMAC_UID_MIN_DIGITS digest digits (at most 34 characters), otherwise
+    ValueError is raised.
+    """
+    _check_uid_prefix(prefix)
+    return _hmac_uid(value, key, prefix)
+
+
+def hmac_id(value, key, kind, digits=16):
+    """
+    Deterministic numeric ID (at most <digits> digits) for <value>. <kind>
+    (e.g. "PatientID", "Study") separates the ID spaces, so the same value
+    gets unrelated IDs in different kinds. 16 digits fit StudyID and
+    AccessionNumber (SH) and keep collisions negligible for millions of values.
+    """
+    return _hmac_int(f"{kind}\x00{value}", key) % (10 ** digits)
+
+
+def _map_unique(series, make_pseudonym):
+    """
+    Vectorized mapping of a column: <make_pseudonym> is called once per
+    unique value (in order of first appearance) and the result is spread to
+    every row through the factorized codes, in O(rows + uniques).
+    """
+    codes, uniques = pd.factorize(series, use_na_sentinel=False)
+    pseudonyms = np.empty(len(uniques), dtype=object)
+    for i, value in enumerate(uniques):
+        pseudonyms[i] = make_pseudonym(value)
+    return pd.Series(pseudonyms[codes], index=series.index)
+
+
+def hmac_uids(series, key, prefix='1.2.840.1234.'):
+    """
+    Map a whole column of UIDs with hmac_uid.
+    """
+    _check_uid_prefix(prefix)
+    return _map_unique(series, lambda value: _hmac_uid(value, key, prefix))
+
+
+def hmac_ids(series, key, kind, digits=16):
+    """
+    Map a whole column of identifiers with hmac_id.
+    """
+    return _map_unique(series, lambda value: hmac_id(value, key, kind, digits))
+
+
+def _uid_generator(prefix, key=None):
+    """
+    Random UIDs (pydicom.uid.generate_uid) without a key, HMAC UIDs with one.
+    """
+    if key is None:
+        return lambda value: pydicom.uid.generate_uid(prefix=prefix)
+    _check_uid_prefix(prefix)
+    return lambda value: _hmac_uid(value, key, prefix)
+
+
+@_staged("replace_ids")
+def replace_uids(df_in: pd.DataFrame, prefix = '1.2.840.1234.', key=None) -> pd.DataFrame:
     """
     # Maps the StudyInstanceUID, SeriesInstanceUID, and SOPInstanceUID
     # in a Pandas DataFrame with newly generated UIDs taking into account the 
@@ -307,6 +2071,8 @@ def replace_uids(df_in: pd.DataFrame, prefix = '1.2.840.1234.') -> pd.DataFrame:
     # Parameters:
     #    df_in (Pandas DataFrame): DataFrame containing the three columns of UIDs
     #    prefix (str): string containing your particular prefix.
+    #    key (str or bytes, optional): secret key for deterministic UIDs (see
+    #        hmac_uid). Without it, UIDs are random.
 
     # Returns:
     #    df (DataFrame): with three new columns containing the new UIDs
@@ -320,13 +2086,12 @@ def replace_uids(df_in: pd.DataFrame, prefix = '1.2.840.1234.') -> pd.DataFrame:
         print("Reassigning " + _tag)
         if _tag not in df.columns:
             raise Exception('Tags StudyInstanceUID, SeriesInstanceUID, and SOPInstanceUID must be columns of the DataFrame')
-        time.sleep(0.2)
-        for _UID in tqdm(df[_tag].unique()):
-            df.loc[df[_tag] == _UID, "fake" + _tag] = pydicom.uid.generate_uid(prefix=prefix)
+        df["fake" + _tag] = _map_unique(df[_tag], _uid_generator(prefix, key))
     print("Time: " + str(time.time() - start))
     return df
 
-def replace_uids_parallel_joblib(df_in: pd.DataFrame, prefix='1.2.840.1234.', n_jobs=-1) -> pd.DataFrame:
+@_staged("replace_ids")
+def replace_uids_parallel_joblib(df_in: pd.DataFrame, prefix='1.2.840.1234.', n_jobs=-1, key=None) -> pd.DataFrame:
     """
     Parallel method using joblib to map the UID columns in a DataFrame.
     New columns with "fake" prefix are created.
@@ -335,6 +2100,8 @@ def replace_uids_parallel_joblib(df_in: pd.DataFrame, prefix='1.2.840.1234.', n_
         df_in (pd.DataFrame): DataFrame with the UIDs
         prefix (str): prefix for generating new UIDs
         n_jobs (int): number of parallel jobs (-1 = all cores)
+        key (str or bytes, optional): secret key for deterministic UIDs, so
+            disjoint shards pseudonymized separately agree on every UID.
 
     Returns:
         df (pd.DataFrame)
@@ -355,11 +2122,13 @@ def replace_uids_parallel_joblib(df_in: pd.DataFrame, prefix='1.2.840.1234.', n_
         """Generate the mapping dict for a single column."""
         unique_vals = df[tag].unique()
         # tqdm here if you'd like to monitor progress
-        mapping = {val: pydicom.uid.generate_uid(prefix=prefix) for val in unique_vals}
+        make_uid = _uid_generator(prefix, key)
+        mapping = {val: make_uid(val) for val in unique_vals}
         return tag, mapping
 
     # Generate mapping dicts in parallel
-    results = Parallel(n_jobs=n_jobs)(
+    # Inside worker_pool() the three maps run on threads instead of a second process pool
+    results = Parallel(n_jobs=n_jobs, prefer="threads" if _shared_pool is not None else None)(
         delayed(make_mapping)(tag) for tag in tqdm(list_of_tags, desc="Generating UID maps")
     )
     
@@ -372,7 +2141,8 @@ def replace_uids_parallel_joblib(df_in: pd.DataFrame, prefix='1.2.840.1234.', n_
     print("Time: {:.2f} seconds".format(time.time() - start))
     return df
     
-def replace_ids(df_in: pd.DataFrame, prefix: str, start_pct=1, start_study=1) -> pd.DataFrame:
+@_staged("replace_ids")
+def replace_ids(df_in: pd.DataFrame, prefix: str, start_pct=1, start_study=1, key=None) -> pd.DataFrame:
     """
     # Maps the PatientID, StudyID
     # in a Pandas DataFrame with newly generated IDs taking into account the 
@@ -382,6 +2152,9 @@ def replace_ids(df_in: pd.DataFrame, prefix: str, start_pct=1, start_study=1) ->
     # Parameters:
     #    df_in (Pandas DataFrame): DataFrame containing the three columns of UIDs
     #    prefix (str): string containing your particular prefix.
+    #    key (str or bytes, optional): secret key for deterministic UIDs and
+    #        IDs (see hmac_uid and hmac_id) instead of random UIDs and
+    #        counters starting at start_pct/start_study.
 
     # Returns:
     #    df (DataFrame): with three new columns containing the new UIDs
@@ -395,9 +2168,7 @@ def replace_ids(df_in: pd.DataFrame, prefix: str, start_pct=1, start_study=1) ->
         print("Reassigning " + _tag)
         if _tag not in df.columns:
             raise Exception('Tags StudyInstanceUID, SeriesInstanceUID, and SOPInstanceUID must be columns of the DataFrame')
-        time.sleep(0.2)
-        for _UID in tqdm(df[_tag].unique()):
-            df.loc[df[_tag] == _UID, "fake_" + _tag] = pydicom.uid.generate_uid(prefix=prefix)
+        df["fake_" + _tag] = _map_unique(df[_tag], _uid_generator(prefix, key))
 
     list_of_tags = ["PatientID", "StudyID", "AccessionNumber" ]
 
@@ -405,19 +2176,23 @@ def replace_ids(df_in: pd.DataFrame, prefix: str, start_pct=1, start_study=1) ->
         print("Reassigning " + _tag)
         if _tag not in df.columns:
             raise Exception('Tags PatientID, StudyID, AccessionNumber must be columns of the DataFrame')
-        time.sleep(0.2)
         
+        if key is not None:
+            if _tag == "PatientID":
+                df["fake_" + _tag] = hmac_ids(df[_tag], key, "PatientID")
+            else:
+                df["fake_" + _tag] = hmac_ids(df["StudyInstanceUID"], key, "Study")
+            continue
+
+        # Consecutive numbers in order of first appearance
         if _tag == "PatientID":
+            codes, uniques = pd.factorize(df[_tag], use_na_sentinel=False)
             counter = start_pct
-            for _UID in df[_tag].unique():
-                df.loc[df[_tag] == _UID, "fake_" + _tag] = counter
-                counter += 1
         else:
+            codes, uniques = pd.factorize(df["StudyInstanceUID"], use_na_sentinel=False)
             counter = start_study
-            for _UID in df["StudyInstanceUID"].unique():
-                df.loc[df["StudyInstanceUID"] == _UID, "fake_" + _tag] = counter
-                counter += 1        
-
+        df["fake_" + _tag] = codes + counter
+        counter += len(uniques)
 
         if _tag == "PatientID":
             last_patient = counter
@@ -425,11 +2200,35 @@ def replace_ids(df_in: pd.DataFrame, prefix: str, start_pct=1, start_study=1) ->
             last_study = counter
             
     print("Time: " + str(time.time() - start))
-    print("Last Patient: " + str(last_patient))
-    print("Last Study: " + str(last_study))
+    if key is None:
+        print("Last Patient: " + str(last_patient))
+        print("Last Study: " + str(last_study))
     return df
 
-def replace_ids_parallel_joblib(df_in: pd.DataFrame, prefix: str, start_pct=1, start_study=1, n_jobs=-1) -> pd.DataFrame:
+def _replace_ids_with_store(df, prefix, start_pct, start_study, store):
+    """
+    Map the UIDs, PatientID and study numbers of <df> through <store>, so
+    values pseudonymized in an earlier batch keep their pseudonyms.
+    """
+    for tag in ["StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"]:
+        print("Assigning new " + tag + "s.")
+        mapping = store.assign_uids(tag, df[tag].unique(), prefix)
+        df[f"fake_{tag}"] = df[tag].astype(str).map(mapping)
+
+    print("Assigning new PatientIDs.")
+    patient_mapping = store.assign_numbers("PatientID", df["PatientID"].unique(), start=start_pct)
+    df["fake_PatientID"] = df["PatientID"].astype(str).map(patient_mapping)
+
+    print("Assigning new StudyIDs and AccessionNumbers.")
+    study_mapping = store.assign_numbers("Study", df["StudyInstanceUID"].unique(), start=start_study)
+    df["fake_StudyID"] = df["StudyInstanceUID"].astype(str).map(study_mapping)
+    df["fake_AccessionNumber"] = df["fake_StudyID"]
+    return store.next_number("PatientID"), store.next_number("Study")
+
+
+@_staged("replace_ids")
+def replace_ids_parallel_joblib(df_in: pd.DataFrame, prefix: str, start_pct=1, start_study=1, n_jobs=-1,
+                                store=None, key=None) -> pd.DataFrame:
     """
     # Maps the PatientID, StudyID
     # in a Pandas DataFrame with newly generated IDs taking into account the 
@@ -439,6 +2238,13 @@ def replace_ids_parallel_joblib(df_in: pd.DataFrame, prefix: str, start_pct=1, s
     # Parameters:
     #    df_in (Pandas DataFrame): DataFrame containing the three columns of UIDs
     #    prefix (str): string containing your particular prefix.
+    #    store (PseudonymStore or str, optional): persistent mapping store.
+    #        Patients, studies and UIDs already in the store reuse their
+    #        pseudonyms, and new numbers continue from the stored counters
+    #        (start_pct/start_study only apply to an empty store).
+    #    key (str or bytes, optional): secret key for deterministic UIDs and
+    #        IDs (see hmac_uid and hmac_id). Shards pseudonymized separately
+    #        with the same key agree on every pseudonym.
 
     # Returns:
     #    df (DataFrame): with three new columns containing the new UIDs
@@ -454,16 +2260,37 @@ def replace_ids_parallel_joblib(df_in: pd.DataFrame, prefix: str, start_pct=1, s
             raise ValueError(
                 "DataFrame must have StudyInstanceUID, SeriesInstanceUID, and SOPInstanceUID columns"
             )
+
+    if store is not None:
+        with _open_store(store) as opened:
+            last_patient, last_study = _replace_ids_with_store(df, prefix, start_pct, start_study, opened)
+        df = df.sort_values(by=['Filename'], ascending=True)
+        print("Time: " + str(time.time() - start))
+        print("Last Patient: " + str(last_patient))
+        print("Last Study: " + str(last_study))
+        return df
+
+    if key is not None:
+        for tag in list_of_tags:
+            df[f"fake_{tag}"] = hmac_uids(df[tag], key, prefix)
+        df["fake_PatientID"] = hmac_ids(df["PatientID"], key, "PatientID")
+        df["fake_StudyID"] = hmac_ids(df["StudyInstanceUID"], key, "Study")
+        df["fake_AccessionNumber"] = df["fake_StudyID"]
+        df = df.sort_values(by=['Filename'], ascending=True)
+        print("Time: " + str(time.time() - start))
+        return df
     
     def make_mapping(tag):
         """Generate the mapping dict for a single column."""
         unique_vals = df[tag].unique()
         # tqdm here if you'd like to monitor progress
-        mapping = {val: pydicom.uid.generate_uid(prefix=prefix) for val in unique_vals}
+        make_uid = _uid_generator(prefix, key)
+        mapping = {val: make_uid(val) for val in unique_vals}
         return tag, mapping
 
     # Generate mapping dicts in parallel
-    results = Parallel(n_jobs=n_jobs)(
+    # Inside worker_pool() the three maps run on threads instead of a second process pool
+    results = Parallel(n_jobs=n_jobs, prefer="threads" if _shared_pool is not None else None)(
         delayed(make_mapping)(tag) for tag in tqdm(list_of_tags, desc="Generating StudyInstanceUID, SeriesInstanceUID, and SOPInstanceUID maps")
     )
     
@@ -497,6 +2324,26 @@ def replace_ids_parallel_joblib(df_in: pd.DataFrame, prefix: str, start_pct=1, s
     print("Last Study: " + str(last_study))
     return df
 
+# Tags read from every input file to build the mapping (crosswalk) table
+_PHI_DICOM_TAGS = [
+    'PatientID',             # Unique identifier for the patient
+    'PatientName',           # Name of the patient
+    'PatientBirthDate',      # Birth date of the patient
+    'PatientSex',            # Sex of the patient
+    'PatientAge',
+    'ReferringPhysicianName',# Name of the referring physician
+    'StudyID',               # ID of the study
+    'AccessionNumber',
+    'DeviceSerialNumber',    # Serial number of the device
+    'StudyInstanceUID',      # Unique identifier for the study
+    'StudyDate',             # Date of study initiation
+    'StudyTime',             # Time of study initiation
+    'SeriesInstanceUID',     # Unique identifier for the series
+    'SOPInstanceUID',     # Unique identifier for the series
+    'ProtocolName',          # Name of the protocol used for the series
+]
+
+
 def allow_list(in_path: str, out_path: str, list_of_tags: list, start_pct=1, start_study=1):
     """
     Processes DICOM files to anonymize and retain only a specified list of tags, saving the modified files to a new location.
@@ -518,99 +2365,15 @@ def allow_list(in_path: str, out_path: str, list_of_tags: list, start_pct=1, sta
 
     The anonymization process assigns new values to PatientID, PatientName, StudyID, AccessionNumber, StudyInstanceUID, SeriesInstanceUID, and SOPInstanceUID, while retaining specified clinical tags. Certain fixed values are assigned to PatientBirthDate, PatientSex, PatientAge, and StudyDate, StudyTime, and the ProtocolName is cleared.
     """
-    
-    phi_dicom_tags = [
-        'PatientID',             # Unique identifier for the patient
-        'PatientName',           # Name of the patient
-        'PatientBirthDate',      # Birth date of the patient
-        'PatientSex',            # Sex of the patient
-        'PatientAge',
-        'ReferringPhysicianName',# Name of the referring physician
-        'StudyID',               # ID of the study
-        'AccessionNumber',
-        'DeviceSerialNumber',    # Serial number of the device
-        'StudyInstanceUID',      # Unique identifier for the study
-        'StudyDate',             # Date of study initiation
-        'StudyTime',             # Time of study initiation
-        'SeriesInstanceUID',     # Unique identifier for the series
-        'SOPInstanceUID',     # Unique identifier for the series
-        'ProtocolName',          # Name of the protocol used for the series
-    ]
 
-    df = dcmtag2table_parallel(in_path, phi_dicom_tags, max_workers=16)
+    df = dcmtag2table_parallel(in_path, _PHI_DICOM_TAGS, max_workers=16)
 
     df = replace_ids_parallel_joblib(df, prefix="1.2.840.12345.", start_pct=start_pct, start_study=start_study)
-    counter = 0
-    for index, row in tqdm(df.iterrows(), total=len(df)):
-        #if counter < 52820:
-        #    continue
-        #counter += 1
-        original_file_path = row['Filename']
-        
-        # Read the original DICOM file
-        original_ds = pydicom.dcmread(original_file_path, force=True)
-        #print(original_ds.file_meta)
-
-        
-        # Create a new DICOM dataset
-        new_ds = Dataset()
-        new_ds.file_meta = FileMetaDataset()
-        try:
-            new_ds.file_meta = original_ds.file_meta
-        except:
-            print("No file_meta found. Skipping file.")
-            continue
-        '''
-        if 'TransferSyntaxUID' in original_ds.file_meta:
-            tsyntax = original_ds.file_meta.TransferSyntaxUID
-            new_ds.is_little_endian = tsyntax not in [
-                "1.2.840.10008.1.2",  # Implicit VR Little Endian
-            ]
-            new_ds.is_implicit_VR = tsyntax in [
-                "1.2.840.10008.1.2",  # Implicit VR Little Endian
-            ]
-        else:
-            # Se o Transfer Syntax não estiver presente, usar valores comuns
-            new_ds.is_little_endian = True  
-            new_ds.is_implicit_VR = False  
-        '''
-        
-        # Copy only the predefined tags from the original to the new dataset
-        for tag in list_of_tags:
-            if hasattr(original_ds, tag):
-                new_ds.add(original_ds[tag])
-
-
-        new_ds.PatientID = str(int(row['fake_PatientID'])).zfill(6)
-        new_ds.PatientName = str(int(row['fake_PatientID'])).zfill(6)
-        new_ds.PatientBirthDate = "19190828"
-        new_ds.PatientSex = row['PatientSex']
-        new_ds.PatientAge = row['PatientAge']
-        new_ds.StudyID = str(int(row['fake_AccessionNumber'])).zfill(6)
-        new_ds.AccessionNumber = str(int(row['fake_AccessionNumber'])).zfill(6)
-        new_ds.StudyInstanceUID = row['fake_StudyInstanceUID']
-        new_ds.SeriesInstanceUID = row['fake_SeriesInstanceUID']
-        new_ds.SOPInstanceUID = row['fake_SOPInstanceUID']
-        new_ds.file_meta.MediaStorageSOPInstanceUID = row['fake_SOPInstanceUID']
-        new_ds.ProtocolName = ""
-        new_ds.StudyDate = "20250228"
-        new_ds.SeriesDate = new_ds.StudyDate
-        new_ds.ContentDate = new_ds.StudyDate
-        new_ds.AcquisitionDate = new_ds.StudyDate
-        new_ds.StudyTime = "000000"
-        new_ds.SeriesTime = new_ds.StudyTime
-        new_ds.ContentTime = new_ds.StudyTime
-        new_ds.AcquisitionTime = new_ds.StudyTime
-
-        # Construct the new file path based on StudyID
-
-        new_file_path = os.path.join(out_path, new_ds['StudyID'].value, new_ds['SOPInstanceUID'].value + ".dcm")
-        
-        # Ensure the directory exists
-        os.makedirs(os.path.dirname(new_file_path), exist_ok=True)
-        
-        # Save the new DICOM file
-        new_ds.save_as(new_file_path)
+    with instrumentation.stage("rewrite"):
+        for index, row in tqdm(df.iterrows(), total=len(df)):
+            new_file_path = _rewrite_file(row, out_path, list_of_tags)
+            instrumentation.count("files_written")
+            instrumentation.count("bytes_written", os.path.getsize(new_file_path))
             
     return df
 
@@ -624,15 +2387,180 @@ def _process_single_row(
     Process a single row from the DataFrame: read the original DICOM,
     copy only certain tags, anonymize / replace IDs, and write out the new DICOM.
     """
-    original_file_path = row['Filename']
-
     try:
-        # Read original
-        original_ds = pydicom.dcmread(original_file_path, force=True)
+        _rewrite_file(row, out_path, list_of_tags)
     except Exception as e:
-        print(f"Failed to read DICOM {original_file_path} - {e}")
-        return
+        instrumentation.log(f"Failed to rewrite DICOM {row['Filename']} - {e}")
+
+
+_COPY_CHUNK_BYTES = 1 << 20
+
+
+def _pixel_data_span(fp, ds):
+    """
+    Locate the PixelData element that follows the header just read from
+    <fp> with stop_before_pixels. Returns (start, end) byte offsets of the
+    whole element (tag, length and value, including every fragment of
+    encapsulated pixel data), or None if no PixelData follows.
+    Raises ValueError when the raw bytes cannot be copied as they are.
+    """
+    start = fp.tell()
+    if 'TransferSyntaxUID' not in ds.file_meta:
+        raise ValueError("no Transfer Syntax UID")
+    tsyntax = ds.file_meta.TransferSyntaxUID
+    if tsyntax.is_deflated or ds.original_encoding != (tsyntax.is_implicit_VR, tsyntax.is_little_endian):
+        raise ValueError("data set encoding differs from its Transfer Syntax")
+    endian = "<" if tsyntax.is_little_endian else ">"
+
+    header = fp.read(12)
+    if len(header) < 8:
+        return None
+    group, element = struct.unpack(endian + "HH", header[:4])
+    if (group, element) != (0x7FE0, 0x0010):
+        if group == 0x7FE0:
+            raise ValueError("float pixel data")
+        return None
+    if tsyntax.is_implicit_VR:
+        length = struct.unpack(endian + "I", header[4:8])[0]
+        value_start = start + 8
+    else:
+        if header[4:6] not in (b"OB", b"OW"):
+            raise ValueError("pixel data not encoded with its Transfer Syntax")
+        if len(header) < 12:
+            raise ValueError("truncated pixel data")
+        length =struct.unpack(endian + "I", header[8:12])[0]
+        value_start = start + 12
+
+    file_size = os.fstat(fp.fileno()).st_size
+    if length != 0xFFFFFFFF:
+        if value_start + length > file_size:
+            raise ValueError("truncated pixel data")
+        return start, value_start + length
+
+    # Encapsulated: skip items until the sequence delimiter
+    fp.seek(value_start)
+    while True:
+        item = fp.read(8)
+        if len(item) < 8:
+            raise ValueError("truncated encapsulated pixel data")
+        group, element, length = struct.unpack(endian + "HHI", item)
+        if (group, element) == (0xFFFE, 0xE0DD):
+            return start, fp.tell()
+        if (group, element) != (0xFFFE, 0xE000):
+            raise ValueError("unexpected tag in encapsulated pixel data")
+        fp.seek(length, os.SEEK_CUR)
+
+
+def _copy_range(fin, fout, start, end):
+    """
+    Copy bytes [start, end) of <fin> to the current position of <fout>,
+    in the kernel with os.copy_file_range when possible, otherwise in
+    fixed-size chunks, so memory use does not depend on the size.
+    """
+    fout.flush()
+    remaining = end - start
+    offset = start
+    if hasattr(os, "copy_file_range"):
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(fin.fileno(), fout.fileno(), remaining, offset)
+                if copied == 0:
+                    break
+                offset += copied
+                remaining -= copied
+        except OSError:
+            pass
+        fout.seek(0, os.SEEK_END)
+    fin.seek(offset)
+    while remaining > 0:
+        chunk = fin.read(min(_COPY_CHUNK_BYTES, remaining))
+        if not chunk:
+            raise ValueError("unexpected end of file while copying pixel data")
+        fout.write(chunk)
+        remaining -= len(chunk)
+
+
+def _rewrite_file(row, out_path: str, list_of_tags: list, make_dirs=True):
+    """
+    Write the pseudonymized copy of row['Filename'] to
+    <out_path>/<StudyID>/<SOPInstanceUID>.dcm.
+
+    The file is written under a temporary name and renamed into place.
+    Only the header is parsed. When PixelData is allowed, its original bytes
+    (including encapsulated fragments) are copied from the input file after
+    the new header without being decoded or loaded into memory. Files whose
+    pixel data cannot be copied as raw bytes fall back to a full read.
+    Returns the path of the new file.
+    """
+    with open(row['Filename'], 'rb') as fin:
+        new_ds, span = _prepare_rewrite(fin, row, list_of_tags)
+        return _write_rewritten(new_ds, fin, span, out_path, make_dirs)
+
+
+def _write_rewritten(new_ds, fin, span, out_path: str, make_dirs=True):
+    """
+    Write <new_ds> to <out_path>/<StudyID>/<SOPInstanceUID>.dcm, followed by
+    the bytes <span> of the open input file <fin> (if span is not None).
+    The file is written under a temporary name and renamed, so no partial
+    .dcm is ever left behind, even if the process is killed.
+    Returns the path of the new file.
+    """
+    new_file_path = os.path.join(out_path, new_ds.StudyID, new_ds.SOPInstanceUID + ".dcm")
+    if make_dirs:
+        os.makedirs(os.path.dirname(new_file_path), exist_ok=True)
+    tmp_path = f"{new_file_path}.tmp-{os.getpid()}"
+    try:
+        with open(tmp_path, 'wb') as fout:
+            new_ds.save_as(fout)
+            if span is not None:
+                _copy_range(fin, fout, *span)
+                _count_bytes_read(span[1] - span[0])
+        os.replace(tmp_path, new_file_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return new_file_path
+
+
+def _read_for_rewrite(fin, list_of_tags: list):
+    """
+    Read the header of the open input file <fin>. Returns (original_ds,
+    header_tags, span) where span is the (start, end) byte range of the
+    original PixelData element to copy after the new header, or None when
+    nothing has to be copied (the pixel data, if allowed, is then in
+    original_ds and header_tags).
+    """
+    original_ds = pydicom.dcmread(fin, stop_before_pixels=True, force=True)
+    _count_bytes_read(fin.tell())
+    header_tags = [tag for tag in list_of_tags if tag != 'PixelData']
+    span = None
+    if 'PixelData' in list_of_tags:
+        try:
+            span = _pixel_data_span(fin, original_ds)
+        except ValueError:
+            fin.seek(0)
+            original_ds = pydicom.dcmread(fin, force=True)
+            _count_bytes_read(fin.tell())
+            header_tags = list_of_tags
+    return original_ds, header_tags, span
+
+
+def _prepare_rewrite(fin, row, list_of_tags: list):
+    """
+    Read the header of the open input file <fin> and build its pseudonymized
+    dataset. Returns (new_ds, span), see _read_for_rewrite.
+    """
+    original_ds, header_tags, span = _read_for_rewrite(fin, list_of_tags)
+    return _anonymize_dataset(original_ds, row, header_tags), span
+
 
+def _anonymize_dataset(original_ds, row, list_of_tags: list):
+    """
+    Build the pseudonymized dataset: copy only <list_of_tags> from
+    <original_ds> and set the fake IDs from <row> (a DataFrame row or a dict
+    with the fake_* columns) and the fixed values.
+    """
     # Create new dataset
     new_ds = Dataset()
     new_ds.file_meta = FileMetaDataset()
@@ -682,22 +2610,302 @@ def _process_single_row(
     new_ds.SeriesTime   = new_ds.StudyTime
     new_ds.ContentTime  = new_ds.StudyTime
     new_ds.AcquisitionTime = new_ds.StudyTime
+    return new_ds
 
-    # Construct new file path
-    new_file_path = os.path.join(
-        out_path, 
-        new_ds.StudyID, 
-        new_ds.SOPInstanceUID + ".dcm"
-    )
 
-    # Ensure directory exists
-    os.makedirs(os.path.dirname(new_file_path), exist_ok=True)
+# Columns of the mapping table needed to rewrite a file
+_REWRITE_COLUMNS = [
+    'Filename', 'SOPInstanceUID', 'PatientSex', 'PatientAge', 'fake_PatientID', 'fake_AccessionNumber',
+    'fake_StudyInstanceUID', 'fake_SeriesInstanceUID', 'fake_SOPInstanceUID',
+]
+
 
-    # Save
+def _process_batch(columns: dict, out_path: str, list_of_tags: list, journal_dir=None):
+    """
+    Rewrite a batch of files, given as {column: list of values} holding only
+    _REWRITE_COLUMNS. Each output study directory is created once per batch.
+    With a <journal_dir>, the original SOPInstanceUID of every file renamed
+    into place is appended to this process's log (see _load_journal).
+    Returns (n_written, failures, bytes written) where failures is a list
+    of (filename, error message).
+    """
+    n_rows = len(columns['Filename'])
+    study_dirs = {str(int(v)).zfill(6) for v in columns['fake_AccessionNumber']}
+    for study_dir in study_dirs:
+        os.makedirs(os.path.join(out_path, study_dir), exist_ok=True)
+
+    n_written = 0
+    n_bytes = 0
+    failures = []
+    journal = _open_done_log(journal_dir) if journal_dir is not None else None
     try:
-        new_ds.save_as(new_file_path) #, enforce_file_format=True)
-    except Exception as e:
-        print(f"Failed to save DICOM {new_file_path} - {e}")
+        for i in range(n_rows):
+            row = {col: values[i] for col, values in columns.items()}
+            try:
+                new_file_path = _rewrite_file(row, out_path, list_of_tags, make_dirs=False)
+                n_written += 1
+                n_bytes += os.path.getsize(new_file_path)
+            except Exception as e:
+                failures.append((row['Filename'], str(e)))
+                continue
+            if journal is not None:
+                journal.write(f"{row['SOPInstanceUID']}\n")
+                journal.flush()
+    finally:
+        if journal is not None:
+            journal.close()
+    return n_written, failures, n_bytes
+
+
+def _open_done_log(journal_dir):
+    # One append-only log per process, so workers never interleave writes
+    return open(os.path.join(journal_dir, f"done-{os.getpid()}.log"), "a")
+
+
+def _load_journal(journal_dir):
+    """
+    Load a journal written by allow_list_parallel.
+    Returns (mapping, done) where mapping is the saved mapping table (or
+    None) and done is the set of original SOPInstanceUIDs already written.
+    A torn last line (no newline) is ignored: that file is written again.
+    """
+    mapping_path = os.path.join(journal_dir, "mapping.pkl")
+    mapping = pd.read_pickle(mapping_path) if os.path.exists(mapping_path) else None
+    done = set()
+    for name in os.listdir(journal_dir):
+        if name.startswith("done-") and name.endswith(".log"):
+            with open(os.path.join(journal_dir, name)) as log:
+                done.update(line[:-1] for line in log if line.endswith("\n"))
+    return mapping, done
+
+
+def _reset_journal(journal_dir):
+    os.makedirs(journal_dir, exist_ok=True)
+    for name in os.listdir(journal_dir):
+        if name.startswith("done-") and name.endswith(".log"):
+            os.remove(os.path.join(journal_dir, name))
+
+
+def _remove_partial_files(out_path):
+    """
+    Remove the temporary files (<file>.tmp-<pid>, shard.tmp-<pid>-<ns> and
+    shard-<hash>.index.csv.tmp) that a killed run left in <out_path>, and
+    the shard-<hash>.tar renamed into place without its index: the journal
+    never lists their instances, so they are written again.
+    Returns how many files were removed.
+    """
+    n_removed = 0
+    for root, _, files in os.walk(out_path):
+        names = set(files)
+        for name in files:
+            if (".tmp-" in name or name.endswith(".index.csv.tmp")
+                    or (name.startswith("shard-") and name.endswith(".tar")
+                        and name[:-len(".tar")] + ".index.csv" not in names)):
+                os.remove(os.path.join(root, name))
+                n_removed += 1
+    return n_removed
+
+
+# Columns of the per-shard index files
+_SHARD_INDEX_COLUMNS = ['SOPInstanceUID', 'StudyInstanceUID', 'member', 'offset', 'size']
+
+# Default rows per worker task in shard mode (whole studies are kept together)
+_SHARD_BATCH_ROWS = 4096
+
+
+class _ShardWriter:
+    """
+    Append pseudonymized instances to size-bounded, uncompressed tar shards
+    in <out_path>. A new shard is started only between studies, once the
+    current one holds <shard_size> bytes, so a study is never split (a study
+    larger than <shard_size> gets an oversized shard of its own).
+
+    Each shard is written as a temporary file and, when full, renamed to
+    shard-<hash>.tar next to shard-<hash>.index.csv, which maps every
+    SOPInstanceUID to the byte offset and size of its member data. The name
+    is derived from the first member, so shards written by separate tasks or
+    by a resumed run never collide. With a <journal_dir>, the original
+    SOPInstanceUIDs of a shard are logged only once the shard is complete.
+    """
+
+    def __init__(self, out_path, shard_size, journal_dir=None):
+        self.out_path = out_path
+        self.shard_size = shard_size
+        self.journal_dir = journal_dir
+        self.fout = None
+
+    def _open(self):
+        self.tmp_path = os.path.join(self.out_path, f"shard.tmp-{os.getpid()}-{time.time_ns()}")
+        self.fout = open(self.tmp_path, 'wb')
+        self.index = []
+        self.done = []
+
+    def start_study(self):
+        if self.fout is not None and self.fout.tell() >= self.shard_size:
+            self.close()
+
+    def add(self, fin, new_ds, span, original_sop):
+        """
+        Append one instance: the new header, then the copied pixel bytes.
+        Returns the size of the instance in bytes.
+        """
+        if self.fout is None:
+            self._open()
+        header = io.BytesIO()
+        new_ds.save_as(header)
+        header = header.getvalue()
+        size = len(header) + (span[1] - span[0] if span is not None else 0)
+
+        member = f"{new_ds.StudyID}/{new_ds.SOPInstanceUID}.dcm"
+        info = tarfile.TarInfo(member)
+        info.size = size
+        info.mtime = int(time.time())
+        start = self.fout.tell()
+        try:
+            self.fout.write(info.tobuf(format=tarfile.GNU_FORMAT))
+            offset = self.fout.tell()
+            self.fout.write(header)
+            if span is not None:
+                _copy_range(fin, self.fout, *span)
+                _count_bytes_read(span[1] - span[0])
+            self.fout.write(b"\0" * (-size % tarfile.BLOCKSIZE))
+        except Exception:
+            # Drop the partial member so the shard stays a valid archive
+            self.fout.seek(start)
+            self.fout.truncate()
+            raise
+        self.index.append((new_ds.SOPInstanceUID, new_ds.StudyInstanceUID, member, offset, size))
+        self.done.append(original_sop)
+        return size
+
+    def close(self):
+        if self.fout is None:
+            return
+        # End-of-archive marker: two zero blocks, padded to a full record
+        self.fout.write(b"\0" * (2 * tarfile.BLOCKSIZE))
+        self.fout.write(b"\0" * (-self.fout.tell() % tarfile.RECORDSIZE))
+        self.fout.close()
+        self.fout = None
+        if not self.index:
+            os.remove(self.tmp_path)
+            return
+
+        name = "shard-" + hashlib.blake2b(self.index[0][0].encode(), digest_size=8).hexdigest()
+        shard_path = os.path.join(self.out_path, name + ".tar")
+        index = pd.DataFrame(self.index, columns=_SHARD_INDEX_COLUMNS)
+        index_tmp = os.path.join(self.out_path, name + ".index.csv.tmp")
+        index.to_csv(index_tmp, index=False)
+        os.replace(self.tmp_path, shard_path)
+        os.replace(index_tmp, os.path.join(self.out_path, name + ".index.csv"))
+
+        if self.journal_dir is not None:
+            with _open_done_log(self.journal_dir) as journal:
+                journal.writelines(f"{sop}\n" for sop in self.done)
+
+    def abort(self):
+        if self.fout is not None:
+            self.fout.close()
+            self.fout = None
+            os.remove(self.tmp_path)
+
+
+def _process_shard_batch(columns: dict, out_path: str, list_of_tags: list, shard_size: int, journal_dir=None):
+    """
+    Same as _process_batch, but packs the batch (sorted by study) into tar
+    shards with _ShardWriter instead of writing one file per instance.
+    """
+    n_rows = len(columns['Filename'])
+    writer = _ShardWriter(out_path, shard_size, journal_dir)
+    n_written = 0
+    n_bytes = 0
+    failures = []
+    previous_study = None
+    try:
+        for i in range(n_rows):
+            row = {col: values[i] for col, values in columns.items()}
+            if row['fake_StudyInstanceUID'] != previous_study:
+                writer.start_study()
+                previous_study = row['fake_StudyInstanceUID']
+            try:
+                with open(row['Filename'], 'rb') as fin:
+                    new_ds, span = _prepare_rewrite(fin, row, list_of_tags)
+                    n_bytes += writer.add(fin, new_ds, span, row['SOPInstanceUID'])
+                n_written += 1
+            except Exception as e:
+                failures.append((row['Filename'], str(e)))
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    return n_written, failures, n_bytes
+
+
+def load_shard_index(out_path: str):
+    """
+    Load and concatenate the index files of the tar shards written by
+    allow_list_parallel(..., shard_size=...).
+
+    Parameters:
+    out_path (str): The output directory holding the shards.
+
+    Returns:
+    pandas.DataFrame: One row per instance with the columns SOPInstanceUID,
+    StudyInstanceUID, member, offset, size and shard (path of the tar file).
+    """
+    frames = []
+    for name in sorted(os.listdir(out_path)):
+        if name.startswith("shard-") and name.endswith(".index.csv"):
+            index = pd.read_csv(os.path.join(out_path, name), dtype={'SOPInstanceUID': str, 'StudyInstanceUID': str})
+            index['shard'] = os.path.join(out_path, name[:-len(".index.csv")] + ".tar")
+            frames.append(index)
+    if not frames:
+        return pd.DataFrame(columns=_SHARD_INDEX_COLUMNS + ['shard'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_from_shard(shard_path: str, offset: int, size: int, stop_before_pixels=False):
+    """
+    Read a single instance from a tar shard with one seek and one read,
+    without extracting the archive.
+
+    Parameters:
+    shard_path (str): Path of the shard (the shard column of load_shard_index).
+    offset (int): Byte offset of the member data (the offset column).
+    size (int): Size of the member data in bytes (the size column).
+    stop_before_pixels (bool): Read only the bytes up to the pixel data.
+
+    Returns:
+    pydicom.Dataset: The instance.
+    """
+    with open(shard_path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(size)
+    if len(data) != size:
+        raise ValueError(f"{shard_path} is truncated at offset {offset}")
+    return pydicom.dcmread(io.BytesIO(data), stop_before_pixels=stop_before_pixels, force=True)
+
+
+def _make_rewrite_batches(df, batch_size=None, whole_studies=False):
+    """
+    Split the mapping table into compact worker batches holding only
+    _REWRITE_COLUMNS: one batch per study by default, or chunks of
+    <batch_size> rows of the table sorted by study. With whole_studies,
+    chunks are extended to the end of their last study.
+    """
+    table = df[[c for c in _REWRITE_COLUMNS if c in df.columns]]
+    if batch_size is None:
+        groups = (group for _, group in table.groupby('fake_StudyInstanceUID', sort=False))
+    else:
+        table = table.sort_values('fake_StudyInstanceUID', kind='stable')
+        bounds = list(range(0, len(table), batch_size)) + [len(table)]
+        if whole_studies:
+            # Move every cut forward to the first row of the next study
+            studies = table['fake_StudyInstanceUID'].to_numpy()
+            starts = np.append(np.flatnonzero(studies[1:] != studies[:-1]) + 1, len(table))
+            bounds = sorted({0, len(table), *starts[np.searchsorted(starts, bounds[1:-1])].tolist()})
+        groups = (table.iloc[i:j] for i, j in zip(bounds[:-1], bounds[1:]))
+    for group in groups:
+        yield {col: group[col].tolist() for col in group.columns}
 
 
 def allow_list_parallel(
@@ -706,35 +2914,277 @@ def allow_list_parallel(
     list_of_tags: list, 
     start_pct=1, 
     start_study=1,
-    max_workers=8
+    max_workers=8,
+    store=None,
+    key=None,
+    batch_size=None,
+    journal_dir=None,
+    resume=False,
+    shard_size=None,
+    prefix="1.2.840.12345.",
+    scan_workers=16
 ):
     """
     Processes DICOM files to anonymize and retain only a specified list of tags,
     saving the modified files to a new location, **in parallel**.
-    """
-    # 1) Extract DICOM tags in parallel (assuming your function already does this)
-    phi_dicom_tags = [
-        'PatientID','PatientName','PatientBirthDate','PatientSex','PatientAge',
-        'ReferringPhysicianName','StudyID','AccessionNumber','DeviceSerialNumber',
-        'StudyInstanceUID','StudyDate','StudyTime','SeriesInstanceUID','SOPInstanceUID','ProtocolName'
-    ]
-    df = dcmtag2table_parallel(in_path, phi_dicom_tags, max_workers=16)
 
-    # 2) Replace IDs in parallel (assuming your function already does this)
-    df = replace_ids_parallel_joblib(df, prefix="1.2.840.12345.", start_pct=start_pct, start_study=start_study)
+    With a <store> (PseudonymStore or path to its SQLite file), patients,
+    studies and UIDs seen in earlier batches reuse their pseudonyms. With a
+    secret <key>, pseudonyms are derived with HMAC instead (see hmac_uid).
+    New UIDs start with <prefix>. The tags are read by <scan_workers>
+    processes, the files rewritten by <max_workers>.
+
+    Files are rewritten one study per worker task (or <batch_size> rows per
+    task), so each task ships only the columns it needs and creates each
+    output directory once. Files that fail are reported at the end.
+
+    With a <journal_dir>, the mapping table is saved there before any file
+    is written and every worker logs the SOPInstanceUIDs it finished. After
+    a crash, run again with resume=True: the saved mapping is reused (so the
+    files already written keep matching), finished files are skipped and
+    the temporary files left in <out_path> are removed. Every file is
+    written under a temporary name and renamed into place.
+
+    With a <shard_size> in bytes, instances are packed into uncompressed tar
+    shards of about that size, grouped by study, instead of one file each.
+    Every shard-<hash>.tar comes with a shard-<hash>.index.csv mapping each
+    SOPInstanceUID to the offset and size of its data (see load_shard_index
+    and read_from_shard). Each task then holds whole studies, <batch_size>
+    rows or more (_SHARD_BATCH_ROWS by default).
+    """
+    if resume and journal_dir is None:
+        raise ValueError("resume=True needs the journal_dir of the interrupted run")
+    df, done = None, set()
+    if journal_dir is not None:
+        if resume:
+            df, done = _load_journal(journal_dir)
+            n_removed = _remove_partial_files(out_path)
+            if n_removed:
+                print(f"Resuming: removed {n_removed} partially written files.")
+        else:
+            _reset_journal(journal_dir)
+
+    if df is None:
+        # 1) Extract DICOM tags in parallel (assuming your function already does this)
+        df = dcmtag2table_parallel(in_path, _PHI_DICOM_TAGS, max_workers=scan_workers)
+
+        # 2) Replace IDs in parallel (assuming your function already does this)
+        df = replace_ids_parallel_joblib(df, prefix=prefix, start_pct=start_pct, start_study=start_study,
+                                         store=store, key=key)
+        if journal_dir is not None:
+            _atomic_to_pickle(df, os.path.join(journal_dir, "mapping.pkl"))
+
+    todo = df
+    if done:
+        todo = df[~df['SOPInstanceUID'].astype(str).isin(done)]
+        print(f"Resuming: {len(df) - len(todo)} files already written, {len(todo)} to go.")
     
-    # 3) Final DICOM read/modify/write in parallel
-    tasks = (
-        delayed(_process_single_row)(index, row, out_path, list_of_tags)
-        for index, row in df.iterrows()
-    )
+    # 3) Final DICOM read/modify/write in parallel, one batch per task
+    if shard_size is None:
+        tasks = (
+            (_process_batch, columns, out_path, list_of_tags, journal_dir)
+            for columns in _make_rewrite_batches(todo, batch_size)
+        )
+    else:
+        os.makedirs(out_path, exist_ok=True)
+        tasks = (
+            (_process_shard_batch, columns, out_path, list_of_tags, shard_size, journal_dir)
+            for columns in _make_rewrite_batches(todo, batch_size or _SHARD_BATCH_ROWS, whole_studies=True)
+        )
+
+    n_written = 0
+    failures = []
+    with instrumentation.stage("rewrite"), tqdm(total=len(todo), desc="Processing DICOMs") as progress:
+        for (batch_written, batch_failures, batch_bytes), pid, seconds, n_read in _map_unordered(
+                _timed_call, tasks, max_workers):
+            n_written += batch_written
+            failures.extend(batch_failures)
+            progress.update(batch_written + len(batch_failures))
+            instrumentation.worker(pid, batch_written + len(batch_failures), seconds)
+            instrumentation.count("files_written", batch_written)
+            instrumentation.count("files_failed", len(batch_failures))
+            instrumentation.count("bytes_written", batch_bytes)
+            instrumentation.count("bytes_read", n_read)
+            for filename, error in batch_failures:
+                instrumentation.log(f"Failed {filename} - {error}")
+
+    print(f"Written: {n_written}, failed: {len(failures)}")
+    for filename, error in failures[:10]:
+        print(f"Failed {filename} - {error}")
+
+    return df
+
+
+_FAKE_COLUMNS = [
+    'fake_StudyInstanceUID', 'fake_SeriesInstanceUID', 'fake_SOPInstanceUID',
+    'fake_PatientID', 'fake_StudyID', 'fake_AccessionNumber',
+]
+
+
+def _single_pass_pseudonyms(rows, prefix, key, store_path, start_pct, start_study):
+    """
+    Add the fake_* values to every row dict of <rows>: derived with HMAC from
+    <key>, or assigned through the PseudonymStore at <store_path> in a single
+    transaction, so the numbers of a batch are consecutive.
+    """
+    uid_tags = ["StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"]
+    if key is not None:
+        _check_uid_prefix(prefix)
+        for row in rows:
+            for tag in uid_tags:
+                row[f"fake_{tag}"] = _hmac_uid(row[tag], key, prefix)
+            row["fake_PatientID"] = hmac_id(row["PatientID"], key, "PatientID")
+            row["fake_StudyID"] = hmac_id(row["StudyInstanceUID"], key, "Study")
+            row["fake_AccessionNumber"] = row["fake_StudyID"]
+        return
+
+    with PseudonymStore(store_path) as store, store.transaction():
+        for tag in uid_tags:
+            mapping = store.assign_uids(tag, [row[tag] for row in rows], prefix)
+            for row in rows:
+                row[f"fake_{tag}"] = mapping[str(row[tag])]
+        patients = store.assign_numbers("PatientID", [row["PatientID"] for row in rows], start=start_pct)
+        studies = store.assign_numbers("Study", [row["StudyInstanceUID"] for row in rows], start=start_study)
+    for row in rows:
+        row["fake_PatientID"] = patients[str(row["PatientID"])]
+        row["fake_StudyID"] = studies[str(row["StudyInstanceUID"])]
+        row["fake_AccessionNumber"] = row["fake_StudyID"]
+
+
+# Files whose headers are held at once by _single_pass_batch
+_SINGLE_PASS_CHUNK = 256
+
+
+def _single_pass_batch(file_paths, out_path, list_of_tags, prefix, key, store_path, start_pct, start_study):
+    """
+    Pseudonymize a batch of files reading each header only once: the PHI
+    values are taken from the same dataset that is then rewritten, and the
+    pixel data is copied from the still unread end of the file. Headers
+    (never pixel data) are held for at most _SINGLE_PASS_CHUNK files at a
+    time; files whose pixel data cannot be copied as raw bytes are read
+    again in full when they are written, one at a time.
+    Returns (crosswalk columns, failures, bytes written).
+    """
+    phi_plan = _compile_plan(_PHI_DICOM_TAGS)
+    crosswalk = {column: [] for column in ['Filename'] + _PHI_DICOM_TAGS + _FAKE_COLUMNS}
+    failures = []
+    n_bytes = 0
+    for start in range(0, len(file_paths), _SINGLE_PASS_CHUNK):
+        rows, headers = [], []
+        for filepath in file_paths[start:start + _SINGLE_PASS_CHUNK]:
+            try:
+                with open(filepath, 'rb') as fin:
+                    original_ds = pydicom.dcmread(fin, stop_before_pixels=True, force=True)
+                    _count_bytes_read(fin.tell())
+                    span = None
+                    if 'PixelData' in list_of_tags:
+                        try:
+                            span = _pixel_data_span(fin, original_ds)
+                        except ValueError:
+                            # Read in full when written, see _read_for_rewrite
+                            span = False
+            except Exception as e:
+                failures.append((filepath, str(e)))
+                continue
+            row = {'Filename': filepath}
+            row.update(zip(_PHI_DICOM_TAGS, _apply_plan(original_ds, phi_plan)))
+            rows.append(row)
+            headers.append((original_ds, span))
+        if not rows:
+            continue
+        _single_pass_pseudonyms(rows, prefix, key, store_path, start_pct, start_study)
+
+        for study_dir in {str(int(row['fake_AccessionNumber'])).zfill(6) for row in rows}:
+            os.makedirs(os.path.join(out_path, study_dir), exist_ok=True)
+        header_tags = [tag for tag in list_of_tags if tag != 'PixelData']
+        for i, row in enumerate(rows):
+            original_ds, span = headers[i]
+            headers[i] = None
+            try:
+                if span is False:
+                    with open(row['Filename'], 'rb') as fin:
+                        original_ds, full_tags, span = _read_for_rewrite(fin, list_of_tags)
+                        new_ds = _anonymize_dataset(original_ds, row, full_tags)
+                        new_file_path = _write_rewritten(new_ds, fin, span, out_path, make_dirs=False)
+                elif span is None:
+                    new_ds = _anonymize_dataset(original_ds, row, header_tags)
+                    new_file_path = _write_rewritten(new_ds, None, None, out_path, make_dirs=False)
+                else:
+                    new_ds = _anonymize_dataset(original_ds, row, header_tags)
+                    with open(row['Filename'], 'rb') as fin:
+                        new_file_path = _write_rewritten(new_ds, fin, span, out_path, make_dirs=False)
+                n_bytes += os.path.getsize(new_file_path)
+            except Exception as e:
+                failures.append((row['Filename'], str(e)))
+                continue
+            for column, values in crosswalk.items():
+                values.append(row[column])
+    return crosswalk, failures, n_bytes
+
+
+def allow_list_single_pass(
+    in_path: str,
+    out_path: str,
+    list_of_tags: list,
+    key=None,
+    store=None,
+    prefix="1.2.840.12345.",
+    start_pct=1,
+    start_study=1,
+    max_workers=8,
+):
+    """
+    Same output as allow_list_parallel, reading every input file once: there
+    is no separate tag scan, and the crosswalk is collected from the headers
+    that are rewritten. Since no worker sees the whole table, pseudonyms come
+    either from a secret <key> (HMAC, see hmac_uid and hmac_id; identical to
+    allow_list_parallel with the same key) or from a <store> (PseudonymStore
+    or path to its SQLite file) shared by all workers. With a store, new
+    patients and studies are numbered in the order batches finish, not in
+    filename order.
 
-    # Optional: wrap in tqdm for a progress bar
-    Parallel(n_jobs=max_workers)(
-        tqdm(tasks, total=len(df), desc="Processing DICOMs")
+    Returns:
+        DataFrame: the crosswalk (Filename, the original PHI tags and the
+        fake_* columns), sorted by Filename. Files that fail are reported
+        at the end and left out.
+    """
+    if key is None and store is None:
+        raise ValueError("allow_list_single_pass needs a key or a store")
+    if key is not None:
+        _check_uid_prefix(prefix)
+    store_path = store.path if isinstance(store, PseudonymStore) else store
+
+    filelist, skipped = scan_dicom_files(in_path)
+    _report_skipped(skipped)
+    tasks = (
+        (_single_pass_batch, batch, out_path, list_of_tags, prefix, key, store_path, start_pct, start_study)
+        for batch in _make_batches(filelist, max_workers)
     )
 
-    return df
+    columns = {column: [] for column in ['Filename'] + _PHI_DICOM_TAGS + _FAKE_COLUMNS}
+    failures = []
+    with instrumentation.stage("rewrite"), tqdm(total=len(filelist), desc="Processing DICOMs") as progress:
+        for (batch_columns, batch_failures, batch_bytes), pid, seconds, n_read in _map_unordered(
+                _timed_call, tasks, max_workers):
+            for column, values in batch_columns.items():
+                columns[column].extend(values)
+            failures.extend(batch_failures)
+            batch_written = len(batch_columns['Filename'])
+            progress.update(batch_written + len(batch_failures))
+            instrumentation.worker(pid, batch_written + len(batch_failures), seconds)
+            instrumentation.count("files_parsed", batch_written)
+            instrumentation.count("files_written", batch_written)
+            instrumentation.count("files_failed", len(batch_failures))
+            instrumentation.count("bytes_written", batch_bytes)
+            instrumentation.count("bytes_read", n_read)
+            for filename, error in batch_failures:
+                instrumentation.log(f"Failed {filename} - {error}")
+
+    print(f"Written: {len(columns['Filename'])}, failed: {len(failures)}")
+    for filename, error in failures[:10]:
+        print(f"Failed {filename} - {error}")
+
+    return pd.DataFrame(columns).sort_values(by=['Filename'], ignore_index=True)
 
 def age_string_to_int(age_str: str) -> int:
     """
@@ -771,18 +3221,18 @@ def no_phi_age(age_str: str) -> str:
         age_int = 90
     return str(age_int) + "Y"
 
-def list_files_in_directory(directory: str) -> Set[str]:
+def list_files_in_directory(directory: str, dicom_only=True, max_threads=8) -> Set[str]:
     """
     List all files in a directory and its subdirectories.
     
     :param directory: The directory to search for files.
+    :param dicom_only: Skip files that fail the cheap DICOM header check.
+    :param max_threads: Number of directories listed concurrently.
     :return: A set of file paths.
     """
-    file_paths = set()
-    for root, _, files in tqdm(os.walk(directory)):
-        for file in files:
-            file_paths.add(os.path.join(root, file))
-    return file_paths
+    file_paths, skipped = scan_dicom_files(directory, max_threads=max_threads, check_header=dicom_only)
+    _report_skipped(skipped)
+    return set(file_paths)
 
 def process_element(element, tag_values):
     """
@@ -820,18 +3270,15 @@ def extract_tags_from_file(file_path: str) -> Set[str]:
     """
     tag_values = set()
     try:
-        dicom_file = pydicom.dcmread(file_path, force=True)
-
-        # Remove PixelData if present to avoid large memory usage
-        if "PixelData" in dicom_file:
-            del dicom_file.PixelData
+        # Header only: the pixel data is never read
+        dicom_file = pydicom.dcmread(file_path, stop_before_pixels=True, force=True)
 
         # Iterate over all elements in the DICOM
         for element in dicom_file.iterall():
             process_element(element, tag_values)
     except Exception as e:
-        # You may log errors or handle them as needed
-        print(f"Error reading {file_path}: {e}")
+        # Printed only with a verbose Instrumentation (see set_instrumentation)
+        instrumentation.log(f"Error reading {file_path}: {e}")
 
     return tag_values
     
@@ -846,6 +3293,7 @@ def save_set_to_file(data: Set[str], file_name: str):
         for item in data:
             file.write(f"{item}\n")
 
+@_staged("dump_unique")
 def dump_unique_values(directory: str, output="unique_values.txt"):
     print("Listing files")
     file_paths = list_files_in_directory(directory)
@@ -853,11 +3301,19 @@ def dump_unique_values(directory: str, output="unique_values.txt"):
     dicom_tags = iterate_dicom_tags(file_paths)
     save_set_to_file(dicom_tags, output)
 
-def dump_unique_values_parallel(directory: str, output="unique_values.txt", max_workers=8):
+@_staged("dump_unique")
+def dump_unique_values_parallel(directory: str, output="unique_values.txt", max_workers=8, per_tag=False,
+                                max_entries=1000000, spill_dir=None):
     """
     List DICOM files in `directory`, read them in parallel,
     accumulate all unique tag values, and save them to `output`.
+
+    With per_tag=True, write instead the per-tag report of
+    dump_unique_values_per_tag, built in bounded memory.
     """
+    if per_tag:
+        return dump_unique_values_per_tag(directory, output, max_workers=max_workers, max_entries=max_entries,
+                                          spill_dir=spill_dir)
     print("Listing files...")
     file_paths = list_files_in_directory(directory)
     file_paths = list(file_paths)  # Convert to list for easier iteration
@@ -866,7 +3322,7 @@ def dump_unique_values_parallel(directory: str, output="unique_values.txt", max_
     
     # Use a process pool to parallelize across CPU cores
     all_tags = set()
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    with _process_pool(max_workers) as executor:
         # Use tqdm to show progress over the number of files
         for tag_set in tqdm(executor.map(extract_tags_from_file, file_paths),
                             total=len(file_paths), desc="Reading files"):
@@ -880,7 +3336,435 @@ def dump_unique_values_parallel(directory: str, output="unique_values.txt", max_
     print("Done.")
 
 
-def copy_files(df, column_name: str, folder2replace: str):
+# VRs whose values are reported by length only
+_BINARY_VRS = {"OB", "OD", "OF", "OL", "OV", "OW", "UN"}
+
+# Runs merged at once; more runs are merged in several passes
+_MERGE_FAN_IN = 256
+
+
+def _report_value(element):
+    # One line per value: tabs and newlines would break the TSV runs
+    if element.VR in _BINARY_VRS:
+        value = f"<{len(element.value or b'')} bytes>"
+    elif element.VM > 1:
+        value = "\\".join(str(v) for v in element.value)
+    else:
+        value = "" if element.value is None else str(element.value)
+    return value.replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _iter_tag_values(ds, prefix=""):
+    """
+    Yield (tag path, VR, value) for every element of <ds>, descending into
+    sequences. Items of a sequence share the path Sequence/*/Keyword, and
+    tags without a keyword (private tags) are written as (gggg,eeee).
+    """
+    for element in ds:
+        if element.tag in _PIXEL_DATA_TAGS:
+            continue
+        path = prefix + (element.keyword or f"({element.tag.group:04X},{element.tag.element:04X})")
+        if element.VR == "SQ":
+            for item in element.value:
+                yield from _iter_tag_values(item, path + "/*/")
+        else:
+            yield path, element.VR, _report_value(element)
+
+
+def _spill_run(counts, spill_dir):
+    """Write the partial counts, sorted by key, as a TSV run. Returns its path."""
+    fd, run_path = tempfile.mkstemp(prefix="run-", suffix=".tsv", dir=spill_dir)
+    with os.fdopen(fd, "w", encoding="utf-8", errors="backslashreplace") as run:
+        # Sort on the joined line prefix, the same key _merge_runs compares
+        for key in sorted(counts, key="\t".join):
+            count, example = counts[key]
+            run.write(f"{key[0]}\t{key[1]}\t{key[2]}\t{count}\t{example}\n")
+    return run_path
+
+
+def _count_tag_values(file_paths, spill_dir, max_entries):
+    """
+    Count (tag path, VR, value) over the headers of <file_paths>, keeping
+    the first file where each was seen. The counts are spilled to a sorted
+    run whenever they reach <max_entries> keys and at the end.
+    Returns (run paths, failures).
+    """
+    counts = {}
+    runs = []
+    failures = []
+    for file_path in file_paths:
+        try:
+            ds = pydicom.dcmread(file_path, stop_before_pixels=True, force=True)
+            for key in _iter_tag_values(ds):
+                entry = counts.get(key)
+                if entry is None:
+                    counts[key] = [1, file_path]
+                else:
+                    entry[0] += 1
+        except Exception as e:
+            failures.append((file_path, str(e)))
+        if len(counts) >= max_entries:
+            runs.append(_spill_run(counts, spill_dir))
+            counts = {}
+    if counts:
+        runs.append(_spill_run(counts, spill_dir))
+    return runs, failures
+
+
+def _run_key(line):
+    return line.rsplit("\t", 2)[0]
+
+
+def _merge_runs(runs, output, header=None):
+    """
+    k-way merge of sorted runs into <output>, adding up the counts of equal
+    keys and keeping the first example file. Only one line per run is held
+    in memory. Returns the number of keys written.
+    """
+    files = [open(run, encoding="utf-8") for run in runs]
+    n_keys = 0
+    try:
+        with open(output, "w", encoding="utf-8") as out:
+            if header is not None:
+                out.write(header)
+            current_key, total, example = None, 0, None
+            for line in heapq.merge(*files, key=_run_key):
+                key, count, line_example = line.rstrip("\n").rsplit("\t", 2)
+                if key != current_key:
+                    if current_key is not None:
+                        out.write(f"{current_key}\t{total}\t{example}\n")
+                        n_keys += 1
+                    current_key, total, example = key, 0, line_example
+                total += int(count)
+            if current_key is not None:
+                out.write(f"{current_key}\t{total}\t{example}\n")
+                n_keys += 1
+    finally:
+        for f in files:
+            f.close()
+    return n_keys
+
+
+@_staged("dump_unique")
+def dump_unique_values_per_tag(directory: str, output="unique_values.tsv", max_workers=8, max_entries=1000000,
+                               spill_dir=None):
+    """
+    Write a per-tag report of every distinct value found in the DICOM headers
+    under a directory, in bounded memory.
+
+    Files are read header only (pixel data is never loaded). Each worker
+    counts (tag path, VR, value) with the first file where it was seen, and
+    spills sorted runs to disk every <max_entries> keys. The runs are then
+    combined with an external k-way merge, so neither the workers nor the
+    parent ever hold the full set of values.
+
+    Parameters:
+    directory (str): The folder to scan.
+    output (str): Path of the TSV report, with the columns tag, vr, value,
+                  count and example_file, sorted by tag then value. Sequence
+                  items are reported as Sequence/*/Keyword, private tags as
+                  (gggg,eeee) and binary values (OB, OW, UN...) by length.
+    max_workers (int): Number of worker processes.
+    max_entries (int): Distinct keys a worker holds before spilling a run.
+    spill_dir (str): Directory for the temporary runs (default: a temporary
+                     directory, removed at the end).
+
+    Returns:
+    int: The number of distinct (tag, VR, value) rows written.
+    """
+    print("Listing files...")
+    file_paths, skipped = scan_dicom_files(directory)
+    _report_skipped(skipped)
+    print(f"Found {len(file_paths)} files. Reading DICOM headers in parallel...")
+
+    with tempfile.TemporaryDirectory(dir=spill_dir) as run_dir:
+        runs = []
+        failures = []
+        with _process_pool(max_workers) as executor:
+            futures = {executor.submit(_count_tag_values, batch, run_dir, max_entries): len(batch)
+                       for batch in _make_batches(file_paths, max_workers)}
+            with tqdm(total=len(file_paths), desc="Reading headers") as progress:
+                for future in as_completed(futures):
+                    batch_runs, batch_failures = future.result()
+                    runs.extend(batch_runs)
+                    failures.extend(batch_failures)
+                    progress.update(futures[future])
+        for file_path, error in failures[:10]:
+            print(f"Error reading {file_path}: {error}")
+
+        # Merge in passes of at most _MERGE_FAN_IN runs to bound open files
+        print(f"Merging {len(runs)} runs...")
+        while len(runs) > _MERGE_FAN_IN:
+            merged = []
+            for i in range(0, len(runs), _MERGE_FAN_IN):
+                fd, merged_path = tempfile.mkstemp(prefix="run-", suffix=".tsv", dir=run_dir)
+                os.close(fd)
+                _merge_runs(runs[i:i + _MERGE_FAN_IN], merged_path)
+                for run in runs[i:i + _MERGE_FAN_IN]:
+                    os.remove(run)
+                merged.append(merged_path)
+            runs = merged
+        n_keys = _merge_runs(runs, output, header="tag\tvr\tvalue\tcount\texample_file\n")
+
+    print(f"Saved {n_keys} unique tag values to '{output}'.")
+    return n_keys
+
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    """
+    Fixed-size cardinality sketch (HyperLogLog over 64-bit blake2b hashes).
+    Uses 2**precision bytes; the standard error of the estimate is about
+    1.04 / sqrt(2**precision), i.e. 1.6% with the default precision of 12.
+    Sketches with the same precision are merged by taking register maxima.
+
+    Parameters:
+        precision (int): Number of index bits, between 4 and 18.
+    """
+
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 18:
+            raise ValueError("precision must be between 4 and 18")
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, value: str):
+        h = _hash64(value)
+        rest_bits = 64 - self.precision
+        rest = h & ((1 << rest_bits) - 1)
+        # Position of the leftmost 1 bit in the remaining bits
+        rank = rest_bits - rest.bit_length() + 1
+        index = h >> rest_bits
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("cannot merge sketches with different precisions")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.ldexp(1.0, -self.registers.astype(np.int64)).sum()
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            # Small range correction: linear counting
+            return int(round(m * np.log(m / zeros)))
+        return int(round(raw))
+
+
+class SpaceSaving:
+    """
+    Heavy-hitters sketch (Space-Saving) keeping at most <k> counters. Any
+    value seen more than n/k times out of n is guaranteed to be kept, and
+    each count overestimates the true one by at most its recorded error.
+    Sketches are merged by adding counts (a value missing from a full
+    sketch is credited with that sketch's minimum count).
+
+    Parameters:
+        k (int): Number of counters.
+    """
+
+    def __init__(self, k=10):
+        self.k = k
+        self.counters = {}
+
+    def add(self, value: str, count=1):
+        entry = self.counters.get(value)
+        if entry is not None:
+            entry[0] += count
+        elif len(self.counters) < self.k:
+            self.counters[value] = [count, 0]
+        else:
+            # Evict the smallest counter; its count becomes the new error
+            victim = min(self.counters, key=lambda v: self.counters[v][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[value] = [floor + count, floor]
+
+    def _floor(self):
+        if len(self.counters) < self.k:
+            return 0
+        return min(count for count, _ in self.counters.values())
+
+    def merge(self, other):
+        floor, other_floor = self._floor(), other._floor()
+        merged = {}
+        for value in set(self.counters) | set(other.counters):
+            count, error = self.counters.get(value, (floor, floor))
+            other_count, other_error = other.counters.get(value, (other_floor, other_floor))
+            merged[value] = [count + other_count, error + other_error]
+        top = sorted(merged.items(), key=lambda item: -item[1][0])[:self.k]
+        self.counters = dict(top)
+        return self
+
+    def top(self, n=None):
+        """Return [(value, count, error)] sorted by count, largest first."""
+        items = sorted(self.counters.items(), key=lambda item: -item[1][0])[:n]
+        return [(value, count, error) for value, (count, error) in items]
+
+
+def _profile_batch(file_paths, k, precision):
+    """
+    Build {tag path: [values seen, files, HyperLogLog, SpaceSaving]} over the
+    headers of <file_paths>. Returns (profiles, number of unreadable files).
+    """
+    profiles = {}
+    failed = 0
+    for file_path in file_paths:
+        try:
+            ds = pydicom.dcmread(file_path, stop_before_pixels=True, force=True)
+            seen = set()
+            for tag, _, value in _iter_tag_values(ds):
+                profile = profiles.get(tag)
+                if profile is None:
+                    profile = profiles[tag] = [0, 0, HyperLogLog(precision), SpaceSaving(k)]
+                profile[0] += 1
+                if tag not in seen:
+                    profile[1] += 1
+                    seen.add(tag)
+                profile[2].add(value)
+                profile[3].add(value)
+        except Exception:
+            failed += 1
+    return profiles, failed
+
+
+@_staged("profile")
+def profile_tag_values(directory: str, max_workers=8, k=10, precision=12):
+    """
+    Profile the values of every tag found in the DICOM headers under a
+    directory in a single parallel pass, with fixed memory per tag: an
+    approximate number of distinct values (HyperLogLog) and the most
+    frequent values (Space-Saving). Useful to spot free text or identifiers
+    in unexpected tags before a PHI review, without the exact list of
+    dump_unique_values.
+
+    Parameters:
+    directory (str): The folder to scan.
+    max_workers (int): Number of worker processes.
+    k (int): Number of top values kept per tag.
+    precision (int): HyperLogLog precision (2**precision bytes per tag).
+
+    Returns:
+    pandas.DataFrame: One row per tag path (named as in
+    dump_unique_values_per_tag) with the columns tag, values (elements
+    seen), files (files containing the tag), cardinality (estimated
+    distinct values), cardinality_ratio (cardinality / values) and
+    top_values ([(value, count, max overcount)]), sorted by cardinality.
+    """
+    file_paths, skipped = scan_dicom_files(directory)
+    _report_skipped(skipped)
+
+    profiles = {}
+    failed = 0
+    with _process_pool(max_workers) as executor:
+        futures = {executor.submit(_profile_batch, batch, k, precision): len(batch)
+                   for batch in _make_batches(file_paths, max_workers)}
+        with tqdm(total=len(file_paths), desc="Profiling headers") as progress:
+            for future in as_completed(futures):
+                batch_profiles, batch_failed = future.result()
+                failed += batch_failed
+                for tag, (n_values, n_files, hll, top) in batch_profiles.items():
+                    profile = profiles.get(tag)
+                    if profile is None:
+                        profiles[tag] = [n_values, n_files, hll, top]
+                    else:
+                        profile[0] += n_values
+                        profile[1] += n_files
+                        profile[2].merge(hll)
+                        profile[3].merge(top)
+                progress.update(futures[future])
+    if failed:
+        print(f"Could not read {failed} files")
+
+    rows = [
+        {
+            "tag": tag,
+            "values": n_values,
+            "files": n_files,
+            "cardinality": min(hll.estimate(), n_values),
+            "top_values": top.top(),
+        }
+        for tag, (n_values, n_files, hll, top) in profiles.items()
+    ]
+    df = pd.DataFrame(rows, columns=["tag", "values", "files", "cardinality", "top_values"])
+    df.insert(4, "cardinality_ratio", df["cardinality"] / df["values"].clip(lower=1))
+    return df.sort_values(["cardinality", "tag"], ascending=[False, True], ignore_index=True)
+
+
+# ioctl request of Linux FICLONE (share the extents of a file, copy-on-write)
+_FICLONE = 0x40049409
+
+# Copy strategies of copy_files, each falling back to the next one
+_COPY_STRATEGIES = ("hardlink", "reflink", "copy_file_range", "copy")
+
+# Rough fixed cost per file (open, create, close) used by dry runs
+_COPY_FILE_OVERHEAD_S = 0.0005
+
+
+def _reflink(source_path, destination_path):
+    import fcntl
+    with open(source_path, 'rb') as fin, open(destination_path, 'wb') as fout:
+        fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+
+
+def _kernel_copy(source_path, destination_path):
+    with open(source_path, 'rb') as fin, open(destination_path, 'wb') as fout:
+        _copy_range(fin, fout, 0, os.fstat(fin.fileno()).st_size)
+
+
+def _copy_one(source_path, destination_path, strategy):
+    """
+    Copy one file with <strategy>, falling back to the next strategy of
+    _COPY_STRATEGIES when the filesystem does not support it (reflink on
+    ext4, hardlink across devices...). Returns the strategy used, or
+    "existing" when the destination already is the source file (a hardlink
+    left by an earlier run). Data is written to a temporary file renamed
+    over the destination, so an existing destination is never opened for
+    writing: it may share its inode with the source.
+    """
+    if os.path.abspath(source_path) == os.path.abspath(destination_path):
+        raise shutil.SameFileError(f"{source_path} and {destination_path} are the same file")
+    if os.path.exists(destination_path) and os.path.samefile(source_path, destination_path):
+        return "existing"
+    for name in _COPY_STRATEGIES[_COPY_STRATEGIES.index(strategy):]:
+        try:
+            if name == "hardlink":
+                if os.path.lexists(destination_path):
+                    os.remove(destination_path)
+                os.link(source_path, destination_path)
+                return name
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(destination_path) or ".",
+                                            prefix=os.path.basename(destination_path) + ".tmp-")
+            os.close(fd)
+            try:
+                if name == "reflink":
+                    _reflink(source_path, tmp_path)
+                elif name == "copy_file_range":
+                    _kernel_copy(source_path, tmp_path)
+                else:
+                    shutil.copy2(source_path, tmp_path)
+                if name != "copy":
+                    shutil.copystat(source_path, tmp_path)
+                os.replace(tmp_path, destination_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            return name
+        except (OSError, ImportError):
+            if name == "copy":
+                raise
+            continue
+
+
+def copy_files(df, column_name: str, folder2replace: str, strategy="copy", max_threads=16, dry_run=False,
+               throughput_mb_s=200):
     """
     Copies files from source paths listed in a DataFrame to a destination path.
     The destination path is generated by replacing a specified folder name in the source path
@@ -890,22 +3774,60 @@ def copy_files(df, column_name: str, folder2replace: str):
     df (pandas.DataFrame): A DataFrame containing file paths.
     column_name (str): The name of the column in the DataFrame where file paths are stored.
     folder2replace (str): The folder name in the path to be replaced with 'folder2replace_filtered'.
+    strategy (str): How files are copied: 'hardlink' (no data copied, the
+                    destination shares the source inode), 'reflink' (Linux
+                    FICLONE: copy-on-write clone on Btrfs/XFS), 'copy_file_range'
+                    (copy inside the kernel) or 'copy' (shutil.copy2). A
+                    strategy the filesystem does not support falls back to
+                    the next one in that order.
+    max_threads (int): Number of files copied concurrently.
+    dry_run (bool): Copy nothing; only report the number of files, the total
+                    bytes and the estimated time.
+    throughput_mb_s (float): Copy throughput assumed by the dry run estimate.
 
-    The function iterates over each file path in the specified DataFrame column, replaces the specified 
-    folder name in the path with 'folder2replace_filtered', creates the destination directory if it does 
-    not exist, and then copies the file to the new location.
-    """
-    for source_path in tqdm(df[column_name]):
-        # Replace 'upload' with 'upload_filtered' in the path
-        destination_path = source_path.replace(folder2replace, folder2replace + "_filtered")
-
-        # Create the destination directory if it doesn't exist
-        destination_dir = os.path.dirname(destination_path)
-        if not os.path.exists(destination_dir):
-            os.makedirs(destination_dir)
+    Returns:
+    dict: files, bytes and estimated_seconds for a dry run; otherwise files
+          copied, failed (list of (path, error)) and the count per strategy used
+          ("existing" for destinations already hardlinked to their source).
 
-        # Copy the file
-        shutil.copy2(source_path, destination_path)
+    Each destination directory is created once before the files are copied
+    by a bounded thread pool.
+    """
+    if strategy not in _COPY_STRATEGIES:
+        raise ValueError(f"strategy must be one of {_COPY_STRATEGIES}")
+    sources = df[column_name].tolist()
+    destinations = [source.replace(folder2replace, folder2replace + "_filtered") for source in sources]
+
+    if dry_run:
+        with ThreadPoolExecutor(max_workers=max_threads) as executor:
+            total_bytes = sum(executor.map(os.path.getsize, sources))
+        data_seconds = 0 if strategy in ("hardlink", "reflink") else total_bytes / (throughput_mb_s * 1e6)
+        report = {
+            "files": len(sources),
+            "bytes": total_bytes,
+            "estimated_seconds": data_seconds + len(sources) * _COPY_FILE_OVERHEAD_S,
+        }
+        print(f"Would copy {report['files']} files, {total_bytes / 1e9:.2f} GB "
+              f"with '{strategy}', about {report['estimated_seconds']:.0f} s")
+        return report
+
+    # Create each destination directory once
+    for destination_dir in {os.path.dirname(destination) for destination in destinations}:
+        os.makedirs(destination_dir, exist_ok=True)
+
+    failed = []
+    used = defaultdict(int)
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        futures = {executor.submit(_copy_one, source, destination, strategy): source
+                   for source, destination in zip(sources, destinations)}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                used[future.result()] += 1
+            except OSError as e:
+                failed.append((futures[future], str(e)))
+    for source, error in failed[:10]:
+        print(f"Failed {source} - {error}")
+    return {"copied": len(sources) - len(failed), "failed": failed, "strategies": dict(used)}
 
 
 def remove_if_tag_contains(df, tag: str, list2remove: list):
@@ -943,20 +3865,38 @@ def append_to_csv(file_path, data_dict):
     # Create a DataFrame from the dictionary
     new_row = pd.DataFrame([data_dict])
 
-    # Check if the file exists
-    if os.path.exists(file_path):
-        # Read existing data
-        df = pd.read_csv(file_path)
-        # Concatenate the new data
-        df = pd.concat([df, new_row], ignore_index=True)
-    else:
-        # Use the new row as the DataFrame
-        df = new_row
-    
+    # Append without reading the history back when the columns match;
+    # only a file with other columns is read and rewritten
+    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+        new_row.to_csv(file_path, index=False)
+        return
+    with open(file_path, newline='') as f:
+        existing_header = f.readline().rstrip('\r\n')
+    if existing_header == new_row.head(0).to_csv(index=False).rstrip('\r\n'):
+        new_row.to_csv(file_path, mode='a', header=False, index=False)
+        return
+
+    # Other columns: read the existing data and concatenate the new row
+    df = pd.read_csv(file_path)
+    df = pd.concat([df, new_row], ignore_index=True)
+
     # Save to CSV
     df.to_csv(file_path, index=False)
-    
-def get_metrics(folder: str, output_file: str):
+
+# Study modalities counted by get_metrics
+_METRICS_MODALITIES = ['MR', 'CT', 'US', 'CR', 'DX']
+
+
+def get_metrics(folder: str, output_file: str, max_workers=8):
+    """
+    Compute summary metrics of a DICOM folder and append them as one row to
+    the CSV history <output_file>.
+
+    Everything comes from one parallel pass: the byte size of each file is
+    taken from the stat of the directory scan (so "Batch Size Bytes" counts
+    the DICOM files found), tags are read header only by <max_workers>
+    processes, and each count is computed once from the table.
+    """
     list_of_tags = [
                 "PatientID",
                 "StudyInstanceUID",
@@ -966,22 +3906,28 @@ def get_metrics(folder: str, output_file: str):
                 "PatientSex",
                 "PatientAge"
                 ]
-    df = dcmtag2table(folder, list_of_tags)
+    stats, skipped = scan_dicom_files(folder, return_stats=True)
+    _report_skipped(skipped)
+    columns, failed = _read_columns_parallel([f[0] for f in stats], list_of_tags, max_workers, tag_bounded=True)
+    _report_skipped({"unreadable by pydicom": failed})
+    df = pd.DataFrame(columns).sort_values(by=['Filename'])
+
+    # First row of each study / patient, as drop_duplicates would keep it
+    studies = df.drop_duplicates('StudyInstanceUID')
+    patients = df.drop_duplicates('PatientID')
+    modality_counts = studies['Modality'].value_counts()
 
     summary = {
         "Timestamp": datetime.now().strftime("%m/%d/%Y, %H:%M:%S"),
         "Number of files": len(df),
-        "Batch Size Bytes": get_folder_size(folder),
-        "Number of patients": len(df['PatientID'].unique()),
-        "Number of studies": len(df['StudyInstanceUID'].unique()),
-        "Number of series": len(df['SeriesInstanceUID'].unique()),
-        "Number of MRs": len(df.drop_duplicates('StudyInstanceUID')[df.drop_duplicates('StudyInstanceUID')['Modality'] == 'MR']),
-        "Number of CTs": len(df.drop_duplicates('StudyInstanceUID')[df.drop_duplicates('StudyInstanceUID')['Modality'] == 'CT']),
-        "Number of USs": len(df.drop_duplicates('StudyInstanceUID')[df.drop_duplicates('StudyInstanceUID')['Modality'] == 'US']),
-        "Number of CRs": len(df.drop_duplicates('StudyInstanceUID')[df.drop_duplicates('StudyInstanceUID')['Modality'] == 'CR']),
-        "Number of DXs": len(df.drop_duplicates('StudyInstanceUID')[df.drop_duplicates('StudyInstanceUID')['Modality'] == 'DX']),
-        "Percentage of male": len(df.drop_duplicates('PatientID')[df.drop_duplicates('PatientID')['PatientSex'] == 'M']) / len(df.drop_duplicates('PatientID')),
+        "Batch Size Bytes": sum(f[1] for f in stats),
+        "Number of patients": len(patients),
+        "Number of studies": len(studies),
+        "Number of series": df['SeriesInstanceUID'].nunique(dropna=False),
     }
+    for modality in _METRICS_MODALITIES:
+        summary[f"Number of {modality}s"] = int(modality_counts.get(modality, 0))
+    summary["Percentage of male"] = float((patients['PatientSex'] == 'M').sum()) / len(patients)
     append_to_csv(output_file, summary)
     return summary
 
@@ -989,3 +3935,159 @@ def summary(df) -> None:
     print("Total unique values per column:")
     for _col in df.columns:
         print(f"{_col}: {str(len(df[_col].unique()))}")
+
+
+def _write_table(df, path):
+    # Output format from the file extension
+    if path.endswith(".parquet"):
+        df.to_parquet(path, index=False)
+    elif path.endswith((".pkl", ".pickle")):
+        df.to_pickle(path)
+    else:
+        df.to_csv(path, index=False)
+
+
+def _read_key(args):
+    if args.key_file is not None:
+        with open(args.key_file, "rb") as f:
+            return f.read().strip()
+    return os.environ.get("DCMTAG2TABLE_KEY")
+
+
+def _cli_scan(args):
+    if args.series:
+        if args.cache is not None or args.shard is not None or args.dicomdir:
+            raise ValueError("--series does not support --cache, --shard or --dicomdir")
+        df = dcmtag2table_series(args.folder, args.tags, max_workers=args.workers, samples=args.samples,
+                                 verify=args.verify, tag_bounded=args.tag_bounded, typed=args.typed)
+    else:
+        df = dcmtag2table_parallel(args.folder, args.tags, max_workers=args.workers, cache_path=args.cache,
+                                   tag_bounded=args.tag_bounded, typed=args.typed, shard=args.shard,
+                                   use_dicomdir=args.dicomdir)
+    _write_table(df, args.output)
+    print(f"Wrote {len(df)} rows to {args.output}")
+
+
+def _cli_merge(args):
+    df = merge_partial_tables(args.partials, args.output)
+    print(f"Wrote {len(df)} rows to {args.output}")
+
+
+def _cli_anonymize(args):
+    if args.single_pass:
+        if args.journal is not None or args.shard_size is not None:
+            raise ValueError("--single-pass does not support --journal or --shard-size")
+        df = allow_list_single_pass(args.in_path, args.out_path, args.allow_tags, key=_read_key(args),
+                                    store=args.store, prefix=args.prefix, start_pct=args.start_pct,
+                                    start_study=args.start_study, max_workers=args.workers)
+    else:
+        df = allow_list_parallel(args.in_path, args.out_path, args.allow_tags, start_pct=args.start_pct,
+                                 start_study=args.start_study, max_workers=args.workers, store=args.store,
+                                 key=_read_key(args), journal_dir=args.journal, resume=args.resume,
+                                 shard_size=args.shard_size, prefix=args.prefix)
+    if args.crosswalk is not None:
+        _write_table(df, args.crosswalk)
+        print(f"Wrote the crosswalk to {args.crosswalk}")
+
+
+def _cli_dump_unique(args):
+    dump_unique_values_parallel(args.folder, args.output, max_workers=args.workers, per_tag=args.per_tag,
+                                max_entries=args.max_entries, spill_dir=args.spill_dir)
+
+
+def _cli_metrics(args):
+    print(get_metrics(args.folder, args.output, max_workers=args.workers))
+
+
+def main(argv=None):
+    """
+    Command line entry point: python -m dcmtag2table {scan,merge,anonymize,dump-unique,metrics}.
+
+    Options can also be given in a JSON file with --config, keyed by option
+    name with dashes as underscores (e.g. {"workers": 16, "tags": [...],
+    "allow_tags": [...], "prefix": "1.2.840.12345."}); options on the command
+    line take precedence. All stages of one invocation share one worker pool.
+    """
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument("--config")
+    known, _ = config_parser.parse_known_args(argv)
+    config = {}
+    if known.config is not None:
+        with open(known.config) as f:
+            config = json.load(f)
+
+    parser = argparse.ArgumentParser(prog="dcmtag2table", description="Tabulate and pseudonymize DICOM folders.")
+    parser.add_argument("--config", help="JSON file with default values for the options")
+    parser.add_argument("--workers", type=int, default=8, help="worker processes shared by all stages")
+    parser.add_argument("--verbose", action="store_true", help="print every file that fails")
+    parser.add_argument("--prometheus", help="write the run metrics to this Prometheus textfile")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    scan = subparsers.add_parser("scan", help="write the table of DICOM tags of a folder")
+    scan.add_argument("folder")
+    scan.add_argument("output", help="output table (.csv, .parquet or .pkl)")
+    scan.add_argument("--tags", nargs="+", required="tags" not in config)
+    scan.add_argument("--cache", help="scan manifest reused between runs")
+    scan.add_argument("--tag-bounded", action="store_true")
+    scan.add_argument("--typed", action="store_true")
+    scan.add_argument("--shard", help="i/N: read only shard i of N (0-based), for multi-node scans")
+    scan.add_argument("--dicomdir", action="store_true",
+                      help="take the tags from DICOMDIR records, opening files only for tags they lack")
+    scan.add_argument("--series", action="store_true",
+                      help="one row per series, reading a few representative files per directory")
+    scan.add_argument("--samples", type=int, default=1, help="representative files per directory (--series)")
+    scan.add_argument("--verify", type=int, default=4,
+                      help="other files per directory checked for the same series (--series)")
+    scan.set_defaults(func=_cli_scan)
+
+    merge = subparsers.add_parser("merge", help="combine the partial tables of a sharded scan")
+    merge.add_argument("output", help="merged table (.csv, .parquet or .pkl)")
+    merge.add_argument("partials", nargs="+", help="partial tables written by scan --shard")
+    merge.set_defaults(func=_cli_merge)
+
+    anonymize = subparsers.add_parser("anonymize", help="write pseudonymized copies keeping only allowed tags")
+    anonymize.add_argument("in_path")
+    anonymize.add_argument("out_path")
+    anonymize.add_argument("--allow-tags", nargs="+", default=non_phi_ct_dicom_tags)
+    anonymize.add_argument("--prefix", default="1.2.840.12345.", help="root of the new UIDs")
+    anonymize.add_argument("--start-pct", type=int, default=1)
+    anonymize.add_argument("--start-study", type=int, default=1)
+    anonymize.add_argument("--store", help="PseudonymStore SQLite file")
+    anonymize.add_argument("--key-file", help="file holding the HMAC key (default: $DCMTAG2TABLE_KEY)")
+    anonymize.add_argument("--journal", help="journal directory for resumable runs")
+    anonymize.add_argument("--resume", action="store_true")
+    anonymize.add_argument("--shard-size", type=int, help="pack the output in tar shards of this many bytes")
+    anonymize.add_argument("--crosswalk", help="write the original/fake ID table here")
+    anonymize.add_argument("--single-pass", action="store_true",
+                           help="read each file once (needs --store or a key; no --journal/--shard-size)")
+    anonymize.set_defaults(func=_cli_anonymize)
+
+    dump = subparsers.add_parser("dump-unique", help="write the unique values of every tag")
+    dump.add_argument("folder")
+    dump.add_argument("output")
+    dump.add_argument("--per-tag", action="store_true", help="per-tag TSV report built in bounded memory")
+    dump.add_argument("--max-entries", type=int, default=1000000)
+    dump.add_argument("--spill-dir")
+    dump.set_defaults(func=_cli_dump_unique)
+
+    metrics = subparsers.add_parser("metrics", help="append the metrics of a folder to a CSV history")
+    metrics.add_argument("folder")
+    metrics.add_argument("output")
+    metrics.set_defaults(func=_cli_metrics)
+
+    # Config values replace the defaults; the command line still wins
+    for subparser in [parser, *subparsers.choices.values()]:
+        dests = {action.dest for action in subparser._actions}
+        subparser.set_defaults(**{name: value for name, value in config.items() if name in dests})
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        instrumentation.verbose = True
+    with worker_pool(args.workers):
+        args.func(args)
+    if args.prometheus is not None:
+        instrumentation.write_prometheus(args.prometheus)
+
+
+if __name__ == "__main__":
+    main()
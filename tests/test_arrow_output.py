@@ -0,0 +1,73 @@
+import pyarrow.parquet as pq
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+from dcmtag2table import dcmtag2table_to_parquet, iter_dcmtag2table
+
+
+@pytest.fixture
+def dicom_folder(tmp_path):
+    template = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    for i in range(3):
+        ds = template.copy()
+        ds.SOPInstanceUID = f"1.2.3.{i}"
+        items = []
+        for j in range(2):
+            item = Dataset()
+            item.ReferencedSOPInstanceUID = f"1.2.3.{i}.{j}"
+            items.append(item)
+        ds.SourceImageSequence = Sequence(items)
+        ds.save_as(tmp_path / f"{i}.dcm")
+    return tmp_path
+
+
+def _read_parquet(folder, tags, tmp_path, typed):
+    output = tmp_path / "out"
+    dcmtag2table_to_parquet(str(folder), tags, str(output), typed=typed)
+    return pq.read_table(output).to_pandas().sort_values("Filename", ignore_index=True)
+
+
+@pytest.mark.parametrize("typed", [False, True])
+def test_multi_valued_tags_survive_parquet(dicom_folder, tmp_path, typed):
+    df = _read_parquet(dicom_folder, ["ImageType", "PixelSpacing"], tmp_path, typed)
+    assert len(df) == 3
+    assert df["ImageType"].notna().all()
+    assert df["PixelSpacing"].notna().all()
+    if typed:
+        assert list(df["PixelSpacing"][0]) == [0.661468, 0.661468]
+        assert list(df["ImageType"][0]) == ["ORIGINAL", "PRIMARY", "AXIAL"]
+    else:
+        assert "ORIGINAL" in df["ImageType"][0]
+        assert "0.661468" in df["PixelSpacing"][0]
+
+
+def test_untyped_arrow_chunks_keep_multi_valued_tags(dicom_folder):
+    tables = list(iter_dcmtag2table(str(dicom_folder), ["ImageType"], as_arrow=True))
+    values = [v for table in tables for v in table.column("ImageType").to_pylist()]
+    assert len(values) == 3
+    assert all(v is not None and "ORIGINAL" in v for v in values)
+
+
+@pytest.mark.parametrize("typed", [False, True])
+def test_wildcard_paths_survive_parquet(dicom_folder, tmp_path, typed):
+    tags = ["SourceImageSequence[*].ReferencedSOPInstanceUID", "SourceImageSequence/*/ReferencedSOPInstanceUID",
+            "SourceImageSequence[1].ReferencedSOPInstanceUID"]
+    df = _read_parquet(dicom_folder, tags, tmp_path, typed)
+    for tag in tags[:2]:
+        assert df[tag].notna().all()
+        if typed:
+            assert list(df[tag][0]) == ["1.2.3.0.0", "1.2.3.0.1"]
+        else:
+            assert "1.2.3.0.1" in df[tag][0]
+    assert list(df[tags[2]].astype(str)) == ["1.2.3.0.1", "1.2.3.1.1", "1.2.3.2.1"]
+
+
+def test_typed_wildcard_paths_are_list_columns(dicom_folder):
+    from dcmtag2table import dcmtag2table_parallel
+
+    df = dcmtag2table_parallel(str(dicom_folder), ["SourceImageSequence/*/ReferencedSOPInstanceUID"], max_workers=1,
+                               typed=True)
+    assert list(df["SourceImageSequence/*/ReferencedSOPInstanceUID"][2]) == ["1.2.3.2.0", "1.2.3.2.1"]
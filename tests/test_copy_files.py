@@ -0,0 +1,51 @@
+import os
+
+import pandas as pd
+import pytest
+
+from dcmtag2table import copy_files
+
+
+def _make_sources(tmp_path, n=3):
+    source_dir = tmp_path / "dataset" / "study"
+    source_dir.mkdir(parents=True)
+    paths = []
+    for i in range(n):
+        path = source_dir / f"{i}.dcm"
+        path.write_bytes(bytes([i]) * (1000 + i))
+        paths.append(str(path))
+    return pd.DataFrame({"Filename": paths})
+
+
+@pytest.mark.parametrize("strategy", ["reflink", "copy_file_range", "copy"])
+def test_restaging_onto_hardlinks_keeps_sources(tmp_path, strategy):
+    df = _make_sources(tmp_path)
+    sizes = [os.path.getsize(p) for p in df["Filename"]]
+
+    first = copy_files(df, "Filename", "dataset", strategy="hardlink")
+    assert first["copied"] == len(df)
+
+    second = copy_files(df, "Filename", "dataset", strategy=strategy)
+    assert second["failed"] == []
+    assert second["strategies"] == {"existing": len(df)}
+    assert [os.path.getsize(p) for p in df["Filename"]] == sizes
+
+
+@pytest.mark.parametrize("strategy", ["reflink", "copy_file_range", "copy"])
+def test_copy_replaces_existing_destination(tmp_path, strategy):
+    df = _make_sources(tmp_path)
+    for source in df["Filename"]:
+        destination = source.replace("dataset", "dataset_filtered")
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(destination, "wb") as f:
+            f.write(b"stale")
+
+    result = copy_files(df, "Filename", "dataset", strategy=strategy)
+    assert result["failed"] == []
+    for source in df["Filename"]:
+        destination = source.replace("dataset", "dataset_filtered")
+        with open(source, "rb") as fs, open(destination, "rb") as fd:
+            assert fs.read() == fd.read()
+        assert not os.path.samefile(source, destination)
+    leftovers = [f for f in os.listdir(os.path.dirname(destination)) if ".tmp-" in f]
+    assert leftovers == []
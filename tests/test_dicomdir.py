@@ -0,0 +1,39 @@
+import os
+import shutil
+
+import pydicom
+import pytest
+
+from dcmtag2table import dcmtag2table_parallel
+
+TAGS = ['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID', 'Modality', 'StudyDate']
+
+
+@pytest.fixture
+def dicomdir_folder(tmp_path):
+    src = os.path.join(os.path.dirname(pydicom.__file__), 'data', 'test_files', 'dicomdirtests')
+    folder = tmp_path / "cd"
+    os.makedirs(folder)
+    for name in ('77654033', '98892001', '98892003'):
+        shutil.copytree(os.path.join(src, name), folder / name)
+    shutil.copy(os.path.join(src, 'DICOMDIR'), folder / 'DICOMDIR')
+    return folder
+
+
+def _sorted(df):
+    df = df[~df.Filename.str.endswith('DICOMDIR')]
+    return df.sort_values('Filename').reset_index(drop=True).astype(str)
+
+
+@pytest.mark.parametrize("relative", [False, True])
+def test_dicomdir_rows_match_plain_scan(dicomdir_folder, monkeypatch, capsys, relative):
+    folder = str(dicomdir_folder)
+    if relative:
+        monkeypatch.chdir(dicomdir_folder.parent)
+        folder = "cd"
+    plain = dcmtag2table_parallel(folder, TAGS, max_workers=1)
+    indexed = dcmtag2table_parallel(folder, TAGS, max_workers=1, use_dicomdir=True)
+
+    assert "but missing" not in capsys.readouterr().out
+    assert len(indexed) == len(plain) - 1
+    assert _sorted(indexed).equals(_sorted(plain))
@@ -0,0 +1,33 @@
+import pandas as pd
+import pytest
+
+from dcmtag2table import hmac_uid, hmac_uids
+
+
+def test_hmac_uid_is_deterministic():
+    first = hmac_uid("1.2.3.4", "key")
+    assert hmac_uid("1.2.3.4", "key") == first
+    assert hmac_uid("1.2.3.4", b"key") == first
+    assert hmac_uid("1.2.3.5", "key") != first
+    assert hmac_uid("1.2.3.4", "other key") != first
+    assert first.startswith("1.2.840.1234.") and len(first) == 64
+    assert list(hmac_uids(pd.Series(["1.2.3.4", "1.2.3.5", "1.2.3.4"]), "key")) == \
+        [first, hmac_uid("1.2.3.5", "key"), first]
+
+
+def test_hmac_uid_prefix_leaves_room_for_the_digest():
+    prefix = "1." * 17
+    assert len(prefix) == 34
+    uid = hmac_uid("1.2.3.4", "key", prefix)
+    assert len(uid) == 64 and uid[34:].isdigit()
+    for too_long in (prefix + "2.", "1." * 25, "1." * 32):
+        with pytest.raises(ValueError, match="characters long"):
+            hmac_uid("1.2.3.4", "key", too_long)
+        with pytest.raises(ValueError, match="characters long"):
+            hmac_uids(pd.Series(["1.2.3.4"]), "key", too_long)
+
+
+@pytest.mark.parametrize("prefix", ["1.2.840", "1.2.a.", "1..2.", "1.02.", ""])
+def test_hmac_uid_rejects_malformed_prefix(prefix):
+    with pytest.raises(ValueError, match="digits and dots"):
+        hmac_uid("1.2.3.4", "key", prefix)
@@ -0,0 +1,59 @@
+import os
+import shutil
+
+import pytest
+from pydicom.data import get_testdata_file
+
+import dcmtag2table as d
+
+TAGS = ["PatientID", "StudyInstanceUID", "Modality"]
+
+
+@pytest.fixture
+def dicom_folder(tmp_path):
+    folder = tmp_path / "in"
+    os.makedirs(folder)
+    for i in range(3):
+        shutil.copy(get_testdata_file("CT_small.dcm"), folder / f"{i}.dcm")
+    return folder
+
+
+@pytest.fixture
+def counters():
+    previous = d.set_instrumentation(d.Instrumentation())
+    yield d.instrumentation.counters
+    d.set_instrumentation(previous)
+
+
+def _total_size(folder):
+    return sum(os.path.getsize(folder / name) for name in os.listdir(folder))
+
+
+def _pixel_bytes():
+    return 3 * len(d.pydicom.dcmread(get_testdata_file("CT_small.dcm")).PixelData)
+
+
+def test_serial_scan_counts_header_bytes(dicom_folder, counters):
+    d.dcmtag2table(str(dicom_folder), TAGS)
+    assert 0 < counters["bytes_read"] <= _total_size(dicom_folder) - _pixel_bytes()
+
+
+@pytest.mark.parametrize("io_threads, prefetch_bytes", [(1, 65536), (2, 256), (2, 1 << 20)])
+def test_parallel_scan_counts_bytes_read(dicom_folder, counters, io_threads, prefetch_bytes):
+    d.dcmtag2table_parallel(str(dicom_folder), TAGS, max_workers=1, io_threads=io_threads,
+                            prefetch_bytes=prefetch_bytes)
+    if prefetch_bytes > _total_size(dicom_folder):
+        # Whole files prefetched
+        assert counters["bytes_read"] == _total_size(dicom_folder)
+    else:
+        assert 0 < counters["bytes_read"] < _total_size(dicom_folder)
+
+
+def test_rewrite_counts_pixel_data(dicom_folder, tmp_path, counters):
+    d.allow_list_parallel(str(dicom_folder), str(tmp_path / "out"), ["PixelData", "Rows", "Columns"], key="k",
+                          max_workers=1, scan_workers=1)
+    snapshot = counters.copy()
+    assert snapshot["files_written"] == 3
+    # The scan reads the headers, the rewrite reads them again and copies the pixel data
+    assert snapshot["bytes_read"] > _total_size(dicom_folder)
+    assert "dcmtag2table_bytes_read_total" in d.instrumentation.to_prometheus()
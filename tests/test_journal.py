@@ -0,0 +1,66 @@
+import os
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dcmtag2table import allow_list_parallel
+
+TAGS = ["PixelData", "Modality", "Rows", "Columns"]
+
+
+@pytest.fixture
+def dicom_folder(tmp_path):
+    folder = tmp_path / "in"
+    os.makedirs(folder)
+    template = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    for i in range(4):
+        ds = template.copy()
+        ds.SOPInstanceUID = f"1.2.3.1.{i}"
+        ds.save_as(folder / f"{i}.dcm")
+    return folder
+
+
+def _files(root):
+    return sorted(os.path.relpath(os.path.join(r, f), root) for r, _, fs in os.walk(root) for f in fs)
+
+
+def test_resume_removes_partial_files(dicom_folder, tmp_path):
+    out, journal = tmp_path / "out", tmp_path / "journal"
+    allow_list_parallel(str(dicom_folder), str(out), TAGS, key="k", max_workers=1, journal_dir=str(journal))
+    written = _files(out)
+    assert len(written) == 4
+
+    # What a killed run leaves behind
+    partial = os.path.join(out, written[0] + ".tmp-12345")
+    with open(partial, "wb") as f:
+        f.write(b"partial")
+    with open(os.path.join(out, "shard.tmp-12345-1"), "wb") as f:
+        f.write(b"partial")
+
+    allow_list_parallel(str(dicom_folder), str(out), TAGS, key="k", max_workers=1, journal_dir=str(journal),
+                        resume=True)
+    assert _files(out) == written
+
+
+def test_resume_without_journal_is_an_error(dicom_folder, tmp_path):
+    with pytest.raises(ValueError, match="journal_dir"):
+        allow_list_parallel(str(dicom_folder), str(tmp_path / "out"), TAGS, key="k", max_workers=1, resume=True)
+
+
+def test_resume_removes_unindexed_shards(dicom_folder, tmp_path):
+    out, journal = tmp_path / "out", tmp_path / "journal"
+    allow_list_parallel(str(dicom_folder), str(out), TAGS, key="k", max_workers=1, journal_dir=str(journal),
+                        shard_size=1)
+    written = _files(out)
+    assert len(written) == 2
+
+    # Killed after the shard was renamed, before its index was
+    with open(os.path.join(out, "shard-0123456789abcdef.tar"), "wb") as f:
+        f.write(b"partial")
+    with open(os.path.join(out, "shard-0123456789abcdef.index.csv.tmp"), "wb") as f:
+        f.write(b"partial")
+
+    allow_list_parallel(str(dicom_folder), str(out), TAGS, key="k", max_workers=1, journal_dir=str(journal),
+                        resume=True, shard_size=1)
+    assert _files(out) == written
@@ -0,0 +1,69 @@
+import os
+
+import pandas as pd
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dcmtag2table import append_to_csv, get_metrics
+
+# (patient, sex, study, modality, series, instances)
+STUDIES = [
+    ("P0", "M", "1.2.1", "CT", 2, 3),
+    ("P0", "M", "1.2.2", "MR", 1, 2),
+    ("P1", "F", "1.2.3", "CT", 1, 1),
+    ("P2", "M", "1.2.4", "US", 3, 1),
+]
+
+
+@pytest.fixture
+def dicom_folder(tmp_path):
+    folder = tmp_path / "in"
+    os.makedirs(folder)
+    template = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    for patient, sex, study, modality, n_series, n_instances in STUDIES:
+        for series in range(n_series):
+            for i in range(n_instances):
+                ds = template.copy()
+                ds.PatientID, ds.PatientSex, ds.Modality = patient, sex, modality
+                ds.StudyInstanceUID = study
+                ds.SeriesInstanceUID = f"{study}.{series}"
+                ds.SOPInstanceUID = f"{study}.{series}.{i}"
+                ds.save_as(folder / f"{study}-{series}-{i}.dcm")
+    (folder / "notes.txt").write_text("not DICOM\n" * 100)
+    return folder
+
+
+def test_get_metrics(dicom_folder, tmp_path):
+    output = tmp_path / "metrics.csv"
+    summary = get_metrics(str(dicom_folder), str(output), max_workers=2)
+
+    dicom_bytes = sum(os.path.getsize(dicom_folder / f) for f in os.listdir(dicom_folder) if f.endswith(".dcm"))
+    assert {k: v for k, v in summary.items() if k != "Timestamp"} == {
+        "Number of files": 12,
+        "Batch Size Bytes": dicom_bytes,
+        "Number of patients": 3,
+        "Number of studies": 4,
+        "Number of series": 7,
+        "Number of MRs": 1,
+        "Number of CTs": 2,
+        "Number of USs": 1,
+        "Number of CRs": 0,
+        "Number of DXs": 0,
+        "Percentage of male": 2 / 3,
+    }
+
+    get_metrics(str(dicom_folder), str(output), max_workers=2)
+    history = pd.read_csv(output)
+    assert len(history) == 2 and (history["Number of files"] == 12).all()
+
+
+def test_append_to_csv_with_new_columns(tmp_path):
+    output = tmp_path / "history.csv"
+    append_to_csv(str(output), {"a": 1, "b": 2})
+    append_to_csv(str(output), {"a": 3, "b": 4})
+    append_to_csv(str(output), {"a": 5, "c": 6})
+    history = pd.read_csv(output)
+    assert list(history.columns) == ["a", "b", "c"]
+    assert history["a"].tolist() == [1, 3, 5]
+    assert history["c"].isna().tolist() == [True, True, False]
@@ -0,0 +1,51 @@
+import os
+import random
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dcmtag2table import _make_batches, dcmtag2table, dcmtag2table_parallel
+
+TAGS = ["PatientID", "SOPInstanceUID", "Modality", "Rows"]
+
+
+def test_batches_follow_directories_and_shrink():
+    filelist = [os.path.join("/data", f"{d:02d}", f"{i:04d}.dcm") for d in range(5) for i in range(400)]
+    shuffled = filelist[:]
+    random.Random(0).shuffle(shuffled)
+    batches = _make_batches(shuffled, max_workers=4)
+
+    assert [f for batch in batches for f in batch] == filelist
+    sizes = [len(batch) for batch in batches]
+    assert sizes == sorted(sizes, reverse=True)
+    assert all(16 <= size <= 2048 for size in sizes[:-1])
+    # Guided scheduling: many more batches than workers, the first a fraction of the files
+    assert len(batches) > 4 * 4 and sizes[0] == len(filelist) // 16
+
+
+def test_batch_size_bounds():
+    filelist = [f"/data/{i:06d}.dcm" for i in range(100000)]
+    assert max(len(batch) for batch in _make_batches(filelist, max_workers=1)) == 2048
+    assert [len(batch) for batch in _make_batches(filelist[:20], max_workers=8)] == [16, 4]
+
+
+@pytest.fixture
+def dicom_folder(tmp_path):
+    template = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    for d in range(3):
+        os.makedirs(tmp_path / str(d))
+        for i in range(7):
+            ds = template.copy()
+            ds.PatientID = f"P{d}"
+            ds.SOPInstanceUID = f"1.2.3.{d}.{i}"
+            ds.save_as(tmp_path / str(d) / f"{i}.dcm")
+    return tmp_path
+
+
+def test_parallel_scan_matches_serial_scan(dicom_folder):
+    serial = dcmtag2table(str(dicom_folder), TAGS)
+    parallel = dcmtag2table_parallel(str(dicom_folder), TAGS, max_workers=2)
+    key = ["Filename"] + TAGS
+    assert len(parallel) == 21
+    assert parallel[key].astype(str).equals(serial.sort_values("Filename", ignore_index=True)[key].astype(str))
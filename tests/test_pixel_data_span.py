@@ -0,0 +1,20 @@
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dcmtag2table import _pixel_data_span
+
+
+@pytest.mark.parametrize("keep", [8, 10])
+def test_truncated_explicit_vr_header_raises_value_error(tmp_path, keep):
+    path = tmp_path / "truncated.dcm"
+    with open(get_testdata_file("CT_small.dcm"), "rb") as fin:
+        ds = pydicom.dcmread(fin, stop_before_pixels=True)
+        start = fin.tell()
+        fin.seek(0)
+        path.write_bytes(fin.read(start + keep))
+
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        with pytest.raises(ValueError, match="truncated"):
+            _pixel_data_span(fp, ds)
@@ -0,0 +1,51 @@
+import pandas as pd
+
+import dcmtag2table
+from dcmtag2table import PseudonymStore, replace_ids_parallel_joblib
+
+
+def _table(n):
+    return pd.DataFrame({
+        "Filename": [f"{i}.dcm" for i in range(n)],
+        "PatientID": [f"P{i // 2}" for i in range(n)],
+        "StudyInstanceUID": [f"1.2.{i // 2}" for i in range(n)],
+        "SeriesInstanceUID": [f"1.2.{i // 2}.1" for i in range(n)],
+        "SOPInstanceUID": [f"1.2.{i // 2}.1.{i}" for i in range(n)],
+    })
+
+
+def _track_stores(monkeypatch):
+    stores = []
+
+    class TrackedStore(PseudonymStore):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.closed = False
+            stores.append(self)
+
+        def close(self):
+            self.closed = True
+            super().close()
+
+    monkeypatch.setattr(dcmtag2table, "PseudonymStore", TrackedStore)
+    return TrackedStore, stores
+
+
+def test_store_path_is_closed_and_reused_across_batches(tmp_path, monkeypatch):
+    _, stores = _track_stores(monkeypatch)
+    path = str(tmp_path / "store.sqlite")
+    first = replace_ids_parallel_joblib(_table(4), prefix="1.2.840.1234.", store=path)
+    second = replace_ids_parallel_joblib(_table(6), prefix="1.2.840.1234.", store=path)
+
+    assert len(stores) == 2 and all(store.closed for store in stores)
+    merged = second.merge(first, on="Filename", suffixes=("", "_first"))
+    for column in ["fake_PatientID", "fake_StudyID", "fake_StudyInstanceUID", "fake_SOPInstanceUID"]:
+        assert (merged[column] == merged[f"{column}_first"]).all()
+
+
+def test_store_object_is_left_open(tmp_path, monkeypatch):
+    TrackedStore, stores = _track_stores(monkeypatch)
+    with TrackedStore(str(tmp_path / "store.sqlite")) as store:
+        replace_ids_parallel_joblib(_table(4), prefix="1.2.840.1234.", store=store)
+        assert not store.closed
+        assert store.lookup("PatientID", ["P0"])
@@ -0,0 +1,76 @@
+import filecmp
+import os
+
+import pandas as pd
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dcmtag2table import _REWRITE_COLUMNS, _make_rewrite_batches, allow_list_parallel
+
+
+def _mapping(studies):
+    rows = []
+    for study, n in enumerate(studies):
+        for i in range(n):
+            row = {column: f"{column}-{study}-{i}" for column in _REWRITE_COLUMNS}
+            row["fake_StudyInstanceUID"] = f"2.25.{study}"
+            row["PatientName"] = "must not be shipped"
+            rows.append(row)
+    # Interleave the studies
+    return pd.DataFrame(rows).sample(frac=1, random_state=0)
+
+
+def _studies(batch):
+    return sorted(set(batch["fake_StudyInstanceUID"]))
+
+
+def test_one_batch_per_study():
+    batches = list(_make_rewrite_batches(_mapping([3, 1, 5])))
+    assert sorted(len(batch["Filename"]) for batch in batches) == [1, 3, 5]
+    assert all(len(_studies(batch)) == 1 for batch in batches)
+    assert all(list(batch) == _REWRITE_COLUMNS for batch in batches)
+
+
+def test_fixed_size_batches():
+    batches = list(_make_rewrite_batches(_mapping([3, 1, 5]), batch_size=4))
+    assert [len(batch["Filename"]) for batch in batches] == [4, 4, 1]
+    # Sorted by study: a study is split only at the batch boundary
+    assert [_studies(batch) for batch in batches] == [["2.25.0", "2.25.1"], ["2.25.2"], ["2.25.2"]]
+
+
+def test_whole_study_batches():
+    batches = list(_make_rewrite_batches(_mapping([3, 1, 5]), batch_size=2, whole_studies=True))
+    assert [len(batch["Filename"]) for batch in batches] == [3, 1, 5]
+    batches = list(_make_rewrite_batches(_mapping([3, 1, 5]), batch_size=4, whole_studies=True))
+    assert [_studies(batch) for batch in batches] == [["2.25.0", "2.25.1"], ["2.25.2"]]
+
+
+@pytest.fixture
+def dicom_folder(tmp_path):
+    folder = tmp_path / "in"
+    os.makedirs(folder)
+    template = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    for study in range(3):
+        for i in range(study + 1):
+            ds = template.copy()
+            ds.StudyInstanceUID = f"1.2.3.{study}"
+            ds.SOPInstanceUID = f"1.2.3.{study}.{i}"
+            ds.save_as(folder / f"{study}-{i}.dcm")
+    return folder
+
+
+def _files(root):
+    return sorted(os.path.relpath(os.path.join(r, f), root) for r, _, fs in os.walk(root) for f in fs)
+
+
+def test_batch_size_does_not_change_the_output(dicom_folder, tmp_path):
+    tags = ["PixelData", "Modality", "Rows", "Columns"]
+    allow_list_parallel(str(dicom_folder), str(tmp_path / "a"), tags, key="k", max_workers=1, scan_workers=1)
+    allow_list_parallel(str(dicom_folder), str(tmp_path / "b"), tags, key="k", max_workers=2, scan_workers=1,
+                        batch_size=2)
+    files = _files(tmp_path / "a")
+    assert len(files) == 6 and len({os.path.dirname(f) for f in files}) == 3
+    assert files == _files(tmp_path / "b")
+    for f in files:
+        assert filecmp.cmp(tmp_path / "a" / f, tmp_path / "b" / f, shallow=False)
@@ -0,0 +1,80 @@
+import os
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+import dcmtag2table as d
+
+
+@pytest.fixture
+def dicom_folder(tmp_path):
+    folder = tmp_path / "in"
+    os.makedirs(folder)
+    template = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    for i in range(3):
+        ds = template.copy()
+        ds.PatientID = f"P{i}"
+        ds.save_as(folder / f"{i}.dcm")
+    return folder
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    # (path, number of tags) of every file actually opened
+    calls = []
+    read_dicom_tags = d._read_dicom_tags
+
+    def spy(filepath, plan, *args, **kwargs):
+        calls.append((os.path.basename(filepath), len(plan)))
+        return read_dicom_tags(filepath, plan, *args, **kwargs)
+
+    monkeypatch.setattr(d, "_read_dicom_tags", spy)
+    return calls
+
+
+def _scan(folder, cache, tags):
+    df = d.dcmtag2table(str(folder), tags, cache_path=str(cache))
+    return dict(zip(df["Filename"].map(os.path.basename), df[tags[0]]))
+
+
+def test_unchanged_files_are_not_read_again(dicom_folder, tmp_path, reads):
+    cache = tmp_path / "cache.pkl"
+    assert _scan(dicom_folder, cache, ["PatientID"]) == {"0.dcm": "P0", "1.dcm": "P1", "2.dcm": "P2"}
+    assert len(reads) == 3
+    reads.clear()
+    assert _scan(dicom_folder, cache, ["PatientID"]) == {"0.dcm": "P0", "1.dcm": "P1", "2.dcm": "P2"}
+    assert reads == []
+
+
+def test_modified_and_deleted_files(dicom_folder, tmp_path, reads):
+    cache = tmp_path / "cache.pkl"
+    _scan(dicom_folder, cache, ["PatientID"])
+    reads.clear()
+
+    # Same size, new mtime
+    ds = pydicom.dcmread(dicom_folder / "1.dcm")
+    ds.PatientID = "Q1"
+    ds.save_as(dicom_folder / "1.dcm")
+    st = os.stat(dicom_folder / "1.dcm")
+    os.utime(dicom_folder / "1.dcm", ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    # Other size
+    ds = pydicom.dcmread(dicom_folder / "2.dcm")
+    ds.PatientID = "LONGER PATIENT ID"
+    ds.save_as(dicom_folder / "2.dcm")
+    os.remove(dicom_folder / "0.dcm")
+
+    assert _scan(dicom_folder, cache, ["PatientID"]) == {"1.dcm": "Q1", "2.dcm": "LONGER PATIENT ID"}
+    assert sorted(reads) == [("1.dcm", 1), ("2.dcm", 1)]
+    assert sorted(d._load_scan_cache(str(cache))["Filename"].map(os.path.basename)) == ["1.dcm", "2.dcm"]
+
+
+def test_new_tag_reads_only_the_new_tag(dicom_folder, tmp_path, reads):
+    cache = tmp_path / "cache.pkl"
+    _scan(dicom_folder, cache, ["PatientID"])
+    reads.clear()
+
+    df = d.dcmtag2table(str(dicom_folder), ["Modality", "PatientID"], cache_path=str(cache))
+    assert list(df["Modality"]) == ["CT"] * 3
+    assert sorted(df["PatientID"]) == ["P0", "P1", "P2"]
+    assert sorted(reads) == [("0.dcm", 1), ("1.dcm", 1), ("2.dcm", 1)]
@@ -0,0 +1,46 @@
+import os
+import shutil
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dcmtag2table import scan_dicom_files
+
+
+@pytest.fixture
+def mixed_folder(tmp_path):
+    os.makedirs(tmp_path / "a" / "b")
+    shutil.copy(get_testdata_file("CT_small.dcm"), tmp_path / "a" / "with_preamble.dcm")
+    # Implicit VR Little Endian without preamble or file meta
+    ds = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    del ds.file_meta
+    ds.preamble = None
+    ds.save_as(tmp_path / "a" / "b" / "raw", implicit_vr=True, little_endian=True)
+    (tmp_path / "empty.dcm").write_bytes(b"")
+    (tmp_path / "tiny.dcm").write_bytes(b"abc")
+    (tmp_path / "notes.txt").write_text("not a DICOM file at all\n" * 10)
+    return tmp_path
+
+
+def test_filter_reasons(mixed_folder):
+    files, skipped = scan_dicom_files(str(mixed_folder), max_threads=2)
+
+    assert files == [str(mixed_folder / "a" / "b" / "raw"), str(mixed_folder / "a" / "with_preamble.dcm")]
+    assert dict(skipped) == {
+        "empty file": [str(mixed_folder / "empty.dcm")],
+        "too small for DICOM": [str(mixed_folder / "tiny.dcm")],
+        "no DICM magic or plausible first tag": [str(mixed_folder / "notes.txt")],
+    }
+    for path in files:
+        pydicom.dcmread(path, force=True)
+
+
+def test_stats_and_unfiltered_listing(mixed_folder):
+    stats, skipped = scan_dicom_files(str(mixed_folder), check_header=False, return_stats=True)
+
+    assert not any(skipped.values())
+    assert len(stats) == 5
+    for path, size, mtime_ns, inode in stats:
+        st = os.stat(path)
+        assert (size, mtime_ns, inode) == (st.st_size, st.st_mtime_ns, st.st_ino)
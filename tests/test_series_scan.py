@@ -0,0 +1,62 @@
+import os
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dcmtag2table import _evenly_spaced, dcmtag2table_parallel, dcmtag2table_series
+
+TAGS = ["PatientID", "Modality", "SliceThickness", "SeriesDescription"]
+
+
+def test_evenly_spaced():
+    assert _evenly_spaced(10, 1) == [0]
+    assert _evenly_spaced(10, 2) == [0, 9]
+    assert _evenly_spaced(10, 4) == [0, 3, 6, 9]
+    assert _evenly_spaced(3, 5) == [0, 1, 2]
+    assert _evenly_spaced(10, 0) == []
+
+
+@pytest.fixture
+def dicom_folder(tmp_path):
+    template = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+
+    def write(directory, series, n, start=0):
+        os.makedirs(tmp_path / directory, exist_ok=True)
+        for i in range(start, start + n):
+            ds = template.copy()
+            ds.PatientID = f"P{series // 10}"
+            ds.SeriesInstanceUID = f"1.2.3.{series}"
+            ds.SOPInstanceUID = f"1.2.3.{series}.{i}"
+            ds.SliceThickness = series
+            ds.SeriesDescription = f"series {series}"
+            ds.save_as(tmp_path / directory / f"{series}-{i:03d}.dcm")
+
+    write("a", 1, 30)
+    write("b", 2, 12)
+    write("c", 3, 3)    # Too small to sample
+    write("mixed", 4, 10)
+    write("mixed", 5, 10)
+    write("split1", 16, 10)
+    write("split2", 16, 10, start=10)
+    return tmp_path
+
+
+def test_series_table_matches_a_full_scan(dicom_folder):
+    series = dcmtag2table_series(str(dicom_folder), TAGS, max_workers=2, samples=2, verify=3)
+    full = dcmtag2table_parallel(str(dicom_folder), TAGS + ["SeriesInstanceUID"], max_workers=2)
+    expected = full.groupby("SeriesInstanceUID").agg(
+        Files=("Filename", "size"), **{tag: (tag, "first") for tag in TAGS})
+
+    table = series.set_index("SeriesInstanceUID").sort_index()
+    assert table[["Files"] + TAGS].astype(str).equals(expected.loc[table.index, ["Files"] + TAGS].astype(str))
+    assert table["Sampled"].to_dict() == {
+        "1.2.3.1": True, "1.2.3.2": True, "1.2.3.3": False, "1.2.3.4": False, "1.2.3.5": False, "1.2.3.16": True,
+    }
+    assert table.loc["1.2.3.16", "Files"] == 20
+    assert sorted(series["Directory"].map(os.path.basename)) == ["a", "b", "c", "mixed", "mixed", "split1"]
+
+
+def test_samples_must_be_positive(dicom_folder):
+    with pytest.raises(ValueError, match="samples"):
+        dcmtag2table_series(str(dicom_folder), TAGS, samples=0)
@@ -0,0 +1,57 @@
+import os
+import tarfile
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dcmtag2table import allow_list_parallel, load_shard_index, read_from_shard
+
+TAGS = ["PixelData", "Modality", "Rows", "Columns"]
+
+
+@pytest.fixture
+def dicom_folder(tmp_path):
+    folder = tmp_path / "in"
+    os.makedirs(folder)
+    template = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    for study in range(4):
+        for i in range(3):
+            ds = template.copy()
+            ds.StudyInstanceUID = f"1.2.3.{study}"
+            ds.SOPInstanceUID = f"1.2.3.{study}.{i}"
+            ds.save_as(folder / f"{study}-{i}.dcm")
+    return folder
+
+
+def test_shards_round_trip_through_the_index(dicom_folder, tmp_path):
+    files, shards = tmp_path / "files", tmp_path / "shards"
+    allow_list_parallel(str(dicom_folder), str(files), TAGS, key="k", max_workers=1, scan_workers=1)
+    # About two studies per shard
+    allow_list_parallel(str(dicom_folder), str(shards), TAGS, key="k", max_workers=1, scan_workers=1,
+                        shard_size=4 * os.path.getsize(dicom_folder / "0-0.dcm"))
+
+    index = load_shard_index(str(shards))
+    assert len(index) == 12 and index["SOPInstanceUID"].is_unique
+    assert index["shard"].nunique() == 2
+    # A study is never split over shards
+    assert (index.groupby("StudyInstanceUID")["shard"].nunique() == 1).all()
+
+    for row in index.itertuples():
+        with open(files / row.member, "rb") as f:
+            expected = f.read()
+        with open(row.shard, "rb") as f:
+            f.seek(row.offset)
+            assert f.read(row.size) == expected
+        ds = read_from_shard(row.shard, row.offset, row.size)
+        assert ds.SOPInstanceUID == row.SOPInstanceUID
+        assert ds.PixelData == pydicom.dcmread(files / row.member, force=True).PixelData
+        assert read_from_shard(row.shard, row.offset, row.size, stop_before_pixels=True).get("PixelData") is None
+
+    for shard in index["shard"].unique():
+        with tarfile.open(shard) as tar:
+            members = tar.getmembers()
+            assert sorted(m.name for m in members) == sorted(index.loc[index["shard"] == shard, "member"])
+            for member in members:
+                with open(files / member.name, "rb") as f:
+                    assert tar.extractfile(member).read() == f.read()
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dcmtag2table import dcmtag2table_parallel, merge_partial_tables, shard_of
+
+TAGS = ["PatientID", "SOPInstanceUID", "Modality", "Rows", "PixelSpacing"]
+
+
+@pytest.fixture
+def dicom_folder(tmp_path):
+    folder = tmp_path / "in"
+    template = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    for d in range(4):
+        os.makedirs(folder / str(d))
+        for i in range(6):
+            ds = template.copy()
+            ds.PatientID = f"P{d}"
+            ds.SOPInstanceUID = f"1.2.3.{d}.{i}"
+            ds.save_as(folder / str(d) / f"{i}.dcm")
+    return folder
+
+
+def test_shard_of_ignores_the_mount_point():
+    paths = [f"{d}/{i}.dcm" for d in range(10) for i in range(10)]
+    first = [shard_of(os.path.join("/mnt/a", p), "/mnt/a", 4) for p in paths]
+    second = [shard_of(os.path.join("/srv/nfs/dicom", p), "/srv/nfs/dicom/", 4) for p in paths]
+    assert first == second
+    assert set(first) == {0, 1, 2, 3}
+
+
+def _text(df):
+    # Parquet gives multi-valued cells back as arrays
+    return df.map(lambda value: value.tolist() if isinstance(value, np.ndarray) else value).astype(str)
+
+
+@pytest.mark.parametrize("typed, suffix", [(False, ".pkl"), (True, ".pkl"), (True, ".parquet")])
+def test_merged_shards_match_a_single_scan(dicom_folder, tmp_path, typed, suffix):
+    full = dcmtag2table_parallel(str(dicom_folder), TAGS, max_workers=1, typed=typed)
+    paths = []
+    for i in range(3):
+        part = dcmtag2table_parallel(str(dicom_folder), TAGS, max_workers=1, typed=typed, shard=f"{i}/3")
+        paths.append(str(tmp_path / f"part{i}{suffix}"))
+        part.to_parquet(paths[-1]) if suffix == ".parquet" else part.to_pickle(paths[-1])
+    merged = merge_partial_tables(paths, output=str(tmp_path / f"merged{suffix}"))
+
+    assert len(full) == 24
+    assert _text(merged).equals(_text(full))
+    if typed:
+        assert (merged.dtypes.astype(str) == full.dtypes.astype(str)).all()
+
+
+def test_overlapping_shards_are_rejected(dicom_folder):
+    part = dcmtag2table_parallel(str(dicom_folder), TAGS, max_workers=1, shard="0/2")
+    with pytest.raises(ValueError, match="overlap"):
+        merge_partial_tables([part, part])
+
+
+def test_bad_shard():
+    with pytest.raises(ValueError, match="0 <= i < N"):
+        dcmtag2table_parallel(".", TAGS, shard="3/3")
@@ -0,0 +1,43 @@
+import filecmp
+import os
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+import dcmtag2table
+from dcmtag2table import allow_list_parallel, allow_list_single_pass
+
+
+@pytest.fixture
+def dicom_folder(tmp_path):
+    folder = tmp_path / "in"
+    template = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    for study in range(2):
+        for i in range(3):
+            ds = template.copy()
+            ds.StudyInstanceUID = f"1.2.3.{study}"
+            ds.SeriesInstanceUID = f"1.2.3.{study}.1"
+            ds.SOPInstanceUID = f"1.2.3.{study}.1.{i}"
+            os.makedirs(folder / str(study), exist_ok=True)
+            ds.save_as(folder / str(study) / f"{i}.dcm")
+    return folder
+
+
+def _output_files(root):
+    return sorted(os.path.relpath(os.path.join(r, f), root) for r, _, fs in os.walk(root) for f in fs)
+
+
+def test_single_pass_matches_two_pass_with_key(dicom_folder, tmp_path, monkeypatch):
+    # Several header chunks per batch
+    monkeypatch.setattr(dcmtag2table, "_SINGLE_PASS_CHUNK", 2)
+    tags = ["PixelData", "Modality", "Rows", "Columns"]
+    two_pass = allow_list_parallel(str(dicom_folder), str(tmp_path / "a"), tags, key="k", max_workers=1)
+    crosswalk = allow_list_single_pass(str(dicom_folder), str(tmp_path / "b"), tags, key="k", max_workers=1)
+
+    files = _output_files(tmp_path / "a")
+    assert len(files) == 6
+    assert files == _output_files(tmp_path / "b")
+    for f in files:
+        assert filecmp.cmp(tmp_path / "a" / f, tmp_path / "b" / f, shallow=False)
+    assert list(crosswalk["fake_SOPInstanceUID"]) == list(two_pass["fake_SOPInstanceUID"])
@@ -0,0 +1,89 @@
+import os
+import random
+from collections import Counter
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dcmtag2table import HyperLogLog, SpaceSaving, profile_tag_values
+
+
+@pytest.mark.parametrize("n", [50, 1000, 100000])
+def test_hyperloglog_error_bound(n):
+    hll = HyperLogLog(precision=12)
+    for i in range(n):
+        hll.add(f"1.2.826.0.1.{i}")
+    # Three standard errors (1.04 / sqrt(4096) = 1.6%)
+    assert abs(hll.estimate() - n) <= max(2, 3 * 1.04 / 64 * n)
+
+
+def test_hyperloglog_merge_is_the_union():
+    a, b, union = HyperLogLog(10), HyperLogLog(10), HyperLogLog(10)
+    for i in range(3000):
+        (a if i < 2000 else b).add(str(i))
+        union.add(str(i))
+    # Overlap counted once
+    for i in range(1000, 2000):
+        b.add(str(i))
+    assert np.array_equal(a.merge(b).registers, union.registers)
+    with pytest.raises(ValueError):
+        a.merge(HyperLogLog(11))
+
+
+def _zipf_stream(n, seed):
+    rng = random.Random(seed)
+    return [f"v{int(rng.paretovariate(1.1))}" for _ in range(n)]
+
+
+def _check_space_saving(sketch, stream, k):
+    true = Counter(stream)
+    kept = {value: (count, error) for value, count, error in sketch.top()}
+    assert len(kept) <= k
+    for value, (count, error) in kept.items():
+        assert count - error <= true[value] <= count
+    # Every value above n/k is kept
+    for value, count in true.items():
+        if count > len(stream) / k:
+            assert value in kept
+
+
+def test_space_saving_bounds():
+    stream = _zipf_stream(20000, seed=0)
+    sketch = SpaceSaving(k=10)
+    for value in stream:
+        sketch.add(value)
+    _check_space_saving(sketch, stream, 10)
+    top = sketch.top()
+    assert [count for _, count, _ in top] == sorted((count for _, count, _ in top), reverse=True)
+
+
+def test_merged_space_saving_bounds():
+    first, second = _zipf_stream(10000, seed=1), _zipf_stream(10000, seed=2)
+    a, b = SpaceSaving(k=10), SpaceSaving(k=10)
+    for value in first:
+        a.add(value)
+    for value in second:
+        b.add(value)
+    _check_space_saving(a.merge(b), first + second, 10)
+
+
+def test_profile_tag_values(tmp_path):
+    template = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    for i in range(12):
+        ds = template.copy()
+        ds.PatientID = f"P{i % 3}"
+        ds.SOPInstanceUID = f"1.2.3.{i}"
+        ds.save_as(tmp_path / f"{i}.dcm")
+    df = profile_tag_values(str(tmp_path), max_workers=2, k=2).set_index("tag")
+
+    assert df.loc["SOPInstanceUID", ["values", "files", "cardinality"]].tolist() == [12, 12, 12]
+    assert df.loc["PatientID", "cardinality"] == 3
+    # Three values for two counters: counts are overestimates within their error
+    assert len(df.loc["PatientID", "top_values"]) == 2
+    for _, count, error in df.loc["PatientID", "top_values"]:
+        assert count - error <= 4 <= count
+    assert df.loc["Modality", "cardinality"] == 1
+    assert df.loc["Modality", "top_values"] == [("CT", 12, 0)]
+    assert df["cardinality"].is_monotonic_decreasing
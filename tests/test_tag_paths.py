@@ -0,0 +1,22 @@
+import pytest
+
+from dcmtag2table import _compile_tag_path
+
+
+def test_private_tag_block_is_resolved_from_creator():
+    expected = (((0x0019101E & 0xFFFF00FF), "GEMS_ACQU_01", None),)
+    assert _compile_tag_path("(0019,xx1E,GEMS_ACQU_01)") == expected
+    assert _compile_tag_path("(0019,101E,GEMS_ACQU_01)") == expected
+
+
+@pytest.mark.parametrize("path", ["(0019,10xx,GEMS_ACQU_01)", "(0019,1x1E,GEMS_ACQU_01)"])
+def test_private_tag_without_offset_names_the_syntax(path):
+    with pytest.raises(ValueError, match=r"\(gggg,xxee,CREATOR\)"):
+        _compile_tag_path(path)
+
+
+@pytest.mark.parametrize("path", ["Seq[0]", "PatientID[0]", "(0018,xx10)", "(0018,xx10,ABC)", "*", "A..B",
+                                  "PatientID/"])
+def test_malformed_paths_raise(path):
+    with pytest.raises(ValueError):
+        _compile_tag_path(path)
@@ -0,0 +1,55 @@
+import csv
+import os
+from collections import Counter
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+import dcmtag2table as d
+
+
+@pytest.fixture
+def dicom_folder(tmp_path):
+    folder = tmp_path / "in"
+    template = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    for study in range(3):
+        os.makedirs(folder / str(study))
+        for i in range(4):
+            ds = template.copy()
+            ds.PatientID = f"P{study}"
+            ds.SOPInstanceUID = f"1.2.3.{study}.{i}"
+            ds.ImageComments = "tab\there"
+            ds.save_as(folder / str(study) / f"{i}.dcm")
+    return folder
+
+
+def _report(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = list(csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE))
+    assert rows[0] == ["tag", "vr", "value", "count", "example_file"]
+    return rows[1:]
+
+
+def test_spilled_report_matches_in_memory_counts(dicom_folder, tmp_path, monkeypatch):
+    expected = Counter()
+    for root, _, files in os.walk(dicom_folder):
+        for name in files:
+            ds = pydicom.dcmread(os.path.join(root, name), stop_before_pixels=True)
+            expected.update(d._iter_tag_values(ds))
+
+    unbounded = d.dump_unique_values_per_tag(str(dicom_folder), str(tmp_path / "a.tsv"), max_workers=2)
+    # A run every 5 keys, merged 2 runs at a time
+    monkeypatch.setattr(d, "_MERGE_FAN_IN", 2)
+    bounded = d.dump_unique_values_per_tag(str(dicom_folder), str(tmp_path / "b.tsv"), max_workers=2,
+                                           max_entries=5, spill_dir=str(tmp_path))
+
+    assert unbounded == bounded == len(expected)
+    a, b = _report(tmp_path / "a.tsv"), _report(tmp_path / "b.tsv")
+    assert [row[:4] for row in a] == [row[:4] for row in b]
+    assert {tuple(row[:3]): int(row[3]) for row in b} == dict(expected)
+    assert [row[:3] for row in b] == sorted(row[:3] for row in b)
+    assert ["PatientID", "LO", "P1", "4"] in [row[:4] for row in b]
+    assert ["ImageComments", "LT", "tab\\there", "12"] in [row[:4] for row in b]
+    # The spill directory is cleaned up
+    assert sorted(os.listdir(tmp_path)) == ["a.tsv", "b.tsv", "in"]